@@ -1,49 +1,23 @@
 import sys
 import os
 import re
-import glob
 import random
 import json
+import contextlib
+import collections
+import html
 import pathlib
-import time
-import dataclasses
+import threading
 import sublime
 import sublime_plugin
 from . import sbot_common as sc
-
-
-# Known file types.
-IMAGE_TYPES = ['.jpg', '.jpeg', '.png', '.bmp', '.gif']
-
-
-#--------------------------- Types -------------------------------------------------
-
-# One target: section or file/url.
-@dataclasses.dataclass(order=True)
-class Target:
-    sort_index: str = dataclasses.field(init=False)
-    name: str      # section title or description
-    ttype: str     # 'section', 'url', 'image', 'file', 'dir'
-    category: str  # 'sticky', 'mru', 'none'
-    level: int     # for section only
-    tags: list     # tags for targets
-    resource: str  # what ttype points to
-    file: str      # .ntr file path
-    line: int      # .ntr file line
-
-    def __post_init__(self):
-        self.sort_index = self.name
-
-# A reference to a Target.
-@dataclasses.dataclass(order=True)
-class Ref:
-    sort_index: str = dataclasses.field(init=False)
-    name: str  # "target#name"
-    file: str  # .ntr file path
-    line: int  # .ntr file line
-
-    def __post_init__(self):
-        self.sort_index = self.name
+from . import notr_core as core
+from . import notr_publish as publish
+from . import notr_db as db
+from . import notr_links as links
+from . import notr_thumbs as thumbs
+from . import notr_complete as complete
+from . import notr_mru as mru
 
 
 #---------------------------- Data -----------------------------------------------
@@ -55,8 +29,14 @@ _current_project = None
 # See Packages/User/Notr/Notr.store.
 _store = None
 
-# Persisted mru.
-_current_mru = []
+# Persisted frecency of visited targets for the mru.
+_frecency = mru.Frecency()
+
+# The _targets that _frecency was last pruned against.
+_frecency_targets = None
+
+# Drill-down selector tree. Tuple of (_targets it was built from, [core.TargetNode]).
+_target_tree = (None, [])
 
 # All Targets found in project ntr files. They are ordered by project.notr_paths => notr_files => sections.
 _targets = []
@@ -67,6 +47,40 @@ _refs = []
 # Accumulated prrors to report to user. Tuples of (path, line, msg).
 _user_errors = []
 
+# Recently used project indexes, least recent first. Key is project file name, value is ProjectIndex.
+_index_cache = collections.OrderedDict()
+
+# Ids of the windows sharing the current project index. All windows are on the one project so they all see the same
+# snapshot. When the last one closes only the current project index is kept.
+_subscribers = set()
+
+# Guards _index_cache and the snapshot swap. Builds are done outside it so the UI never waits on a parse.
+_index_lock = threading.Lock()
+
+# One writer to the index database at a time.
+_db_lock = threading.Lock()
+
+# Lazy fixed_hl coverage per view. Key is view id, value is (change_count, begin, end).
+_fixed_hl_coverage = {}
+
+# Targets by name for hover lookups. Tuple of (_targets it was made from, dict).
+_target_names = (None, {})
+
+# Alias tables with each file's overrides. Tuple of (project AliasTable they were made from, dict of ntr file name to
+# AliasTable).
+_file_alias_tables = (None, {})
+
+# Image thumbnails for hover. Made on first use.
+_thumb_cache = None
+
+# Target names for ref completion, and the FileIndexes it has now.
+_name_trie = complete.NameTrie()
+_name_trie_files = {}
+
+# Section hover popups, least recent first. Key is (file, offset), value is (file mtime, content).
+_preview_cache = collections.OrderedDict()
+_PREVIEW_CACHE_SIZE = 200
+
 
 #-----------------------------------------------------------------------------------
 def plugin_loaded():
@@ -102,7 +116,7 @@ class NotrEvent(sublime_plugin.EventListener):
         project_files = settings.get('project_files')
         if project_files is not None:
             for pf in project_files:  # pyright: ignore
-                spf = sc.expand_vars(pf)
+                spf = core.expand_vars(pf)
                 if spf is not None and os.path.isfile(spf):
                     valid_projects.append(spf)
                 else: # invalid project file - user must fix
@@ -124,7 +138,7 @@ class NotrEvent(sublime_plugin.EventListener):
             if vp in temp_store.keys(): # valid one - copy it
                 _store[vp] = temp_store[vp]
             else: # new one - add default
-                _store[vp] = {'active':False, 'mru':[]}
+                _store[vp] = {'active':False, 'frecency':[]}
 
         # Determine project file. Ensure one only active.
         project_fn = None
@@ -138,6 +152,9 @@ class NotrEvent(sublime_plugin.EventListener):
 
         if project_fn is not None:
             _open_project(project_fn)
+            # All windows share the one index.
+            for view in views:
+                _subscribe(view.window())
             _process_all_files(views[0].window())
             # Views are all valid now so init them.
             for view in views:
@@ -151,11 +168,27 @@ class NotrEvent(sublime_plugin.EventListener):
         self._init_fixed_hl(view)
         _set_status(view)
 
+    def on_new_window(self, window):
+        ''' Share the current index, no need to process again. '''
+        _subscribe(window)
+
+    def on_pre_close_window(self, window):
+        ''' Window doesn't need the index anymore. '''
+        _unsubscribe(window)
+
     def on_pre_close(self, view):
         ''' Save anything. '''
-        del view
+        _fixed_hl_coverage.pop(view.id(), None)
         _write_store()
 
+    def on_activated(self, view):
+        ''' View got focus. Extend lazy highlights if needed. '''
+        self._extend_fixed_hl(view)
+
+    def on_selection_modified(self, view):
+        ''' Caret moved, maybe scrolled too. Extend lazy highlights if needed. '''
+        self._extend_fixed_hl(view)
+
     def on_post_save(self, view):
         ''' Called after a view has been saved.
         If it is a notr file, reload all ntr files. Seems a bit brute force, how else?
@@ -164,42 +197,114 @@ class NotrEvent(sublime_plugin.EventListener):
             _process_all_files(view.window())
         elif _current_project is not None and view.file_name() == _current_project['_fn']:
             _open_project(view.file_name())
-            _process_all_files(view.window)
+            _process_all_files(view.window())
+
+    def on_query_completions(self, view, prefix, locations):
+        ''' Complete ref names after <*. '''
+        if view.syntax() is None or view.syntax().name != 'Notr' or len(locations) != 1:
+            return None
+
+        # What's been typed since the <*.
+        loc = locations[0]
+        line = view.substr(sublime.Region(view.line(loc).begin(), loc))
+        start = line.rfind('<*')
+        if start < 0 or '>' in line[start:]:
+            return None
+        typed = line[start + 2:].lstrip()
+        if not typed.endswith(prefix):
+            return None
+
+        settings = sublime.load_settings(sc.get_settings_fn())
+        limit = int(str(settings.get('max_completions', 50)))
+        mru_names = _get_frecency().ranked(int(str(settings.get('mru_size', 5))))
+        findex = None
+        index = _index_cache.get(_current_project['_fn']) if _current_project is not None else None
+        if index is not None:
+            findex = index.files.get(view.file_name())
+        local_names = [t.name for t in findex.sections + findex.links] if findex is not None else []
+
+        # Matching ignores case. Sublime replaces just the prefix so a command puts in the whole name as it's spelled.
+        items = []
+        for name, rank in complete.complete(_name_trie, typed, mru_names, local_names, limit):
+            items.append(sublime.CompletionItem.command_completion(trigger=name, command='notr_complete_ref',
+                                                                   args={'name': name}, annotation=rank,
+                                                                   kind=sublime.KIND_NAVIGATION))
+        return sublime.CompletionList(items, flags=sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_REORDER)
+
+    def on_hover(self, view, point, hover_zone):
+        ''' Show a preview of the section or image link/ref under the mouse. '''
+        if (hover_zone != sublime.HOVER_TEXT or _current_project is None or
+                view.syntax() is None or view.syntax().name != 'Notr'):
+            return
+        settings = sublime.load_settings(sc.get_settings_fn())
+        if not settings.get('hover_previews', True):
+            return
+
+        res = None
+        tref = _get_text_for_scope(view, point, 'markup.link.refname.notr')
+        tlink = _get_text_for_scope(view, point, 'markup.link.target.notr')
+        if tref is not None:
+            if tref.startswith('#') and view.file_name() is not None:
+                tref = core.get_froot(view.file_name()) + tref
+            target = _get_target(tref)
+            if target is not None and target.ttype == 'section':
+                _show_section_popup(view, point, target)
+            elif target is not None and target.ttype == 'image':
+                res = target.resource
+        elif tlink is not None:
+            res = _expand_vars(tlink, view.file_name())
+
+        if res is not None and os.path.splitext(res)[1].lower() in core.IMAGE_TYPES:
+            _show_image_popup(view, point, res)
 
     def _init_fixed_hl(self, view):
         ''' Add any highlights. '''
-        if (_current_project is not None and
-            view.is_scratch() is False and
-            view.file_name() is not None and
-            view.syntax() is not None and
-            view.syntax().name == 'Notr'):
-            settings = sublime.load_settings(sc.get_settings_fn())
-            whole_word = settings.get('fixed_hl_whole_word')
-            fixed_hl = _current_project['fixed_hl']
-            if fixed_hl is None:
-                return
-
-            hl_info = sc.get_highlight_info('fixed')
-            for hl_index in range(len(fixed_hl)):
-                hl = hl_info[hl_index]
-                # Clean first.
-                view.erase_regions(hl.region_name)
+        if self._check_fixed_hl(view):
+            # Start over.
+            _fixed_hl_coverage.pop(view.id(), None)
+            if _get_fixed_hl_lazy(view):
+                self._extend_fixed_hl(view)
+            else:
+                _add_fixed_hl(view, [sublime.Region(0, view.size())], False)
 
-                # New ones.
-                hl_regions = []
+    def _extend_fixed_hl(self, view):
+        ''' Lazy mode only. Highlight the visible region plus margin if not already covered. '''
+        if not self._check_fixed_hl(view) or not _get_fixed_hl_lazy(view):
+            return
 
-                # Colorize one token.
-                for token in fixed_hl[hl_index]:
-                    escaped = re.escape(token)
-                    if whole_word:  # and escaped[0].isalnum():
-                        escaped = r'\b%s\b' % escaped
-                    regs = view.find_all(escaped) if whole_word else view.find_all(token, sublime.LITERAL)
-                    # print(escaped, len(regs))
-                    hl_regions.extend(regs)
+        settings = sublime.load_settings(sc.get_settings_fn())
+        margin = int(str(settings.get('fixed_hl_lazy_margin', 20000)))
+
+        # What should be covered now. Snap to lines so tokens don't get split.
+        vis = view.visible_region()
+        begin = view.line(max(0, vis.begin() - margin)).begin()
+        end = view.line(min(view.size(), vis.end() + margin)).end()
+        change_count = view.change_count()
+
+        cov = _fixed_hl_coverage.get(view.id())
+        if cov is not None and cov[0] == change_count and begin <= cov[2] and end >= cov[1]:
+            # Overlaps current coverage so just do the new parts.
+            segments = []
+            if begin < cov[1]:
+                segments.append(sublime.Region(begin, cov[1]))
+            if end > cov[2]:
+                segments.append(sublime.Region(cov[2], end))
+            if len(segments) > 0:
+                _add_fixed_hl(view, segments, True)
+            _fixed_hl_coverage[view.id()] = (change_count, min(begin, cov[1]), max(end, cov[2]))
+        else:
+            # First time, edited, or jumped somewhere else - start over.
+            _add_fixed_hl(view, [sublime.Region(begin, end)], False)
+            _fixed_hl_coverage[view.id()] = (change_count, begin, end)
 
-                if len(hl_regions) > 0:
-                    view.add_regions(key=hl.region_name, regions=hl_regions, scope=hl.scope_name,
-                                     flags=sublime.RegionFlags.DRAW_STIPPLED_UNDERLINE)
+    def _check_fixed_hl(self, view):
+        ''' True if view is eligible for fixed highlights. '''
+        return (_current_project is not None and
+                _current_project['fixed_hl'] is not None and
+                view.is_scratch() is False and
+                view.file_name() is not None and
+                view.syntax() is not None and
+                view.syntax().name == 'Notr')
 
 
 #-----------------------------------------------------------------------------------
@@ -259,6 +364,9 @@ class NotrReloadCommand(sublime_plugin.WindowCommand):
     ''' Reload after editing. '''
 
     def run(self):
+        if _current_project is not None:
+            # Start from scratch.
+            _index_cache.pop(_current_project['_fn'], None)
         _process_all_files(self.window)
 
     def is_visible(self):
@@ -267,29 +375,27 @@ class NotrReloadCommand(sublime_plugin.WindowCommand):
 
 #-----------------------------------------------------------------------------------
 class NotrDumpCommand(sublime_plugin.WindowCommand):
-    ''' Diagnostic. '''
-
-    def run(self, verbose=False):
-        text = []
-
-        def do_one(name, coll):
-            text.append(f'\n========== {name} ==========')
-            text.extend([str(x) for x in coll])
-
-        if len(_user_errors) > 0:
-            text.append('\n========== !! errors below !! ==========')
-
-        if verbose:
-            do_one('targets', _targets)
-            do_one('refs', _refs)
-            do_one('tags', _get_all_tags())
-        do_one('ntr_files', _get_all_ntr_files())
+    ''' Diagnostic. Output is streamed to a view, or to out_fn if given.
+        file, ttype and tag limit the output to matching files/targets.
+    '''
 
-        if len(_user_errors) > 0:
-            text.append('\n========== errors ==========')
-            text.extend([f'{p[0]}({p[1]}): {p[2]}' for p in _user_errors])
+    def run(self, verbose=False, file=None, ttype=None, tag=None, out_fn=None):
+        # The lists are snapshots so it's ok to walk them later.
+        lines = _dump_lines(_targets, _refs, _user_errors, verbose, file, ttype, tag)
 
-        sc.create_new_view(self.window, '\n'.join(text))
+        if out_fn is not None:
+            out_fn = core.expand_vars(out_fn)
+            try:
+                with open(out_fn, 'w', encoding='utf-8') as fp:
+                    for line in lines:
+                        fp.write(line)
+                        fp.write('\n')
+                sc.info(f'Dumped to {out_fn}')
+            except Exception as e:
+                sc.error(f'Dump to {out_fn} failed: {e}', e.__traceback__)
+        else:
+            view = sc.create_new_view(self.window, '')
+            _stream_to_view(view, lines)
 
     def is_visible(self):
         return True
@@ -309,7 +415,7 @@ class NotrFindInFilesCommand(sublime_plugin.WindowCommand):
         notr_paths = _current_project['notr_paths']
         if notr_paths is not None:
             for npath in notr_paths:  # pyright: ignore
-                expath = sc.expand_vars(npath)
+                expath = core.expand_vars(npath)  # like core.get_project_files()
                 if expath is not None and os.path.exists(expath):
                     paths.append(expath)
 
@@ -325,30 +431,120 @@ class NotrFindInFilesCommand(sublime_plugin.WindowCommand):
 
 
 #-----------------------------------------------------------------------------------
-# class NotrPublishCommand(sublime_plugin.WindowCommand):
-#     ''' TODO Publish the .ntr files somehow/somewhere. '''
+class NotrPublishCommand(sublime_plugin.WindowCommand):
+    ''' Publish the .ntr files as html to the project publish_path. Only changed pages are rendered. '''
+
+    def run(self):
+        pub_path = core.expand_vars(_current_project.get('publish_path'))
+        if pub_path is None:
+            sc.error('Project needs a valid publish_path')
+            return
+
+        project = _current_project
+        settings = sublime.load_settings(sc.get_settings_fn())
+        workers = int(str(settings.get('publish_workers', 4)))
+
+        def _publish():
+            try:
+                # Process pools don't play well with the plugin host so use threads.
+                res = publish.publish(project, pub_path, workers, use_processes=False)
+                sc.info(f'Published {len(res["rendered"])} pages to {pub_path}')
+            except Exception as e:
+                sc.error(f'Publish failed: {e}', e.__traceback__)
+
+        sublime.set_timeout_async(_publish)
+
+    def is_visible(self):
+        return _current_project is not None and 'publish_path' in _current_project
+
+
+#-----------------------------------------------------------------------------------
+class NotrCheckLinksCommand(sublime_plugin.WindowCommand):
+    ''' Check that link resources exist. Urls get a HEAD request. Recent results are cached. '''
 
-#     def run(self):
-#         docs_path = os.path.join("somewhere", 'OneDriveDocuments')
-#         pub_path = os.path.join("somewhere", '_notr')
-#         notes_path = os.path.join(docs_path, 'notes')
+    def run(self):
+        settings = sublime.load_settings(sc.get_settings_fn())
+        workers = int(str(settings.get('link_check_workers', 8)))
+        max_age = float(str(settings.get('link_check_max_age_hours', 24))) * 3600
+        timeout = float(str(settings.get('link_check_timeout', 10)))
+
+        targets = _targets
+        cache_fn = _get_link_cache_fn()
+        window = self.window
+        sc.info('Checking links...')
+
+        def _check():
+            try:
+                cache = links.load_cache(cache_fn)
+                errors = links.check_links(targets, cache, workers, max_age, timeout)
+                links.save_cache(cache_fn, cache)
+            except Exception as e:
+                sc.error(f'Link check failed: {e}', e.__traceback__)
+                return
+
+            if len(errors) > 0:
+                sublime.set_timeout(lambda: _show_user_errors(window, errors, 'Notr link errors'))
+            else:
+                sc.info(f'All {len(cache)} links ok')
+
+        sublime.set_timeout_async(_check)
+
+    def is_visible(self):
+        return _current_project is not None
+
+
+#-----------------------------------------------------------------------------------
+class NotrQueryIndexCommand(sublime_plugin.WindowCommand):
+    ''' Query the index database. A select statement is run as is, anything else is a full text search of sections. '''
 
-#         notes_to_pub = [
-#             'activities.ntr',
-#             'shop.ntr',
-#             'todo.ntr',
-#         ]
+    # Last results for navigation.
+    _cols = []
+    _rows = []
 
-#         # Gen the publish files.
-#         for p in notes_to_pub:
-#             src = os.path.join(notes_path, p)
-#             dest = os.path.join(pub_path, p.replace('.ntr', '.html'))
-#             # need to manage files in/out. Maybe use clipboard?
-#             # self.window.run_command("sbot_render_to_html", {"group": 0})
-#             time.sleep(0.5) # let st finish this first
+    def run(self):
+        self.window.show_input_panel('Query:', '', self.on_done, None, None)
+
+    def on_done(self, text):
+        if len(text.strip()) == 0:
+            return
+
+        # Exporting could take a while so it's done in the background, with the snapshot from now.
+        index = _index_cache[_current_project['_fn']]
+        db_fn = _get_index_db_fn()
 
-#     def is_visible(self):
-#         return False
+        def _query():
+            try:
+                with _db_lock, contextlib.closing(db.open_db(db_fn)) as conn:
+                    db.update_db(conn, index)
+                    cols, rows = db.query(conn, text)
+            except db.sqlite3.Error as e:
+                sc.error(f'Query failed: {e}')
+                return
+            sublime.set_timeout(lambda: self.show_results(cols, rows))
+
+        sublime.set_timeout_async(_query)
+
+    def show_results(self, cols, rows):
+        self._cols, self._rows = cols, rows
+        if len(self._rows) == 0:
+            sc.info('No results')
+            return
+
+        items = []
+        for row in self._rows:
+            item = dict(zip(self._cols, row))
+            details = f'{item["file"]}({item["line"]})' if 'file' in item and 'line' in item else ''
+            items.append(sublime.QuickPanelItem(trigger=' | '.join([str(v) for v in row]), details=details, kind=sublime.KIND_AMBIGUOUS))
+        self.window.show_quick_panel(items, on_select=self.on_sel)
+
+    def on_sel(self, *args, **kwargs):
+        sel = args[0]
+        if sel >= 0 and 'file' in self._cols and 'line' in self._cols:
+            item = dict(zip(self._cols, self._rows[sel]))
+            sc.wait_load_file(self.window, item['file'], item['line'])
+
+    def is_visible(self):
+        return _current_project is not None and _current_project['_fn'] in _index_cache and db.available()
 
 
 #-----------------------------------------------------------------------------------
@@ -393,7 +589,7 @@ class NotrGotoTargetCommand(sublime_plugin.TextCommand):
 
         # Explicit link - do immediate.
         elif tlink is not None:
-            linkfn = sc.expand_vars(tlink)
+            linkfn = _expand_vars(tlink, self.view.file_name())
             if linkfn is None:
                 valid = False
 
@@ -434,8 +630,13 @@ class NotrGotoTargetCommand(sublime_plugin.TextCommand):
                 else:
                     sc.error('No tags in project')
             else:
-                targets = _filter_order_targets(mru_first=True, current_file=self.view.file_name())
-                self.show_targets(targets)
+                settings = sublime.load_settings(sc.get_settings_fn())
+                if settings.get('drill_down_selector', False):
+                    self._node_path = []
+                    self.show_node()
+                else:
+                    targets = _filter_order_targets(mru_first=True, current_file=self.view.file_name())
+                    self.show_targets(targets)
 
     def on_sel_tag(self, *args, **kwargs):
         del kwargs
@@ -471,13 +672,69 @@ class NotrGotoTargetCommand(sublime_plugin.TextCommand):
 
         if len(args) > 0 and args[0] >= 0:
             # Get the selected target record.
-            target = self._targets_to_select[args[0]]
-            _update_mru(target.name)
-            if target.ttype == 'section':
-                # Open the notr file and position it.
-                sc.wait_load_file(self.view.window(), target.file, target.line)
-            elif target.ttype != '':  # 'image', 'url', 'file', 'dir'
-                sc.open_path(target.resource)
+            self.open_target(self._targets_to_select[args[0]])
+
+    def show_node(self):
+        ''' Present one level of the drill-down selector. _node_path is the TargetNodes down to here. '''
+        entries = []
+        if len(self._node_path) == 0:
+            # Sticky and mru stay at the top.
+            entries.extend([('target', target) for target in _get_pinned_targets()])
+            entries.extend([('node', node) for node in _get_target_tree()])
+        else:
+            node = self._node_path[-1]
+            entries.append(('back', node))
+            entries.append(('target', node.target) if node.target is not None else ('file', node))
+            for child in node.children:
+                entries.append(('node', child) if len(child.children) > 0 else ('target', child.target))
+        self._entries = entries
+
+        panel_items = []
+        for kind, item in entries:
+            if kind == 'target':
+                panel_items.extend(_build_selector([item]))
+            elif kind == 'back':
+                panel_items.append(sublime.QuickPanelItem(trigger='..', annotation='back', kind=sublime.KIND_NAVIGATION))
+            elif kind == 'file':
+                panel_items.append(sublime.QuickPanelItem(trigger=item.name, annotation='open file',
+                                                          kind=(sublime.KindId.COLOR_GREENISH, 'N', '')))
+            else:
+                tt = 'S' if item.target is not None else 'N'
+                clr = sublime.KindId.COLOR_REDISH if item.target is not None else sublime.KindId.COLOR_GREENISH
+                panel_items.append(sublime.QuickPanelItem(trigger=item.name, annotation=f'{len(item.children)} >',
+                                                          kind=(clr, tt, '')))
+
+        win = self.view.window()
+        if win is not None:
+            win.show_quick_panel(panel_items, on_select=self.on_sel_node)
+
+    def on_sel_node(self, *args, **kwargs):
+        del kwargs
+
+        if len(args) > 0 and args[0] >= 0:
+            kind, item = self._entries[args[0]]
+            if kind == 'target':
+                self.open_target(item)
+            elif kind == 'file':
+                sc.wait_load_file(self.view.window(), item.file, 1)
+            else:
+                # Up or down a level.
+                win = self.view.window()
+                if win is not None:
+                    win.run_command("hide_overlay")
+                if kind == 'back':
+                    self._node_path.pop()
+                else:
+                    self._node_path.append(item)
+                self.show_node()
+
+    def open_target(self, target):
+        _update_mru(target.name)
+        if target.ttype == 'section':
+            # Open the notr file and position it.
+            sc.wait_load_file(self.view.window(), target.file, target.line)
+        elif target.ttype != '':  # 'image', 'url', 'file', 'dir'
+            sc.open_path(target.resource)
 
     def is_visible(self):
         return _check_syntax(self.view)
@@ -566,6 +823,30 @@ class NotrInsertTargetFromClipCommand(sublime_plugin.TextCommand):
         return _check_syntax(self.view) and sublime.get_clipboard() != ''
 
 
+#-----------------------------------------------------------------------------------
+class NotrCompleteRefCommand(sublime_plugin.TextCommand):
+    ''' Replace what's been typed since the <* with the picked ref name. Run by ref completion. '''
+
+    def run(self, edit, name):
+        v = self.view
+        caret = sc.get_single_caret(v)
+        if caret is None:
+            return
+        line_start = v.line(caret).begin()
+        start = v.substr(sublime.Region(line_start, caret)).rfind('<*')
+        if start < 0:
+            return
+
+        text = name + ('' if v.substr(caret) == '>' else '>')
+        region = sublime.Region(line_start + start + 2, caret)
+        v.replace(edit, region, text)
+        v.sel().clear()
+        v.sel().add(sublime.Region(region.a + len(text), region.a + len(text)))
+
+    def is_visible(self):
+        return False
+
+
 #-----------------------------------------------------------------------------------
 class NotrInsertRefCommand(sublime_plugin.TextCommand):
     ''' Insert ref from list of known refs. '''
@@ -598,60 +879,50 @@ class NotrInsertRefCommand(sublime_plugin.TextCommand):
 #-----------------------------------------------------------------------------------
 def _write_store():
     ''' Save everything. '''
+    if _current_project is not None and _current_project['_fn'] in _store:
+        _store[_current_project['_fn']]['frecency'] = _frecency.dump()
     store_fn = sc.get_store_fn()
     with open(store_fn, 'w') as fp:
         json.dump(_store, fp, indent=4)
 
 #-----------------------------------------------------------------------------------
 def _open_project(project_fn):
-    global _store, _current_project, _current_mru
-
-    try:
-        expfn = sc.expand_vars(project_fn)
-        if expfn is None:
-            sc.error(f'Invalid project file: {project_fn}')
-            return
-
-        if _store is None:
-            sc.error(f'Store not initialized.')
-            return
-
-        with open(expfn, 'r') as fp:
-            s = fp.read()
-            proj = json.loads(s) # TODO use jsonc so .nproj files can use comments.
+    global _store, _current_project, _frecency, _frecency_targets
 
-            # Check file integrity.
-            if "notr_paths" not in proj or "notr_index" not in proj:
-                # Broken file.
-                sc.error(f'Invalid notr project file: {expfn}')
-                return
-
-            # Non-fatal patchups.
-            if "fixed_hl" not in proj:
-                proj["fixed_hl"] = []
-            if 'sticky' not in proj:
-                proj['sticky'] = []
-
-            _current_project = proj
-            _current_project['_fn'] = expfn  # for downstream access
+    if _store is None:
+        sc.error(f'Store not initialized.')
+        return
 
-            # Reset flags first.
-            for _, v in _store.items():
-                v['active'] = False
+    try:
+        _current_project = core.load_project(project_fn)
+        expfn = _current_project['_fn']
 
-            # Get dynamic stuff. Add if not included.
-            if expfn not in _store:  # new, add
-                _store[expfn] = {'active': True, 'mru': []}
-            else:
-                _store[expfn]['active'] = True
-            _current_mru = _store[expfn]['mru']
+        # Reset flags first.
+        for _, v in _store.items():
+            v['active'] = False
 
-            s = f'Opened notr project file {project_fn}'
-            sc.info(s)
-            sublime.status_message(s)
-            for v in sublime.active_window().views():
+        # Get dynamic stuff. Add if not included.
+        if expfn not in _store:  # new, add
+            _store[expfn] = {'active': True, 'frecency': []}
+        else:
+            _store[expfn]['active'] = True
+        # Older stores have a plain mru list.
+        settings = sublime.load_settings(sc.get_settings_fn())
+        half_life = float(str(settings.get('mru_half_life_days', 14))) * 86400
+        _frecency = mru.Frecency.load(_store[expfn].pop('mru', None) or _store[expfn].get('frecency', []), half_life)
+        _frecency_targets = None
+
+        s = f'Opened notr project file {project_fn}'
+        sc.info(s)
+        sublime.status_message(s)
+        for window in _subscribed_windows():
+            for v in window.views():
                 _set_status(v)
 
+    except ValueError as e:
+        # Broken project file.
+        sc.error(str(e))
+
     except Exception as e:
         # Assume bad project file.
         sc.error(f'Error opening notr project file {project_fn}: {e}', e.__traceback__)
@@ -659,228 +930,275 @@ def _open_project(project_fn):
 
 #-----------------------------------------------------------------------------------
 def _process_all_files(window):
-    ''' Get all ntr files and grab their goodies. '''
-    _targets.clear()
-    _refs.clear()
-    _user_errors.clear()
-    ntr_files = []
+    ''' Get all ntr files and grab their goodies. Uses the cached project index if available. '''
+    global _targets, _refs, _user_errors, _name_trie_files
 
     if _current_project is None:
+        _targets = []
+        _refs = []
+        _user_errors = []
+        complete.update_trie(_name_trie, {}, _name_trie_files)
+        _name_trie_files = {}
         return
 
-    settings = sublime.load_settings(sc.get_settings_fn())
+    project = _current_project
+    project_fn = project['_fn']
+    _subscribe(window)
 
-    # Index first.
-    index_path = None
-    notr_index = _current_project['notr_index']
-    if notr_index is not None:
-        index_path = sc.expand_vars(notr_index)
-        if index_path is not None and os.path.exists(index_path):
-            ntr_files.append(index_path)
-        else:
-            _do_user_error(sc.get_settings_fn(), -1, f'Invalid path in project: [{index_path}]')
-
-    # Project directory paths.
-    notr_paths = _current_project['notr_paths']
-    for npath in notr_paths:
-        expath = sc.expand_vars(npath)
-        if expath is not None and os.path.exists(expath):
-            for nfile in glob.glob(os.path.join(expath, '*.ntr')):
-                if index_path is None or not os.path.samefile(nfile, index_path):  # don't do index twice
-                    ntr_files.append(nfile)
-        else:
-            _do_user_error(sc.get_settings_fn(), -1, f'Invalid path in project: [{npath}]')
-
-    # Process the files. Targets are ordered by sections then files/links.
-    sections = []
-    links = []
-    for nfile in ntr_files:
-        fparts = _process_one_file(nfile) # returns (sections, links, refs)
-        if fparts is not None:
-            sections.extend(fparts[0])
-            links.extend(fparts[1])
-            _refs.extend(fparts[2])
-    _targets.extend(sections)
-    _targets.extend(links)
-
-    # Check all user targets and refs are valid.
-    valid_refs = []
-    for target in _targets:
-        if target.name in valid_refs:
-            _do_user_error(target.file, target.line, f'Duplicate target name: [{target.name}]')
-        elif len(target.name) == 0:
-            _do_user_error(target.file, target.line, f'Missing target name: [{target.name}]')
-        elif target.ttype == '':
-            _do_user_error(target.file, target.line, f'Invalid target resource: [{target.resource}]')
-        else:
-            valid_refs.append(target.name)
+    # Revalidate the cached one or make a new one. Indexes aren't changed once made so this can be done unlocked.
+    with _index_lock:
+        old_index = _index_cache.get(project_fn)
+    index = core.build_index(project, old_index)
+    if index is not old_index:
+        index.size = _estimate_index_size(index)
+
+    with _index_lock:
+        # Either way it's now most recent.
+        _index_cache.pop(project_fn, None)
+        _index_cache[project_fn] = index
+        _trim_index_cache(project_fn)
 
-    for ref in _refs:
-        if ref.name not in valid_refs:
-            _do_user_error(ref.file, ref.line, f'Invalid ref name: [{ref.name}]')
+        if _current_project is not project:
+            return  # switched while building, that one does the swap
+
+        # Swap in the new snapshot.
+        complete.update_trie(_name_trie, index.files, _name_trie_files)
+        _name_trie_files = index.files
+        _targets = index.targets
+        _refs = index.refs
+        _user_errors = index.user_errors
+
+    if index is not old_index:
+        _notify_subscribers()
+
+        settings = sublime.load_settings(sc.get_settings_fn())
+        if settings.get('export_db') and db.available():
+            sublime.set_timeout_async(lambda: _export_db(index))
 
     # Do output if errors.
     if len(_user_errors) > 0:
-        output_view = None
-        working_dir = ''
-        use_panel = settings.get("show_panel", False)
+        _show_user_errors(window)
 
-        # Create output to panel or view. Don't call get_output_panel until the regexes are assigned.
-        if use_panel:
-            output_view = window.create_output_panel("exec")
-        else:
-            output_view = sc.create_new_view(window, '')
 
-        # Enable result navigation.
-        settings = output_view.settings()
-        settings.set('result_file_regex', r'^([^\(]+)\(([0-9]+)\)(): (.*)$')
-        settings.set('result_base_dir', working_dir)
+#-----------------------------------------------------------------------------------
+def _expand_vars(s, ntr_fn):
+    ''' Expand with the current project aliases, plus the ones in ntr_fn. The tables are kept so expansions are
+        memoized until the next index.
+    '''
+    global _file_alias_tables
+    index = _index_cache.get(_current_project['_fn']) if _current_project is not None else None
+    if index is None or index.aliases is None:
+        return core.expand_vars(s)
+
+    if _file_alias_tables[0] is not index.aliases:
+        _file_alias_tables = (index.aliases, {})
+    tables = _file_alias_tables[1]
+    table = tables.get(ntr_fn)
+    if table is None:
+        findex = index.files.get(ntr_fn)
+        table = index.aliases.with_overrides(findex.aliases if findex is not None else None)
+        tables[ntr_fn] = table
+    return table.expand(s)
 
-        # Create a second time after assigning the above regex and settings.
-        if use_panel:
-            output_view = window.create_output_panel("exec")
-            window.run_command('show_panel', {'panel': 'output.exec'})
-        else:
-            window.focus_view(output_view)
 
-        # Fill with info.
-        output_view.run_command('append', {'characters': "Notr file errors:\n"})
-        for p in _user_errors:
-            output_view.run_command('append', {'characters': f'{p[0]}({p[1]}): {p[2]}\n', 'force': True, 'scroll_to_end': True})
+#-----------------------------------------------------------------------------------
+def _get_index_db_fn():
+    ''' Index database for the current project lives with the store. '''
+    stem = pathlib.Path(_current_project['_fn']).stem
+    return os.path.join(os.path.dirname(sc.get_store_fn()), f'{stem}.sqlite')
 
 
 #-----------------------------------------------------------------------------------
-def _process_one_file(ntr_fn):
-    ''' Process one notr file. Regex and process sections and links.
-    This collects the text and checks raw syntax only. Validity will be checked when all files processed.
-    Returns (sections, links, refs)
-    '''
+def _get_link_cache_fn():
+    ''' Link check results for the current project live with the store. '''
+    stem = pathlib.Path(_current_project['_fn']).stem
+    return os.path.join(os.path.dirname(sc.get_store_fn()), f'{stem}.links.json')
 
-    sections = []
-    links = []
-    refs = []
-    no_index = False
-    line_num = -1
 
+#-----------------------------------------------------------------------------------
+def _export_db(index):
+    ''' Bring the index database up to date with a snapshot. '''
     try:
-        with open(ntr_fn, 'r', encoding='utf-8') as file:  # need to explicitly set encoding because default windows is ascii
-            lines = file.read().splitlines()
-            line_num = 1
-
-            # Regex to get the things of interest defined in the file. Roughly corresponds to Notr.sublime-syntax.
-            re_directives = re.compile(r'^:(.*)')
-            re_links = re.compile(r'<([^>)]*)>\(([^\)]*)\)*(?:\[(.*)\])?')
-            re_refs = re.compile(r'<\* *([^\>]*)>')
-            re_sections = re.compile(r'^(#+ +[^\[]+) *(?:\[(.*)\])?')
-
-            in_block_comment = False
-
-            for line in lines:
-                ### Ignore false triggers in comments.
-                if in_block_comment:
-                    if line.startswith("```"):
-                        in_block_comment = False
-                    line_num += 1
-                    continue # ignore
-                elif line.startswith("```"):
-                    in_block_comment = True
-                    line_num += 1
-                    continue # ignore
-
-                ### Handle directives now.
-                # :MY_PATH=some/where/my
-                # :NO_INDEX
-                # others as needed
-                matches = re_directives.findall(line)
-                for m in matches:
-                    handled = False
-                    parts = m.strip().split('=')
-                    if len(parts) == 1:
-                        directive = parts[0].strip()
-                        if directive == 'NO_INDEX':
-                            no_index = True
-                            handled = True
-                    elif len(parts) == 2:
-                        alias = parts[0].strip()
-                        value = parts[1].strip()
-                        os.environ[alias] = value
-                        handled = True  # so far
-
-                    if not handled:
-                        _do_user_error(ntr_fn, line_num, 'Invalid directive')
-
-                ### Links - also checks type.
-                # <yer news>(https://nytimes.com)
-                # <some felix>($NOTES_PATH/felix9.jpg)
-                matches = re_links.findall(line)
-                for m in matches:
-                    if len(m) >= 2:
-                        tags = []
-                        name = m[0].strip()
-                        res = sc.expand_vars(m[1].strip())
-
-                        if len(m) >= 3:
-                            tags = m[2].strip().split()
-
-                        if res is None:
-                            # Bad env var.
-                            _do_user_error(ntr_fn, line_num, f'Bad env var in: [{m[1]}]')
-                        else:
-                            ttype = '' # default/unknown
-                            _, ext = os.path.splitext(res)
-                            if ext in IMAGE_TYPES:
-                                ttype = 'image'
-                            elif res.startswith('http'):
-                                ttype = 'url'
-                            elif os.path.isfile(res):
-                                ttype = 'file'
-                            elif os.path.isdir(res):
-                                ttype = 'dir'
-                            links.append(Target(name, ttype, '', 0, tags, res, ntr_fn, line_num))
-                    else:
-                        _do_user_error(ntr_fn, line_num, 'Invalid syntax')
-
-                ### Refs - will be validated at end after collecting all links.
-                # <*some felix>
-                # <*yer news>
-                # <*ST executable dir>
-                # <* #section no tags]>
-                # <*page2#P2 section 2>
-                matches = re_refs.findall(line)
-                for m in matches:
-                    name = m.strip()
-                    # If it's local section insert the froot.
-                    if name.startswith('#'):
-                        froot = _get_froot(ntr_fn)
-                        name = froot + name
-                    refs.append(Ref(name, ntr_fn, line_num))
-
-                ### Sections
-                # # Some name [tag1 tag2]
-                matches = re_sections.findall(line)
-                for m in matches:
-                    hashes = ''
-                    name = ''
-                    tags = []
-
-                    if len(m) == 2:
-                        content = m[0].strip().split(None, 1)
-                        if len(content) == 2:
-                            hashes = content[0].strip()
-                            name = f'{_get_froot(ntr_fn)}{hashes}{content[1].strip()}'
-                            tags = m[1].strip().split()
-                            sections.append(Target(name, 'section', '', len(hashes), tags, '', ntr_fn, line_num))
-                    else:
-                        _do_user_error(ntr_fn, line_num, 'Invalid syntax')
-
-                line_num += 1
-
+        with _db_lock, contextlib.closing(db.open_db(_get_index_db_fn())) as conn:
+            db.update_db(conn, index)
     except Exception as e:
-        _do_user_error(ntr_fn, line_num, f'Error processing file: [{e}]')
-        sc.error(f'Error processing file: {ntr_fn}:{line_num} {e}', e.__traceback__)
-        return None
+        sc.error(f'Export to index database failed: {e}', e.__traceback__)
+
+
+#-----------------------------------------------------------------------------------
+def _subscribe(window):
+    ''' Window uses the current project index. '''
+    if window is not None and _current_project is not None:
+        _subscribers.add(window.id())
+
+
+#-----------------------------------------------------------------------------------
+def _unsubscribe(window):
+    ''' Window is done with the index. The last one out leaves only the current project index cached. '''
+    _subscribers.discard(window.id())
+    if len(_subscribers) == 0:
+        with _index_lock:
+            for fn in list(_index_cache.keys()):
+                if _current_project is None or fn != _current_project['_fn']:
+                    del _index_cache[fn]
+
+
+#-----------------------------------------------------------------------------------
+def _subscribed_windows():
+    ''' The windows sharing the current project index. '''
+    return [window for window in sublime.windows() if window.id() in _subscribers]
+
+
+#-----------------------------------------------------------------------------------
+def _notify_subscribers():
+    ''' There's a new index snapshot. Refresh the views in the windows that use it. '''
+    evt = NotrEvent()  # listener methods don't keep state
+    for window in _subscribed_windows():
+        for view in window.views():
+            _set_status(view)
+            evt._init_fixed_hl(view)
+
+
+#-----------------------------------------------------------------------------------
+def _trim_index_cache(keep_fn):
+    ''' Evict least recently used project indexes until under the memory budget. Never evicts keep_fn. '''
+    settings = sublime.load_settings(sc.get_settings_fn())
+    budget = float(str(settings.get('index_cache_mb', 100))) * 1000000
+
+    total = sum([index.size for index in _index_cache.values()])
+    for fn in list(_index_cache.keys()):
+        if total <= budget:
+            break
+        if fn != keep_fn:
+            total -= _index_cache.pop(fn).size
+
+
+#-----------------------------------------------------------------------------------
+def _estimate_index_size(index):
+    ''' Rough memory footprint of a ProjectIndex. Shared strings are counted more than once so it's on the high side. '''
+    def _obj_size(obj):
+        return sys.getsizeof(obj.__dict__) + sum([sys.getsizeof(v) for v in obj.__dict__.values()])
+
+    size = 0
+    for findex in index.files.values():
+        size += _obj_size(findex)
+        for coll in (findex.sections, findex.links, findex.refs):
+            size += sum([_obj_size(x) for x in coll])
+    for coll in (index.targets, index.refs, index.user_errors):
+        size += sys.getsizeof(coll)
+    size += sum([sys.getsizeof(e) + sys.getsizeof(e[2]) for e in index.user_errors])
+    return size
+
+
+#-----------------------------------------------------------------------------------
+def _show_user_errors(window, errors=None, title='Notr file errors'):
+    ''' Report the user errors, or other ones in the same format, with a summary, all in one go.
+        Reuses the output panel or view.
+    '''
+    settings = sublime.load_settings(sc.get_settings_fn())
+    use_panel = settings.get("show_panel", False)
+    max_errors = int(str(settings.get('max_errors_shown', 1000)))
+    if errors is None:
+        errors = _user_errors
+
+    # Summarize by kind, most first.
+    counts = {}
+    for p in errors:
+        kind = _get_error_kind(p[2])
+        counts[kind] = counts[kind] + 1 if kind in counts else 1
+
+    text = [f'{title}: {len(errors)}']
+    for kind, count in sorted(counts.items(), key=lambda x: x[1], reverse=True):
+        text.append(f'    {kind}: {count}')
+    text.append('')
+    text.extend([core.format_error(p) for p in errors[:max_errors]])
+    if len(errors) > max_errors:
+        text.append(f'... {len(errors) - max_errors} more not shown')
+    text.append('')
+
+    # Get output panel or view.
+    if use_panel:
+        output_view = window.find_output_panel('notr')
+        if output_view is None:
+            # Don't call get_output_panel until the regexes are assigned.
+            output_view = window.create_output_panel('notr')
+            _set_result_navigation(output_view)
+            # Create a second time after assigning the regex and settings.
+            output_view = window.create_output_panel('notr')
+        else:
+            # Clean the old one.
+            output_view.run_command('select_all')
+            output_view.run_command('right_delete')
+        window.run_command('show_panel', {'panel': 'output.notr'})
+    else:
+        # This reuses the temp view if it's still open.
+        output_view = sc.create_new_view(window, '')
+        _set_result_navigation(output_view)
+
+    # Fill with info.
+    sc.append_text(output_view, '\n'.join(text))
+
+
+#-----------------------------------------------------------------------------------
+def _dump_lines(targets, refs, user_errors, verbose, file, ttype, tag):
+    ''' Generate the dump a line at a time so it never has to be all in memory. '''
+
+    def _file_ok(fn):
+        return file is None or file.lower() in fn.lower()
+
+    def _target_ok(t):
+        return _file_ok(t.file) and (ttype is None or t.ttype == ttype) and (tag is None or tag in t.tags)
+
+    errors = [e for e in user_errors if _file_ok(e[0])]
+    if len(errors) > 0:
+        yield '\n========== !! errors below !! =========='
+
+    if verbose:
+        yield '\n========== targets =========='
+        yield from (str(t) for t in targets if _target_ok(t))
+        yield '\n========== refs =========='
+        yield from (str(r) for r in refs if _file_ok(r.file))
+        yield '\n========== tags =========='
+        yield from (t for t in _get_all_tags(targets) if tag is None or t == tag)
 
-    return None if no_index else (sections, links, refs)
+    yield '\n========== ntr_files =========='
+    yield from (fn for fn in _get_all_ntr_files(targets) if _file_ok(fn))
+
+    if len(errors) > 0:
+        yield '\n========== errors =========='
+        yield from (core.format_error(e) for e in errors)
+
+
+#-----------------------------------------------------------------------------------
+def _stream_to_view(view, lines, chunk_lines=10000):
+    ''' Append lines to the view a chunk at a time, letting the UI run in between. '''
+    if not view.is_valid():
+        return  # user closed it
+
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_lines:
+            break
+
+    if len(chunk) > 0:
+        sc.append_text(view, '\n'.join(chunk) + '\n')
+        if len(chunk) >= chunk_lines:
+            sublime.set_timeout(lambda: _stream_to_view(view, lines, chunk_lines), 0)
+
+
+#-----------------------------------------------------------------------------------
+def _set_result_navigation(view):
+    ''' Enable result navigation for file(line): msg format. '''
+    settings = view.settings()
+    settings.set('result_file_regex', r'^([^\(]+)\(([0-9]+)\)(): (.*)$')
+    settings.set('result_base_dir', '')
+
+
+#-----------------------------------------------------------------------------------
+def _get_error_kind(msg):
+    ''' Generic part of a user error message for summarizing. '''
+    return msg.split(':', 1)[0].split('[', 1)[0].strip()
 
 
 #-----------------------------------------------------------------------------------
@@ -919,13 +1237,65 @@ def _build_selector(targets):
 
 
 #-----------------------------------------------------------------------------------
-def _get_all_tags():
-    ''' Return all tags found in all ntr files. Honors sort_tags_alpha setting. '''
+def _get_fixed_hl_lazy(view):
+    ''' True if the view should use lazy highlighting. Honors fixed_hl_mode setting. '''
+    settings = sublime.load_settings(sc.get_settings_fn())
+    mode = settings.get('fixed_hl_mode', 'auto')
+    if mode == 'auto':
+        threshold = int(str(settings.get('fixed_hl_lazy_threshold', 1000000)))
+        return view.size() > threshold
+    return mode == 'lazy'
+
+
+#-----------------------------------------------------------------------------------
+def _add_fixed_hl(view, segments, extend):
+    ''' Find fixed_hl tokens in the segments and add them to the view regions.
+        If extend is True the new regions are added to the existing ones, otherwise they replace them.
+    '''
+    settings = sublime.load_settings(sc.get_settings_fn())
+    whole_word = settings.get('fixed_hl_whole_word')
+    fixed_hl = _current_project['fixed_hl']
+    whole_view = len(segments) == 1 and segments[0].begin() == 0 and segments[0].end() == view.size()
+
+    hl_info = sc.get_highlight_info('fixed')
+    for hl_index in range(len(fixed_hl)):
+        hl = hl_info[hl_index]
+
+        # Clean first or keep what's there.
+        hl_regions = view.get_regions(hl.region_name) if extend else []
+
+        # Colorize one token.
+        for token in fixed_hl[hl_index]:
+            escaped = re.escape(token)
+            if whole_word:  # and escaped[0].isalnum():
+                escaped = r'\b%s\b' % escaped
+
+            if whole_view:
+                # Let ST do the whole thing.
+                regs = view.find_all(escaped) if whole_word else view.find_all(token, sublime.LITERAL)
+                hl_regions.extend(regs)
+            else:
+                # Just the segments.
+                pattern = re.compile(escaped)
+                for seg in segments:
+                    offset = seg.begin()
+                    for m in pattern.finditer(view.substr(seg)):
+                        hl_regions.append(sublime.Region(offset + m.start(), offset + m.end()))
+
+        view.erase_regions(hl.region_name)
+        if len(hl_regions) > 0:
+            view.add_regions(key=hl.region_name, regions=hl_regions, scope=hl.scope_name,
+                             flags=sublime.RegionFlags.DRAW_STIPPLED_UNDERLINE)
+
+
+#-----------------------------------------------------------------------------------
+def _get_all_tags(targets=None):
+    ''' Return all tags found in all ntr files, or in targets. Honors sort_tags_alpha setting. '''
     settings = sublime.load_settings(sc.get_settings_fn())
     sort_tags_alpha = settings.get('sort_tags_alpha')
     tags = {}  # k:tag text v:count
 
-    for target in _targets:
+    for target in _targets if targets is None else targets:
         for tag in target.tags:
             tags[tag] = tags[tag] + 1 if tag in tags else 1
 
@@ -945,13 +1315,9 @@ def _set_status(view):
 
 
 #-----------------------------------------------------------------------------------
-def _get_all_ntr_files():
-    ''' Return a sorted list of all processed .ntr file names. '''
-    fns = []
-    for target in _targets:
-        if target.file not in fns:
-            fns.append(target.file)
-    return sorted(fns)
+def _get_all_ntr_files(targets=None):
+    ''' Return a sorted list of all processed .ntr file names, or the ones in targets. '''
+    return sorted(set([target.file for target in (_targets if targets is None else targets)]))
 
 
 #-----------------------------------------------------------------------------------
@@ -987,6 +1353,13 @@ def _filter_order_targets(**kwargs):
         os.path.exists(kwargs["current_file"])):
         current_file = kwargs["current_file"]
 
+    # Mru is the best by frecency.
+    frecency = _get_frecency()
+    settings = sublime.load_settings(sc.get_settings_fn())
+    mru_size = int(str(settings.get('mru_size', 5)))
+    mru_names = frecency.ranked(mru_size) if mru_first else []
+    mru_set = set(mru_names)
+
     # Cache some targets to maintain order.
     sticky_cache = {}
     mru_cache = {}
@@ -1010,7 +1383,7 @@ def _filter_order_targets(**kwargs):
             if not tag_ok:
                 continue
 
-            if mru_first and target.name in _current_mru:
+            if target.name in mru_set:
                 target.category = 'mru'
                 mru_cache[target.name] = target
             elif current_file is not None:
@@ -1026,15 +1399,23 @@ def _filter_order_targets(**kwargs):
         current_file_targets = sorted(current_file_targets)
         other_targets = sorted(other_targets)
 
+    # Then the visited ones by frecency. Stable so the others keep their order.
+    if mru_first and mru_size > 0:
+        def _rank(target):
+            score = frecency.score(target.name)
+            return -score if score is not None else float('inf')
+        current_file_targets.sort(key=_rank)
+        other_targets.sort(key=_rank)
+
     # Collect and return.
     ret = []
     # Order these.
     for st in sticky:  # by position in settings
         if st in sticky_cache:
             ret.append(sticky_cache[st])
-    for mru in _current_mru:  # by recent first
-        if mru in mru_cache:
-            ret.append(mru_cache[mru])
+    for mru_name in mru_names:  # best first
+        if mru_name in mru_cache:
+            ret.append(mru_cache[mru_name])
 
     ret.extend(current_file_targets)
     ret.extend(other_targets)
@@ -1045,53 +1426,140 @@ def _filter_order_targets(**kwargs):
 #-----------------------------------------------------------------------------------
 def _get_selection_for_scope(view, scope):
     ''' If the current region includes the scope return it otherwise None. '''
-    sel_text = None
     caret = sc.get_single_caret(view)
-    if caret is not None:
-        scopes = view.scope_name(caret).rstrip().split()
-        if scope in scopes:
-            reg = view.expand_to_scope(caret, scope)
-            if reg is not None:
-                sel_text = view.substr(reg).strip()
+    return _get_text_for_scope(view, caret, scope) if caret is not None else None
+
+
+#-----------------------------------------------------------------------------------
+def _get_text_for_scope(view, point, scope):
+    ''' If the scope is at point return its text otherwise None. '''
+    sel_text = None
+    scopes = view.scope_name(point).rstrip().split()
+    if scope in scopes:
+        reg = view.expand_to_scope(point, scope)
+        if reg is not None:
+            sel_text = view.substr(reg).strip()
 
     return sel_text
 
 
 #-----------------------------------------------------------------------------------
-def _update_mru(name):
-    ''' Update the mru list. Removes duplicate and invalid names. '''
-    global _current_mru
-    settings = sublime.load_settings(sc.get_settings_fn())
-    mru_size = int(str(settings.get("mru_size")))
+def _get_target(name):
+    ''' Target by name or None. First one wins like validation. '''
+    global _target_names
+    if _target_names[0] is not _targets:
+        names = {}
+        for target in _targets:
+            names.setdefault(target.name, target)
+        _target_names = (_targets, names)
+    return _target_names[1].get(name)
 
-    # Clean up the mru.
-    tmp = _current_mru.copy()
-    _current_mru.clear()
-    _current_mru.append(name)  # new first
 
-    valid_refs = set()
-    for target in _targets:
-        if target.category != 'sticky':
-            valid_refs.add(target.name)
-    for tname in tmp:
-        if tname in valid_refs and tname not in _current_mru and len(_current_mru) < mru_size:
-            _current_mru.append(tname)
+#-----------------------------------------------------------------------------------
+def _show_section_popup(view, point, target):
+    ''' First lines of the section in a popup. Only that part of the file is read, and it's cached until the file changes. '''
+    try:
+        mtime = os.path.getmtime(target.file)
+    except OSError:
+        return
+
+    key = (target.file, target.name)
+    cached = _preview_cache.get(key)
+    if cached is not None and cached[0] == mtime:
+        content = cached[1]
+        _preview_cache.move_to_end(key)
+    else:
+        settings = sublime.load_settings(sc.get_settings_fn())
+        lines = core.read_section(target.file, target.offset, int(str(settings.get('preview_lines', 10))), target.name)
+        if lines is None:
+            return  # gone since indexed
+        body = '<br>'.join([html.escape(line).replace(' ', '&nbsp;') for line in lines[1:]])
+        content = f'<body id="notr-preview"><b>{html.escape(lines[0])}</b><br>{body}</body>'
+        _preview_cache[key] = (mtime, content)
+        if len(_preview_cache) > _PREVIEW_CACHE_SIZE:
+            _preview_cache.popitem(last=False)
+
+    view.show_popup(content, flags=sublime.HIDE_ON_MOUSE_MOVE_AWAY, location=point, max_width=800, max_height=400)
+
+
+#-----------------------------------------------------------------------------------
+def _show_image_popup(view, point, res):
+    ''' Thumbnail in a popup. Making one could take a while so it's done in the background. '''
+    global _thumb_cache
+    if _thumb_cache is None:
+        settings = sublime.load_settings(sc.get_settings_fn())
+        cache_dir = os.path.join(os.path.dirname(sc.get_store_fn()), 'thumbs')
+        max_bytes = int(str(settings.get('thumb_cache_mb', 50))) * 1024 * 1024
+        _thumb_cache = thumbs.ThumbCache(cache_dir, max_bytes, int(str(settings.get('thumb_size', 200))))
+    cache = _thumb_cache
+
+    def _show():
+        thumb = cache.get(res)
+        if thumb is not None:
+            fn, width, height = thumb
+            content = f'<img src="file://{html.escape(fn)}" width="{width}" height="{height}">'
+            sublime.set_timeout(lambda: view.show_popup(content, flags=sublime.HIDE_ON_MOUSE_MOVE_AWAY, location=point,
+                                                        max_width=width + 20, max_height=height + 20))
+
+    sublime.set_timeout_async(_show)
+
+
+#-----------------------------------------------------------------------------------
+def _update_mru(name):
+    ''' Count a visit to the named target. '''
+    if _current_project is None or name in _current_project['sticky'] or _get_target(name) is None:
+        return
+    _get_frecency().visit(name)
 
     # Persist.
     _write_store()
 
 
 #-----------------------------------------------------------------------------------
-def _do_user_error(path, line, msg):
-    ''' Error in user file. '''
-    if '(' in msg or ')' in msg:
-        msg = msg + '   <<< Targets with parens not supported'
-    _user_errors.append((path, line, msg))
+def _get_pinned_targets():
+    ''' Sticky then mru Targets, for the top of the selector. '''
+    if _current_project is None:
+        return []
+    settings = sublime.load_settings(sc.get_settings_fn())
+    mru_size = int(str(settings.get('mru_size', 5)))
+
+    ret = []
+    sticky = _current_project['sticky']
+    for name in sticky:
+        target = _get_target(name)
+        if target is not None:
+            target.category = 'sticky'
+            ret.append(target)
+    for name in _get_frecency().ranked(mru_size):
+        target = _get_target(name)
+        if target is not None and name not in sticky:
+            target.category = 'mru'
+            ret.append(target)
+    return ret
 
 
 #-----------------------------------------------------------------------------------
-def _get_froot(fn):
-    return os.path.basename(os.path.splitext(fn)[0])
+def _get_target_tree():
+    ''' The drill-down tree for the current targets. Made once per index. '''
+    global _target_tree
+    if _target_tree[0] is not _targets:
+        index = _index_cache.get(_current_project['_fn']) if _current_project is not None else None
+        section_sel_depth = _current_project.get('section_sel_depth', 0) if _current_project is not None else 0
+        tree = core.build_target_tree(index, section_sel_depth) if index is not None else []
+        _target_tree = (_targets, tree)
+    return _target_tree[1]
+
+
+#-----------------------------------------------------------------------------------
+def _get_frecency():
+    ''' The frecency, with names that aren't targets any more dropped. That's done here the first time it's used after
+        the index changes, not every time the index changes.
+    '''
+    global _frecency_targets
+    if _frecency_targets is not _targets:
+        _frecency.prune(set([name for name in _frecency.ranked() if _get_target(name) is not None]))
+        _frecency_targets = _targets
+    return _frecency
 
 
 #-----------------------------------------------------------------------------------
@@ -0,0 +1,117 @@
+'''
+Ref name completion. Target names are kept in a prefix trie that is updated per file as the index changes,
+and completions are ranked mru first, then names in the same file, then the rest. No dependency on sublime.
+'''
+
+
+#-----------------------------------------------------------------------------------
+class NameTrie:
+    ''' Case insensitive prefix trie of names. The same name can be added more than once, e.g. from two files. '''
+
+    def __init__(self):
+        # Nodes are dicts of k:char v:node. Key '' holds the names ending there as dict of k:name v:count.
+        self._root = {}
+        self.size = 0
+
+    def add(self, name):
+        node = self._root
+        for c in name.lower():
+            node = node.setdefault(c, {})
+        names = node.setdefault('', {})
+        names[name] = names.get(name, 0) + 1
+        self.size += 1
+
+    def remove(self, name):
+        ''' Remove one of name. Empty branches are pruned. '''
+        path = [self._root]
+        for c in name.lower():
+            node = path[-1].get(c)
+            if node is None:
+                return
+            path.append(node)
+
+        names = path[-1].get('')
+        if names is None or name not in names:
+            return
+        names[name] -= 1
+        if names[name] == 0:
+            del names[name]
+            if len(names) == 0:
+                del path[-1]['']
+        self.size -= 1
+
+        # Prune.
+        key = name.lower()
+        for i in range(len(key), 0, -1):
+            if len(path[i]) > 0:
+                break
+            del path[i - 1][key[i - 1]]
+
+    def find(self, prefix, limit):
+        ''' Up to limit names starting with prefix. Depth first with branches in the order they were added, so a name
+            comes before the longer names under it but not before names in earlier branches. Breadth first would have
+            to visit most of the trie before the first names for a short prefix.
+        '''
+        node = self._root
+        for c in prefix.lower():
+            node = node.get(c)
+            if node is None:
+                return []
+
+        res = []
+        stack = [node]
+        while len(stack) > 0 and len(res) < limit:
+            node = stack.pop()
+            names = node.get('')
+            if names is not None:
+                res.extend(names.keys())
+            # Reversed so they pop in order.
+            stack.extend([node[c] for c in reversed(node.keys()) if c != ''])
+        return res[:limit]
+
+
+#-----------------------------------------------------------------------------------
+def update_trie(trie, files, old_files):
+    ''' Bring trie from the notr_core.FileIndexes in old_files to the ones in files. Both are dicts of k:fn v:FileIndex.
+        FileIndexes are replaced when their file changes so only those are touched.
+    '''
+    for fn, findex in old_files.items():
+        if files.get(fn) is not findex:
+            for name in _get_names(findex):
+                trie.remove(name)
+
+    for fn, findex in files.items():
+        if old_files.get(fn) is not findex:
+            for name in _get_names(findex):
+                trie.add(name)
+
+
+#-----------------------------------------------------------------------------------
+def complete(trie, typed, mru, local_names, limit=50):
+    ''' Names starting with typed. Ranked mru, then local_names (e.g. in the same file), then the rest from trie.
+        Returns list of (name, rank) where rank is 'mru', 'local' or ''.
+    '''
+    key = typed.lower()
+    res = []
+    seen = set()
+
+    def _add(names, rank):
+        for name in names:
+            if len(res) >= limit:
+                return
+            if name not in seen and name.lower().startswith(key):
+                res.append((name, rank))
+                seen.add(name)
+
+    _add(mru, 'mru')
+    _add(local_names, 'local')
+    # Ask for enough to make up for the ones already seen.
+    _add(trie.find(typed, limit + len(seen)), '')
+    return res
+
+
+#-----------------------------------------------------------------------------------
+def _get_names(findex):
+    if findex.no_index:
+        return []
+    return [t.name for t in findex.sections + findex.links]
@@ -0,0 +1,657 @@
+'''
+Notr parser and validator. This has no dependency on sublime so it can be used by the plugin and from the command line:
+
+    python notr_core.py my-project.nproj [-j workers] [--json]
+
+Errors are printed as `file(line): msg` or as json. Exit code is 0 if ok, 1 if user errors, 2 if the project file is bad.
+'''
+
+import sys
+import os
+import re
+import glob
+import json
+import argparse
+import dataclasses
+import concurrent.futures
+
+
+# Known file types.
+IMAGE_TYPES = ['.jpg', '.jpeg', '.png', '.bmp', '.gif']
+
+# Regex to get the things of interest defined in the file. Roughly corresponds to Notr.sublime-syntax.
+RE_DIRECTIVES = re.compile(r'^:(.*)')
+RE_LINKS = re.compile(r'<([^>)]*)>\(([^\)]*)\)*(?:\[(.*)\])?')
+RE_REFS = re.compile(r'<\* *([^\>]*)>')
+RE_SECTIONS = re.compile(r'^(#+ +[^\[]+) *(?:\[(.*)\])?')
+
+# Alias references: $NAME or ${NAME}, and %NAME% on windows like os.path.expandvars(). A bare $ is invalid.
+_RE_VARS = re.compile(r'\$(?:(?P<name>\w+)|\{(?P<braced>[^}]*)\})?' + (r'|%(?P<win>\w+)%' if os.name == 'nt' else ''))
+
+# Quick find of the section lines.
+_RE_HEADINGS = re.compile(rb'^#', re.M)
+
+# Quick find of the directive lines.
+_RE_ALIASES = re.compile(r'^:(.*=.*)$', re.M)
+
+# Don't bother with a process pool for fewer files than this.
+_PARALLEL_MIN_FILES = 100
+
+
+#--------------------------- Types -------------------------------------------------
+
+# One target: section or file/url.
+@dataclasses.dataclass(order=True)
+class Target:
+    sort_index: str = dataclasses.field(init=False)
+    name: str      # section title or description
+    ttype: str     # 'section', 'url', 'image', 'file', 'dir'
+    category: str  # 'sticky', 'mru', 'none'
+    level: int     # for section only
+    tags: list     # tags for targets
+    resource: str  # what ttype points to
+    file: str      # .ntr file path
+    line: int      # .ntr file line
+    offset: int = -1  # section only - byte offset of the line in the file
+
+    def __post_init__(self):
+        self.sort_index = self.name
+
+# A reference to a Target.
+@dataclasses.dataclass(order=True)
+class Ref:
+    sort_index: str = dataclasses.field(init=False)
+    name: str  # "target#name"
+    file: str  # .ntr file path
+    line: int  # .ntr file line
+
+    def __post_init__(self):
+        self.sort_index = self.name
+
+# Parse results for one ntr file. Reused until the file mtime changes.
+@dataclasses.dataclass
+class FileIndex:
+    fn: str         # .ntr file path
+    mtime: float    # when parsed
+    no_index: bool  # file has NO_INDEX directive
+    sections: list  # section Targets
+    links: list     # link Targets
+    refs: list      # Refs
+    errors: list    # parse errors as tuples of (path, line, msg)
+    aliases: dict = dataclasses.field(default_factory=dict)  # alias directives in this file
+    uses_aliases: bool = False  # has links with vars so depends on the project aliases
+
+# Everything found in one project.
+@dataclasses.dataclass
+class ProjectIndex:
+    files: dict           # k:ntr file path v:FileIndex
+    project_errors: list  # bad paths in the project file
+    targets: list         # all Targets
+    refs: list            # all Refs
+    user_errors: list     # all errors as tuples of (path, line, msg)
+    aliases: 'AliasTable' = None  # project wide aliases
+    size: int = 0         # estimated bytes, for clients that cache
+
+# One entry in the drill-down target selector. Files at the top, then their sections.
+@dataclasses.dataclass
+class TargetNode:
+    name: str                 # file or section name
+    file: str                 # .ntr file path
+    target: 'Target' = None   # None for a file
+    children: list = dataclasses.field(default_factory=list)  # TargetNodes
+
+
+#-----------------------------------------------------------------------------------
+class AliasTable:
+    ''' Alias name to value, from the notr file directives, on top of the environment. Never changed after it's made
+        so expansions are memoized and it can be shared between threads and processes. Per-file aliases go in a
+        child table from with_overrides().
+    '''
+
+    def __init__(self, aliases=None, parent=None):
+        self._aliases = dict(aliases) if aliases else {}
+        self._parent = parent
+        self._memo = {}    # k:string v:expanded or None
+        self._values = {}  # k:name v:expanded value or None
+
+    def with_overrides(self, aliases):
+        ''' Table with aliases on top of this one. '''
+        return AliasTable(aliases, self) if aliases else self
+
+    def as_dict(self):
+        ''' All the aliases, not the environment. '''
+        res = self._parent.as_dict() if self._parent is not None else {}
+        res.update(self._aliases)
+        return res
+
+    def lookup(self, name):
+        ''' Raw value of name or None if not known. '''
+        if name in self._aliases:
+            return self._aliases[name]
+        if self._parent is not None:
+            return self._parent.lookup(name)
+        return os.environ.get(name)
+
+    def expand(self, s):
+        ''' Replace the vars in s, and the vars in their values, in one pass. Returns None if a var is unknown or circular. '''
+        if s is None or ('$' not in s and '%' not in s):
+            return s
+        res = self._memo.get(s, self)
+        if res is self:
+            res = self._expand(s, ())
+            self._memo[s] = res
+        return res
+
+    def _expand(self, s, stack):
+        out = []
+        pos = 0
+        for m in _RE_VARS.finditer(s):
+            name = m.group('name') or m.group('braced') or m.groupdict().get('win')
+            value = self._get_value(name, stack) if name else None
+            if value is None:
+                if m.groupdict().get('win'):
+                    continue  # windows leaves unknown %NAME% alone
+                return None
+            out.append(s[pos:m.start()])
+            out.append(value)
+            pos = m.end()
+        out.append(s[pos:])
+        return ''.join(out)
+
+    def _get_value(self, name, stack):
+        if name not in self._aliases and self._parent is not None:
+            # Parent values don't see the overrides so they can be shared by all the children.
+            return self._parent._get_value(name, ())
+        if name in self._values:
+            return self._values[name]
+        if name in stack:
+            return None  # circular
+        raw = self._aliases[name] if name in self._aliases else os.environ.get(name)
+        value = None if raw is None else self._expand(raw, stack + (name,))
+        self._values[name] = value
+        return value
+
+
+#-----------------------------------------------------------------------------------
+#---------------------------- Public functions -------------------------------------
+#-----------------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------------
+def load_project(project_fn):
+    ''' Read and check a notr project file. Returns the project dict. Raises ValueError if it's broken. '''
+    expfn = expand_vars(project_fn)
+    if expfn is None:
+        raise ValueError(f'Invalid project file: {project_fn}')
+
+    with open(expfn, 'r') as fp:
+        proj = json.loads(fp.read()) # TODO use jsonc so .nproj files can use comments.
+
+    # Check file integrity.
+    if "notr_paths" not in proj or "notr_index" not in proj:
+        # Broken file.
+        raise ValueError(f'Invalid notr project file: {expfn}')
+
+    # Non-fatal patchups.
+    if "fixed_hl" not in proj:
+        proj["fixed_hl"] = []
+    if 'sticky' not in proj:
+        proj['sticky'] = []
+
+    proj['_fn'] = expfn  # for downstream access
+    return proj
+
+
+#-----------------------------------------------------------------------------------
+def get_project_files(project, errors):
+    ''' All the ntr files in the project, index first. Bad paths are appended to errors. '''
+    ntr_files = []
+    project_fn = project['_fn']
+
+    # Index first.
+    index_path = None
+    notr_index = project['notr_index']
+    if notr_index is not None:
+        index_path = expand_vars(notr_index)
+        if index_path is not None and os.path.exists(index_path):
+            ntr_files.append(index_path)
+        else:
+            _do_user_error(errors, project_fn, -1, f'Invalid path in project: [{index_path}]')
+
+    # Project directory paths.
+    for npath in project['notr_paths']:
+        expath = expand_vars(npath)
+        if expath is not None and os.path.exists(expath):
+            for nfile in glob.glob(os.path.join(expath, '*.ntr')):
+                if index_path is None or not os.path.samefile(nfile, index_path):  # don't do index twice
+                    ntr_files.append(nfile)
+        else:
+            _do_user_error(errors, project_fn, -1, f'Invalid path in project: [{npath}]')
+
+    return ntr_files
+
+
+#-----------------------------------------------------------------------------------
+def build_index(project, old_index=None, workers=1):
+    ''' Make the project index. Files not changed since old_index are not parsed again.
+        If there's a lot to do and workers > 1, files are parsed in a process pool.
+        Returns ProjectIndex, which is old_index itself if nothing changed.
+    '''
+    project_errors = []
+    ntr_files = get_project_files(project, project_errors)
+
+    # See what needs parsing. Collect the project aliases too, later files win.
+    files = {}
+    todo = []
+    all_aliases = {}
+    for nfile in ntr_files:
+        mtime = os.path.getmtime(nfile)
+        findex = old_index.files.get(nfile) if old_index is not None else None
+        if findex is not None and findex.mtime == mtime:
+            files[nfile] = findex
+            all_aliases.update(findex.aliases)
+        else:
+            files[nfile] = None  # placeholder to keep the order
+            todo.append((nfile, mtime))
+            all_aliases.update(read_aliases(nfile))
+
+    # If the aliases changed, files that use them need doing again.
+    old_aliases = old_index.aliases.as_dict() if old_index is not None and old_index.aliases is not None else {}
+    if all_aliases != old_aliases:
+        for nfile, findex in files.items():
+            if findex is not None and findex.uses_aliases:
+                files[nfile] = None
+                todo.append((nfile, findex.mtime))
+
+    if (old_index is not None and len(todo) == 0 and len(files) == len(old_index.files) and
+            project_errors == old_index.project_errors):
+        # Nothing to do.
+        return old_index
+
+    aliases = AliasTable(all_aliases)
+    for findex in _process_files(todo, aliases, workers):
+        files[findex.fn] = findex
+
+    # Targets are ordered by sections then files/links.
+    errors = project_errors.copy()
+    targets = []
+    refs = []
+    for findex in files.values():
+        errors.extend(findex.errors)
+        if not findex.no_index:
+            targets.extend(findex.sections)
+            refs.extend(findex.refs)
+    for findex in files.values():
+        if not findex.no_index:
+            targets.extend(findex.links)
+
+    validate(targets, refs, errors)
+
+    return ProjectIndex(files, project_errors, targets, refs, errors, aliases)
+
+
+#-----------------------------------------------------------------------------------
+def build_target_tree(index, max_level=0):
+    ''' Tree of the targets in a ProjectIndex for drilling down. Files have their sections nested by level, and links
+        are in the section they're in. Sections deeper than max_level are left out if it's > 0.
+        Returns list of TargetNode for the files, by name.
+    '''
+    tree = []
+    for findex in index.files.values():
+        if findex.no_index or len(findex.sections) + len(findex.links) == 0:
+            continue
+        fnode = TargetNode(os.path.basename(findex.fn), findex.fn)
+        stack = [(0, fnode)]  # (level, node) down to the current section
+
+        for target in sorted(findex.sections + findex.links, key=lambda t: t.line):
+            if target.ttype == 'section':
+                if max_level > 0 and target.level > max_level:
+                    continue
+                while stack[-1][0] >= target.level:
+                    stack.pop()
+                node = TargetNode(target.name, findex.fn, target)
+                stack[-1][1].children.append(node)
+                stack.append((target.level, node))
+            else:
+                stack[-1][1].children.append(TargetNode(target.name, findex.fn, target))
+
+        tree.append(fnode)
+
+    return sorted(tree, key=lambda node: (node.name.lower(), node.file))
+
+
+#-----------------------------------------------------------------------------------
+def validate(targets, refs, errors):
+    ''' Check all user targets and refs are valid. Problems are appended to errors. '''
+    valid_refs = set()
+    for target in targets:
+        if target.name in valid_refs:
+            _do_user_error(errors, target.file, target.line, f'Duplicate target name: [{target.name}]')
+        elif len(target.name) == 0:
+            _do_user_error(errors, target.file, target.line, f'Missing target name: [{target.name}]')
+        elif target.ttype == '':
+            _do_user_error(errors, target.file, target.line, f'Invalid target resource: [{target.resource}]')
+        else:
+            valid_refs.add(target.name)
+
+    for ref in refs:
+        if ref.name not in valid_refs:
+            _do_user_error(errors, ref.file, ref.line, f'Invalid ref name: [{ref.name}]')
+
+
+#-----------------------------------------------------------------------------------
+def process_file(ntr_fn, mtime, aliases=None):
+    ''' Process one notr file. Regex and process sections and links.
+    This collects the text and checks raw syntax only. Validity will be checked when all files processed.
+    Links are expanded with the project AliasTable plus the aliases in this file.
+    Returns FileIndex
+    '''
+
+    sections = []
+    links = []
+    refs = []
+    errors = []
+    no_index = False
+    file_aliases = {}
+    uses_aliases = False
+    line_num = -1
+
+    try:
+        with open(ntr_fn, 'rb') as file:
+            data = file.read()
+            text = data.decode('utf-8')  # need to explicitly set encoding because default windows is ascii
+            lines = text.splitlines()
+            offsets = _get_heading_offsets(data)
+            line_num = 1
+            froot = get_froot(ntr_fn)
+            in_block_comment = False
+            file_aliases = _scan_aliases(text)
+            table = (aliases if aliases is not None else AliasTable()).with_overrides(file_aliases)
+
+            for line in lines:
+                ### Ignore false triggers in comments.
+                if in_block_comment:
+                    if line.startswith("```"):
+                        in_block_comment = False
+                    line_num += 1
+                    continue # ignore
+                elif line.startswith("```"):
+                    in_block_comment = True
+                    line_num += 1
+                    continue # ignore
+
+                ### Handle directives now.
+                # :MY_PATH=some/where/my
+                # :NO_INDEX
+                # others as needed
+                matches = RE_DIRECTIVES.findall(line)
+                for m in matches:
+                    handled = False
+                    parts = m.strip().split('=')
+                    if len(parts) == 1:
+                        directive = parts[0].strip()
+                        if directive == 'NO_INDEX':
+                            no_index = True
+                            handled = True
+                    elif len(parts) == 2:
+                        # Aliases were collected up front.
+                        handled = True  # so far
+
+                    if not handled:
+                        _do_user_error(errors, ntr_fn, line_num, 'Invalid directive')
+
+                ### Links - also checks type.
+                # <yer news>(https://nytimes.com)
+                # <some felix>($NOTES_PATH/felix9.jpg)
+                matches = RE_LINKS.findall(line)
+                for m in matches:
+                    if len(m) >= 2:
+                        tags = []
+                        name = m[0].strip()
+                        res = table.expand(m[1].strip())
+                        uses_aliases = uses_aliases or _RE_VARS.search(m[1]) is not None
+
+                        if len(m) >= 3:
+                            tags = m[2].strip().split()
+
+                        if res is None:
+                            # Bad env var.
+                            _do_user_error(errors, ntr_fn, line_num, f'Bad env var in: [{m[1]}]')
+                        else:
+                            ttype = '' # default/unknown
+                            _, ext = os.path.splitext(res)
+                            if ext in IMAGE_TYPES:
+                                ttype = 'image'
+                            elif res.startswith('http'):
+                                ttype = 'url'
+                            elif os.path.isfile(res):
+                                ttype = 'file'
+                            elif os.path.isdir(res):
+                                ttype = 'dir'
+                            links.append(Target(name, ttype, '', 0, tags, res, ntr_fn, line_num))
+                    else:
+                        _do_user_error(errors, ntr_fn, line_num, 'Invalid syntax')
+
+                ### Refs - will be validated at end after collecting all links.
+                # <*some felix>
+                # <*yer news>
+                # <*ST executable dir>
+                # <* #section no tags]>
+                # <*page2#P2 section 2>
+                matches = RE_REFS.findall(line)
+                for m in matches:
+                    name = m.strip()
+                    # If it's local section insert the froot.
+                    if name.startswith('#'):
+                        name = froot + name
+                    refs.append(Ref(name, ntr_fn, line_num))
+
+                ### Sections
+                # # Some name [tag1 tag2]
+                matches = RE_SECTIONS.findall(line)
+                for m in matches:
+                    hashes = ''
+                    name = ''
+                    tags = []
+
+                    if len(m) == 2:
+                        content = m[0].strip().split(None, 1)
+                        if len(content) == 2:
+                            hashes = content[0].strip()
+                            name = f'{froot}{hashes}{content[1].strip()}'
+                            tags = m[1].strip().split()
+                            sections.append(Target(name, 'section', '', len(hashes), tags, '', ntr_fn, line_num,
+                                                   offsets.get(line_num, -1)))
+                    else:
+                        _do_user_error(errors, ntr_fn, line_num, 'Invalid syntax')
+
+                line_num += 1
+
+    except Exception as e:
+        _do_user_error(errors, ntr_fn, line_num, f'Error processing file: [{e}]')
+        return FileIndex(ntr_fn, mtime, True, [], [], [], errors)
+
+    return FileIndex(ntr_fn, mtime, no_index, sections, links, refs, errors, file_aliases, uses_aliases)
+
+
+#-----------------------------------------------------------------------------------
+def expand_vars(s, aliases=None):
+    ''' Expand vars from the AliasTable, or just the environment if None. Returns expanded string or None if bad var name. '''
+    return (aliases if aliases is not None else AliasTable()).expand(s)
+
+
+#-----------------------------------------------------------------------------------
+def read_aliases(ntr_fn):
+    ''' Quick pass over a file for just the alias directives. Returns dict of alias:value. '''
+    try:
+        with open(ntr_fn, 'r', encoding='utf-8') as file:
+            return _scan_aliases(file.read())
+    except Exception:
+        return {}  # process_file() will report it
+
+
+#-----------------------------------------------------------------------------------
+def read_section(ntr_fn, offset, max_lines, name=None):
+    ''' Read a section from its Target.offset: the heading line plus up to max_lines of body, stopping at the next
+        section. If name is given and the heading there isn't that section, e.g. the file was edited since it was
+        indexed, the file is searched for it. Returns list of lines or None if it's not there.
+    '''
+    froot = get_froot(ntr_fn)
+    try:
+        with open(ntr_fn, 'rb') as file:
+            file.seek(offset)
+            lines = _read_section_lines(file, max_lines)
+            if name is None or (lines is not None and _get_section_name(lines[0], froot) == name):
+                return lines
+
+            # Moved. Look for it like process_file() does.
+            file.seek(0)
+            pos = 0
+            found = None
+            in_block_comment = False
+            for bline in file:
+                if bline.startswith(b'```'):
+                    in_block_comment = not in_block_comment
+                elif not in_block_comment and bline.startswith(b'#'):
+                    if _get_section_name(bline.decode('utf-8', errors='replace').rstrip('\r\n'), froot) == name:
+                        found = pos
+                        break
+                pos += len(bline)
+            if found is None:
+                return None
+            file.seek(found)
+            return _read_section_lines(file, max_lines)
+    except OSError:
+        return None
+
+
+#-----------------------------------------------------------------------------------
+def get_froot(fn):
+    ''' File name root, used to qualify section names. '''
+    return os.path.basename(os.path.splitext(fn)[0])
+
+
+#-----------------------------------------------------------------------------------
+def format_error(err):
+    ''' Standard navigable format for an error tuple. '''
+    return f'{err[0]}({err[1]}): {err[2]}'
+
+
+#-----------------------------------------------------------------------------------
+#---------------------------- Private functions ------------------------------------
+#-----------------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------------
+def _process_files(todo, aliases, workers):
+    ''' Parse the (fn, mtime) list with the project AliasTable. Returns FileIndexes in the same order. '''
+    if workers <= 1 or len(todo) < _PARALLEL_MIN_FILES:
+        return [process_file(fn, mtime, aliases) for fn, mtime in todo]
+
+    fns = [t[0] for t in todo]
+    mtimes = [t[1] for t in todo]
+    chunksize = max(1, len(todo) // (workers * 4))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(process_file, fns, mtimes, [aliases] * len(todo), chunksize=chunksize))
+
+
+#-----------------------------------------------------------------------------------
+def _read_section_lines(file, max_lines):
+    ''' The heading line at the file position plus up to max_lines of body. None if it's not at a heading. '''
+    lines = []
+    for bline in file:
+        line = bline.decode('utf-8', errors='replace').rstrip('\r\n')
+        is_section = RE_SECTIONS.match(line) is not None
+        if len(lines) == 0 and not is_section:
+            return None
+        if (len(lines) > 0 and is_section) or len(lines) > max_lines:
+            break
+        lines.append(line)
+    return lines if len(lines) > 0 else None
+
+
+#-----------------------------------------------------------------------------------
+def _get_section_name(line, froot):
+    ''' Target name of a heading line like process_file() makes, or None if it's not one. '''
+    m = RE_SECTIONS.match(line)
+    if m is None:
+        return None
+    content = m.group(1).strip().split(None, 1)
+    return f'{froot}{content[0].strip()}{content[1].strip()}' if len(content) == 2 else None
+
+
+#-----------------------------------------------------------------------------------
+def _get_heading_offsets(data):
+    ''' Byte offsets of the lines starting with # in the file bytes. Returns dict of 1-based line number:offset. '''
+    offsets = {}
+    line_num = 1
+    pos = 0
+    for m in _RE_HEADINGS.finditer(data):
+        line_num += data.count(b'\n', pos, m.start())
+        pos = m.start()
+        offsets[line_num] = pos
+    return offsets
+
+
+#-----------------------------------------------------------------------------------
+def _scan_aliases(text):
+    ''' Alias directives in the file text, skipping raw blocks. Returns dict of alias:value. '''
+    aliases = {}
+    if '```' in text:
+        # Blank out the raw blocks first. Unterminated one runs to the end.
+        text = re.sub(r'^```.*?(?:^```[^\n]*|\Z)', '', text, flags=re.M | re.S)
+    for m in _RE_ALIASES.finditer(text):
+        parts = m.group(1).strip().split('=')
+        if len(parts) == 2:
+            aliases[parts[0].strip()] = parts[1].strip()
+    return aliases
+
+
+#-----------------------------------------------------------------------------------
+def _do_user_error(errors, path, line, msg):
+    ''' Error in user file. Appended to errors. '''
+    if '(' in msg or ')' in msg:
+        msg = msg + '   <<< Targets with parens not supported'
+    errors.append((path, line, msg))
+
+
+#-----------------------------------------------------------------------------------
+#---------------------------- Command line -----------------------------------------
+#-----------------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------------
+def main(argv=None):
+    ''' Index and validate a project. Returns the exit code. '''
+    parser = argparse.ArgumentParser(prog='notr_core', description='Index and validate a notr project.')
+    parser.add_argument('project', help='notr project file (.nproj)')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help='number of parser processes')
+    parser.add_argument('--json', action='store_true', help='output as json')
+    args = parser.parse_args(argv)
+
+    try:
+        project = load_project(args.project)
+    except Exception as e:
+        print(f'{args.project}: {e}', file=sys.stderr)
+        return 2
+
+    index = build_index(project, workers=args.workers)
+
+    if args.json:
+        out = {
+            'project': project['_fn'],
+            'files': len(index.files),
+            'targets': len(index.targets),
+            'refs': len(index.refs),
+            'errors': [{'file': e[0], 'line': e[1], 'msg': e[2]} for e in index.user_errors],
+        }
+        print(json.dumps(out, indent=4))
+    else:
+        for err in index.user_errors:
+            print(format_error(err))
+
+    return 1 if len(index.user_errors) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+'''
+Export of a notr project index to a SQLite database for bulk queries. Section bodies go in a FTS5 table
+if this sqlite has it. The export is incremental: only files whose mtime or targets changed are rewritten. Targets
+can change without the file when an alias in another file does.
+
+Tables:
+- files(path, mtime, sig) - sig is a hash of the file's target rows
+- targets(name, ttype, level, resource, file, line)
+- tags(tag, target, file)
+- refs(name, section, file, line) - section is the one the ref is in
+- errors(file, line, msg)
+- sections_fts(name, tags, body, file, line) - full text
+'''
+
+import bisect
+import hashlib
+
+try:
+    import sqlite3
+except ImportError:
+    # Not in all python builds.
+    sqlite3 = None
+
+
+_SCHEMA = '''
+create table if not exists files(path text primary key, mtime real, sig text);
+create table if not exists targets(name text, ttype text, level integer, resource text, file text, line integer);
+create table if not exists tags(tag text, target text, file text);
+create table if not exists refs(name text, section text, file text, line integer);
+create table if not exists errors(file text, line integer, msg text);
+create index if not exists targets_file on targets(file);
+create index if not exists targets_name on targets(name);
+create index if not exists tags_file on tags(file);
+create index if not exists tags_tag on tags(tag);
+create index if not exists refs_file on refs(file);
+create index if not exists refs_name on refs(name);
+'''
+
+_FTS_SCHEMA = '''
+create virtual table if not exists sections_fts using fts5(name, tags, body, file unindexed, line unindexed);
+'''
+
+# Plain table for sqlite without fts5. Use like instead of match.
+_NO_FTS_SCHEMA = '''
+create table if not exists sections_fts(name text, tags text, body text, file text, line integer);
+'''
+
+
+#-----------------------------------------------------------------------------------
+def available():
+    ''' True if sqlite is usable here. '''
+    return sqlite3 is not None
+
+
+#-----------------------------------------------------------------------------------
+def open_db(db_fn):
+    ''' Open or create the database. Returns the connection. '''
+    conn = sqlite3.connect(db_fn)
+    conn.executescript(_SCHEMA)
+    if 'sig' not in [row[1] for row in conn.execute('pragma table_info(files)')]:
+        # From before sig. Null so they get rewritten.
+        conn.execute('alter table files add column sig text')
+    try:
+        conn.executescript(_FTS_SCHEMA)
+    except sqlite3.OperationalError:
+        # No fts5 in this build.
+        conn.executescript(_NO_FTS_SCHEMA)
+    return conn
+
+
+#-----------------------------------------------------------------------------------
+def has_fts(conn):
+    ''' True if sections_fts is a real full text table. '''
+    row = conn.execute("select sql from sqlite_master where name = 'sections_fts'").fetchone()
+    return row is not None and 'fts5' in row[0].lower()
+
+
+#-----------------------------------------------------------------------------------
+def update_db(conn, index):
+    ''' Bring the database up to date with a notr_core.ProjectIndex. Only changed files are rewritten.
+        Returns the list of files that were written.
+    '''
+    old_files = {path: (mtime, sig) for path, mtime, sig in conn.execute('select path, mtime, sig from files')}
+    written = []
+
+    with conn:
+        # Gone files.
+        for path in old_files.keys() - index.files.keys():
+            _delete_file(conn, path)
+
+        for path, findex in index.files.items():
+            targets = [] if findex.no_index else findex.sections + findex.links
+            target_rows = [(t.name, t.ttype, t.level, t.resource, t.file, t.line) for t in targets]
+            sig = hashlib.sha1(repr((target_rows, [t.tags for t in targets])).encode('utf-8')).hexdigest()
+            if old_files.get(path) == (findex.mtime, sig):
+                continue
+
+            if path in old_files:
+                _delete_file(conn, path)
+            conn.execute('insert into files values (?, ?, ?)', (path, findex.mtime, sig))
+            written.append(path)
+
+            if findex.no_index:
+                continue
+
+            conn.executemany('insert into targets values (?, ?, ?, ?, ?, ?)', target_rows)
+            conn.executemany('insert into tags values (?, ?, ?)',
+                             [(tag, t.name, t.file) for t in targets for tag in t.tags])
+
+            # Which section each ref is in.
+            sections = sorted(findex.sections, key=lambda t: t.line)
+            lines = [t.line for t in sections]
+            refs = []
+            for ref in findex.refs:
+                i = bisect.bisect_right(lines, ref.line) - 1
+                refs.append((ref.name, sections[i].name if i >= 0 else None, ref.file, ref.line))
+            conn.executemany('insert into refs values (?, ?, ?, ?)', refs)
+
+            conn.executemany('insert into sections_fts values (?, ?, ?, ?, ?)',
+                             [(t.name, ' '.join(t.tags), body, t.file, t.line) for t, body in _get_bodies(path, sections)])
+
+        # Errors are for the whole project so just redo them.
+        conn.execute('delete from errors')
+        conn.executemany('insert into errors values (?, ?, ?)', index.user_errors)
+
+    return written
+
+
+#-----------------------------------------------------------------------------------
+def query(conn, text):
+    ''' Run a query. If text is a select statement it's run as is, otherwise it's a full text search of section bodies.
+        Returns (column names, rows).
+    '''
+    if text.strip().lower().startswith(('select', 'with')):
+        cur = conn.execute(text)
+    elif has_fts(conn):
+        cur = conn.execute("select name, file, line, snippet(sections_fts, 2, '', '', '...', 8) as snippet from sections_fts "
+                           "where sections_fts match ? order by rank", (text,))
+    else:
+        cur = conn.execute('select name, file, line, substr(body, 1, 60) as snippet from sections_fts where body like ?',
+                           (f'%{text}%',))
+    cols = [d[0] for d in cur.description]
+    return cols, cur.fetchall()
+
+
+#-----------------------------------------------------------------------------------
+def _delete_file(conn, path):
+    for table in ('targets', 'tags', 'refs'):
+        conn.execute(f'delete from {table} where file = ?', (path,))
+    conn.execute('delete from sections_fts where file = ?', (path,))
+    conn.execute('delete from files where path = ?', (path,))
+
+
+#-----------------------------------------------------------------------------------
+def _get_bodies(path, sections):
+    ''' Text under each section up to the next one. sections must be ordered by line. Returns list of (section, body). '''
+    try:
+        with open(path, 'r', encoding='utf-8') as fp:
+            lines = fp.read().splitlines()
+    except Exception:
+        return [(t, '') for t in sections]
+
+    bodies = []
+    for i, t in enumerate(sections):
+        end = sections[i + 1].line - 1 if i + 1 < len(sections) else len(lines)
+        bodies.append((t, '\n'.join(lines[t.line:end])))  # lines are 1-based so this skips the heading
+    return bodies
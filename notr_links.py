@@ -0,0 +1,90 @@
+'''
+Link health checker. Files and dirs are stat'ed and urls get a HEAD request, all concurrently in a bounded
+thread pool. Results are cached per resource with the time they were checked so a re-run only rechecks the
+stale ones. Like notr_core.py it has no dependency on sublime.
+'''
+
+import os
+import json
+import time
+import urllib.request
+import urllib.error
+import concurrent.futures
+
+
+# Link types that point at something checkable.
+LINK_TYPES = ('url', 'image', 'file', 'dir')
+
+# Some servers don't like HEAD. Try GET for these.
+_NO_HEAD_CODES = (403, 405, 501)
+
+
+#-----------------------------------------------------------------------------------
+def check_links(targets, cache, workers=8, max_age=86400, timeout=10.0):
+    ''' Check the link targets. cache is a dict of resource: [time checked, problem or None] that is brought up to date
+        and pruned of resources no longer linked. Entries older than max_age seconds are rechecked.
+        Returns list of user errors (file, line, msg).
+    '''
+    now = time.time()
+    links = [t for t in targets if t.ttype in LINK_TYPES]
+    resources = set([t.resource for t in links])
+
+    for res in list(cache.keys()):
+        if res not in resources:
+            del cache[res]
+
+    stale = [res for res in resources if res not in cache or now - cache[res][0] > max_age]
+    if len(stale) > 0:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for res, problem in zip(stale, executor.map(lambda r: check_resource(r, timeout), stale)):
+                cache[res] = [now, problem]
+
+    errors = []
+    for t in links:
+        problem = cache[t.resource][1]
+        if problem is not None:
+            errors.append((t.file, t.line, f'Broken link: [{t.resource}] {problem}'))
+    return errors
+
+
+#-----------------------------------------------------------------------------------
+def check_resource(resource, timeout=10.0):
+    ''' Check one resource. Returns None if ok else what's wrong. '''
+    if resource.startswith('http'):
+        return _check_url(resource, timeout)
+    return None if os.path.exists(resource) else 'not found'
+
+
+#-----------------------------------------------------------------------------------
+def load_cache(fn):
+    ''' Read a cache file. Returns empty if not there or bad. '''
+    try:
+        with open(fn, 'r') as fp:
+            return json.load(fp)
+    except Exception:
+        return {}
+
+
+#-----------------------------------------------------------------------------------
+def save_cache(fn, cache):
+    with open(fn, 'w') as fp:
+        fp.write(json.dumps(cache))
+
+
+#-----------------------------------------------------------------------------------
+def _check_url(url, timeout):
+    ''' HEAD it, or GET if the server won't. Only the headers are read. '''
+    for method in ('HEAD', 'GET'):
+        req = urllib.request.Request(url, method=method, headers={'User-Agent': 'Notr link check'})
+        try:
+            with urllib.request.urlopen(req, timeout=timeout):
+                return None
+        except urllib.error.HTTPError as e:
+            if method == 'HEAD' and e.code in _NO_HEAD_CODES:
+                continue
+            return f'http {e.code}'
+        except urllib.error.URLError as e:
+            return str(e.reason)
+        except Exception as e:
+            # Timeouts, bad urls, etc.
+            return str(e)
@@ -0,0 +1,82 @@
+'''
+Frecency ranking of visited targets for the mru. Each visit adds a score that halves every half_life so names used
+often and lately rank first. A score is kept as the time of one visit worth the same as all of them, so a visit is
+O(1), nothing has to be decayed, and scores still compare after the half life is changed. Like notr_core.py it has
+no dependency on sublime.
+'''
+
+import math
+import time
+import collections
+
+
+#-----------------------------------------------------------------------------------
+class Frecency:
+    ''' Visited names and their scores. half_life is in seconds. Only max_size names are kept. '''
+
+    def __init__(self, half_life=14 * 86400, max_size=500):
+        self.half_life = half_life
+        self.max_size = max_size
+        self._scores = collections.OrderedDict()  # k:name v:score in epoch seconds, most recently visited last
+        self._ranked = None  # cached ranked()
+
+    def __len__(self):
+        return len(self._scores)
+
+    def __contains__(self, name):
+        return name in self._scores
+
+    def visit(self, name, now=None):
+        ''' Count a visit to name. '''
+        score = time.time() if now is None else now
+        old = self._scores.pop(name, None)
+        if old is not None:
+            # half_life * log2(2^(old/half_life) + 2^(score/half_life)) without going out of range.
+            high, low = max(old, score), min(old, score)
+            score = high + self.half_life * math.log2(1 + 2 ** ((low - high) / self.half_life))
+        self._scores[name] = score
+        self._ranked = None
+        if len(self._scores) > self.max_size:
+            self._trim()
+
+    def score(self, name):
+        ''' Relative score in seconds, bigger is better, or None if not visited. Only good for comparing. '''
+        return self._scores.get(name)
+
+    def ranked(self, limit=None):
+        ''' Names best first. Ties go to the most recent. '''
+        if self._ranked is None:
+            names = list(reversed(self._scores.keys()))
+            self._ranked = sorted(names, key=lambda name: -self._scores[name])
+        return self._ranked if limit is None else self._ranked[:limit]
+
+    def prune(self, valid_names):
+        ''' Drop names not in valid_names e.g. after the index changed. '''
+        for name in [name for name in self._scores if name not in valid_names]:
+            del self._scores[name]
+            self._ranked = None
+
+    def dump(self):
+        ''' For persisting. List of [name, score], least recent first. '''
+        return [[name, score] for name, score in self._scores.items()]
+
+    @classmethod
+    def load(cls, data, half_life=14 * 86400, max_size=500):
+        ''' From dump(). Also takes the old style mru list of names, most recent first. '''
+        frecency = cls(half_life, max_size)
+        if len(data) > 0 and isinstance(data[0], str):
+            # An hour apart so they keep their order.
+            now = time.time()
+            for i, name in enumerate(reversed(data)):
+                frecency._scores[name] = now - (len(data) - i) * 3600
+        else:
+            for name, score in data:
+                frecency._scores[name] = float(score)
+        return frecency
+
+    def _trim(self):
+        ''' Drop the lowest scores, a few at a time so it's not every visit. '''
+        keep = set(self.ranked(self.max_size * 9 // 10))
+        for name in [name for name in self._scores if name not in keep]:
+            del self._scores[name]
+        self._ranked = None
@@ -0,0 +1,358 @@
+'''
+Publish a notr project as linked static html. Sections become anchors and refs become hyperlinks.
+
+A manifest in the output dir remembers the source hashes and what each page links to, so a republish
+only renders the pages whose source changed or whose refs now resolve somewhere else. Like notr_core.py
+it has no dependency on sublime and can be run from the command line:
+
+    python notr_publish.py my-project.nproj out_dir [-j workers]
+'''
+
+import sys
+import os
+import re
+import json
+import html
+import hashlib
+import pathlib
+import argparse
+import concurrent.futures
+
+try:
+    from . import notr_core as core
+except ImportError:
+    import notr_core as core
+
+
+# Remembers what was published.
+MANIFEST_FN = '.notr-publish.json'
+
+# Table of contents. Underscore so it doesn't collide with a notr file named index.
+CONTENTS_FN = '_contents.html'
+
+# Don't bother with a worker pool for fewer pages than this.
+_PARALLEL_MIN_PAGES = 50
+
+_PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; max-width: 60em; margin: auto; }}
+.notr {{ white-space: pre-wrap; font-family: monospace; }}
+.notr h1, .notr h2, .notr h3, .notr h4, .notr h5, .notr h6 {{ font-family: sans-serif; margin: 0.5em 0 0 0; }}
+.tags {{ color: gray; font-size: small; }}
+.bad-ref {{ color: red; }}
+</style>
+</head>
+<body>
+<a href="{contents}">contents</a>
+<div class="notr">
+{body}
+</div>
+</body>
+</html>
+'''
+
+
+#-----------------------------------------------------------------------------------
+#---------------------------- Public functions -------------------------------------
+#-----------------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------------
+def publish(project, out_dir, workers=1, use_processes=True):
+    ''' Render the project notr files to out_dir. Only changed pages, and the pages that link to them, are rendered.
+        workers > 1 renders in a process pool, or in a thread pool if use_processes is False.
+        Returns dict with lists of 'rendered' and 'removed' output file names.
+    '''
+    pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+    manifest_fn = os.path.join(out_dir, MANIFEST_FN)
+
+    old_manifest = {}
+    if os.path.isfile(manifest_fn):
+        try:
+            with open(manifest_fn, 'r') as fp:
+                old_manifest = json.load(fp)
+        except Exception:
+            old_manifest = {}  # start over
+    old_pages = old_manifest.get('pages', {})
+
+    # See which sources changed. Check mtime first and hash only if that's different.
+    pages = {}
+    changed = []
+    for ntr_fn in core.get_project_files(project, []):
+        mtime = os.path.getmtime(ntr_fn)
+        old = old_pages.get(ntr_fn)
+        if old is not None and old['mtime'] == mtime:
+            pages[ntr_fn] = old
+            continue
+        with open(ntr_fn, 'rb') as fp:
+            digest = hashlib.sha1(fp.read()).hexdigest()
+        if old is not None and old['hash'] == digest:
+            old['mtime'] = mtime
+            pages[ntr_fn] = old
+        else:
+            pages[ntr_fn] = {'mtime': mtime, 'hash': digest}
+            if old is not None:
+                pages[ntr_fn]['out'] = old['out']  # keep its place
+            changed.append(ntr_fn)
+
+    # New pages get an output name not used by another page. Same named files in different dirs get a number.
+    used = set([page['out'].lower() for page in pages.values() if 'out' in page] + [CONTENTS_FN])
+    for ntr_fn, page in pages.items():
+        if 'out' not in page:
+            page['out'] = _unique_name(core.get_froot(ntr_fn), '.html', used)
+
+    # Aliases from all files are visible, later files win like build_index().
+    for ntr_fn in changed:
+        pages[ntr_fn]['aliases'] = core.read_aliases(ntr_fn)
+    all_aliases = {}
+    for page in pages.values():
+        all_aliases.update(page.get('aliases', {}))
+    aliases = core.AliasTable(all_aliases)
+
+    # If they changed, links anywhere could be different so do everything.
+    old_aliases = {}
+    for page in old_pages.values():
+        old_aliases.update(page.get('aliases', {}))
+    if all_aliases != old_aliases:
+        changed = list(pages.keys())
+
+    # Parse the changed ones to get their targets and refs.
+    if len(changed) > 0:
+        for ntr_fn in changed:
+            findex = core.process_file(ntr_fn, pages[ntr_fn]['mtime'], aliases)
+            page = pages[ntr_fn]
+            page['targets'] = []
+            if not findex.no_index:
+                anchors = get_anchors([t.name for t in findex.sections])
+                page['targets'] = [[t.name, f'{page["out"]}#{anchor}'] for t, anchor in zip(findex.sections, anchors)]
+                page['targets'].extend([[t.name, _get_href(t)] for t in findex.links])
+            page['refs'] = sorted(set([r.name for r in findex.refs]))
+
+    # Where everything points, now and last time. First one wins like validation.
+    hrefs = _get_hrefs(pages)
+    old_hrefs = _get_hrefs(old_pages)
+    moved = set([name for name in hrefs.keys() | old_hrefs.keys() if hrefs.get(name) != old_hrefs.get(name)])
+
+    # A page needs rendering if its source changed or any of its refs resolve differently.
+    changed = set(changed)
+    jobs = []
+    for ntr_fn, page in pages.items():
+        out_fn = os.path.join(out_dir, page['out'])
+        if ntr_fn in changed or not moved.isdisjoint(page['refs']) or not os.path.isfile(out_fn):
+            jobs.append((ntr_fn, out_fn, {name: hrefs.get(name) for name in page['refs']}, aliases.with_overrides(page['aliases'])))
+
+    _render_pages(jobs, workers, use_processes)
+
+    # Clean up pages for sources that went away.
+    removed = []
+    for ntr_fn, page in old_pages.items():
+        if ntr_fn not in pages:
+            out_fn = os.path.join(out_dir, page['out'])
+            if page['out'].lower() not in used and os.path.isfile(out_fn):
+                os.remove(out_fn)
+            removed.append(out_fn)
+
+    # Table of contents if the page list changed.
+    contents_fn = os.path.join(out_dir, CONTENTS_FN)
+    if len(removed) > 0 or set(pages.keys()) != set(old_pages.keys()) or not os.path.isfile(contents_fn):
+        items = [f'<a href="{page["out"]}">{html.escape(core.get_froot(ntr_fn))}</a>' for ntr_fn, page in pages.items()]
+        with open(contents_fn, 'w', encoding='utf-8') as fp:
+            title = html.escape(pathlib.Path(project['_fn']).stem)
+            fp.write(_PAGE_TEMPLATE.format(title=title, contents=CONTENTS_FN, body='\n'.join(items)))
+
+    with open(manifest_fn, 'w') as fp:
+        fp.write(json.dumps({'project': project['_fn'], 'pages': pages}))
+
+    return {'rendered': [j[1] for j in jobs], 'removed': removed}
+
+
+#-----------------------------------------------------------------------------------
+def render_page(ntr_fn, out_fn, hrefs, aliases=None):
+    ''' Render one notr file to html. hrefs maps the ref names used in the file to their href or None if invalid.
+        aliases is the core.AliasTable for expanding links.
+    '''
+    froot = core.get_froot(ntr_fn)
+    with open(ntr_fn, 'r', encoding='utf-8') as fp:
+        lines = fp.read().splitlines()
+
+    out = []
+    anchors = set()
+    in_block_comment = False
+    for line in lines:
+        # Raw blocks are verbatim.
+        if in_block_comment or line.startswith('```'):
+            if line.startswith('```'):
+                in_block_comment = not in_block_comment
+            out.append(html.escape(line))
+            continue
+
+        # Directives are not for readers.
+        if core.RE_DIRECTIVES.match(line):
+            continue
+
+        m = core.RE_SECTIONS.match(line)
+        if m is not None:
+            content = m.group(1).strip().split(None, 1)
+            if len(content) == 2:
+                hashes = content[0]
+                level = min(len(hashes), 6)
+                anchor = _unique_anchor(f'{froot}{hashes}{content[1].strip()}', anchors)
+                tags = f' <span class="tags">[{html.escape(m.group(2))}]</span>' if m.group(2) else ''
+                out.append(f'<h{level} id="{anchor}">{html.escape(content[1].strip())}{tags}</h{level}>')
+                continue
+
+        out.append(_render_line(line, froot, hrefs, aliases))
+
+    with open(out_fn, 'w', encoding='utf-8') as fp:
+        fp.write(_PAGE_TEMPLATE.format(title=html.escape(froot), contents=CONTENTS_FN, body='\n'.join(out)))
+
+
+#-----------------------------------------------------------------------------------
+def get_anchors(section_names):
+    ''' Html ids for the section names in one file, like froot#Section title, in file order. Ids are made from the
+        title and numbered if they come out the same, like for the same title at a different level.
+    '''
+    anchors = set()
+    return [_unique_anchor(name, anchors) for name in section_names]
+
+
+#-----------------------------------------------------------------------------------
+#---------------------------- Private functions ------------------------------------
+#-----------------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------------
+def _render_pages(jobs, workers, use_processes):
+    ''' Render the (ntr_fn, out_fn, hrefs, aliases) jobs. '''
+    if workers <= 1 or len(jobs) < _PARALLEL_MIN_PAGES:
+        for job in jobs:
+            render_page(*job)
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor if use_processes else concurrent.futures.ThreadPoolExecutor
+        with pool(max_workers=workers) as executor:
+            fns, out_fns, hrefs, aliases = zip(*jobs)
+            chunksize = max(1, len(jobs) // (workers * 4)) if use_processes else 1
+            # Consume to surface any exceptions.
+            list(executor.map(render_page, fns, out_fns, hrefs, aliases, chunksize=chunksize))
+
+
+#-----------------------------------------------------------------------------------
+def _unique_anchor(section_name, used):
+    ''' Html id for a section name that isn't in used, which it's added to. Titles with no letters or digits use a
+        hash of the title.
+    '''
+    _, _, title = section_name.partition('#')
+    base = re.sub(r'[\W_]+', '-', title).strip('-').lower()
+    if len(base) == 0:
+        base = 'section-' + hashlib.sha1(title.encode('utf-8')).hexdigest()[:8]
+    return _unique_name(base, '', used)
+
+
+#-----------------------------------------------------------------------------------
+def _unique_name(base, ext, used):
+    ''' base + ext, or numbered if that's in used. Ignores case since file systems might. Adds it to used. '''
+    name = base + ext
+    num = 1
+    while name.lower() in used:
+        num += 1
+        name = f'{base}-{num}{ext}'
+    used.add(name.lower())
+    return name
+
+
+#-----------------------------------------------------------------------------------
+def _get_hrefs(pages):
+    ''' Map all target names in the manifest pages to their href. '''
+    hrefs = {}
+    for page in pages.values():
+        for name, href in page['targets']:
+            if name not in hrefs:
+                hrefs[name] = href
+    return hrefs
+
+
+#-----------------------------------------------------------------------------------
+def _render_line(line, froot, hrefs, aliases):
+    ''' Escape a plain line and turn its links and refs into anchors. '''
+    spans = []  # (start, end, html)
+
+    for m in core.RE_LINKS.finditer(line):
+        name = m.group(1).strip()
+        res = core.expand_vars(m.group(2).strip(), aliases)
+        href = None if res is None else res if res.startswith('http') else _get_file_uri(res)
+        spans.append((m.start(), m.end(), _make_anchor(href, name if len(name) > 0 else m.group(2))))
+
+    for m in core.RE_REFS.finditer(line):
+        name = m.group(1).strip()
+        if name.startswith('#'):
+            name = froot + name
+        spans.append((m.start(), m.end(), _make_anchor(hrefs.get(name), name)))
+
+    # Assemble, skipping overlaps.
+    out = []
+    pos = 0
+    for start, end, text in sorted(spans):
+        if start >= pos:
+            out.append(html.escape(line[pos:start]))
+            out.append(text)
+            pos = end
+    out.append(html.escape(line[pos:]))
+    return ''.join(out)
+
+
+#-----------------------------------------------------------------------------------
+def _make_anchor(href, text):
+    if href is None:
+        return f'<span class="bad-ref">{html.escape(text)}</span>'
+    return f'<a href="{html.escape(href)}">{html.escape(text)}</a>'
+
+
+#-----------------------------------------------------------------------------------
+def _get_href(target):
+    ''' Where a link target points in the published site. None if invalid. '''
+    if target.ttype == 'url':
+        return target.resource
+    if target.ttype != '':
+        return _get_file_uri(target.resource)
+    return None
+
+
+#-----------------------------------------------------------------------------------
+def _get_file_uri(path):
+    try:
+        return pathlib.Path(os.path.abspath(path)).as_uri()
+    except ValueError:
+        return None
+
+
+#-----------------------------------------------------------------------------------
+#---------------------------- Command line -----------------------------------------
+#-----------------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------------
+def main(argv=None):
+    ''' Publish a project. Returns the exit code. '''
+    parser = argparse.ArgumentParser(prog='notr_publish', description='Publish a notr project as html.')
+    parser.add_argument('project', help='notr project file (.nproj)')
+    parser.add_argument('out_dir', help='where to put the html')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help='number of render processes')
+    args = parser.parse_args(argv)
+
+    try:
+        project = core.load_project(args.project)
+    except Exception as e:
+        print(f'{args.project}: {e}', file=sys.stderr)
+        return 2
+
+    res = publish(project, args.out_dir, args.workers)
+    print(f'Rendered {len(res["rendered"])} pages, removed {len(res["removed"])} to {args.out_dir}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
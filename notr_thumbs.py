@@ -0,0 +1,330 @@
+'''
+Disk cache of image thumbnails for hover popups. A thumbnail is made once per source path and mtime and kept in
+a size-bounded directory, least recently used removed first. Pillow is used if it's there. It's not usually in the
+plugin host so png files are also done in plain python. Anything else without Pillow shows the original scaled by
+its img size, if it's not too big. Like notr_core.py it has no dependency on sublime.
+'''
+
+import os
+import re
+import zlib
+import struct
+import hashlib
+import collections
+
+try:
+    from PIL import Image
+except ImportError:
+    # Not usually in the plugin host.
+    Image = None
+
+
+# Cache file names are key_width_height.ext where width and height are the display size.
+_RE_CACHE_FN = re.compile(r'^([0-9a-f]{40})_(\d+)_(\d+)(\.\w+)$')
+
+_PNG_SIG = b'\x89PNG\r\n\x1a\n'
+
+# Plain python png decoding is slow for the filters that go a byte at a time, a few seconds for a big screenshot.
+# Bigger than this isn't tried.
+_MAX_PNG_BYTES = 16 * 1024 * 1024
+
+# Originals shown as is. ST decodes them on every hover so big ones aren't shown at all.
+_MAX_ORIGINAL_BYTES = 2 * 1024 * 1024
+_MAX_ORIGINALS = 100
+
+# Png color type to bytes per pixel at 8 bits. Palette is index only.
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+#-----------------------------------------------------------------------------------
+class ThumbCache:
+    ''' Thumbnails in cache_dir, up to max_bytes total. size_px is the largest side. '''
+
+    def __init__(self, cache_dir, max_bytes, size_px=200):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.size_px = size_px
+        self._entries = None  # k:key v:(fn, width, height) - loaded on first use
+        self._originals = collections.OrderedDict()  # k:key v:(src, width, height) - least recent first
+
+    def get(self, src):
+        ''' Thumbnail for image file src. Returns (fn, width, height) or None if it can't be done. '''
+        try:
+            mtime = os.path.getmtime(src)
+        except OSError:
+            return None
+
+        key = hashlib.sha1(f'{os.path.abspath(src)}|{mtime}'.encode('utf-8')).hexdigest()
+        entry = self._originals.get(key)
+        if entry is not None:
+            self._originals.move_to_end(key)
+            return entry
+
+        entries = self._load()
+        entry = entries.get(key)
+        if entry is not None:
+            try:
+                os.utime(entry[0])  # now most recent
+                return entry
+            except OSError:
+                del entries[key]  # someone deleted it
+
+        entry = self._make(src, key) if Image is not None else self._make_png(src, key)
+        if entry is not None:
+            entries[key] = entry
+            self._trim(entry[0])
+        elif Image is None:
+            entry = self._get_original(src, key)
+        return entry
+
+    def _get_original(self, src, key):
+        ''' Can't make one so it's the original with its display size, if it's small enough. '''
+        try:
+            if os.path.getsize(src) > _MAX_ORIGINAL_BYTES:
+                return None
+            size = get_image_size(src)
+        except (OSError, struct.error):
+            size = None
+        if size is None:
+            return None
+        entry = (src,) + _fit(size, self.size_px)
+        self._originals[key] = entry
+        if len(self._originals) > _MAX_ORIGINALS:
+            self._originals.popitem(last=False)
+        return entry
+
+    def _load(self):
+        ''' Find what's already in the cache dir. '''
+        if self._entries is None:
+            self._entries = {}
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for fn in os.listdir(self.cache_dir):
+                m = _RE_CACHE_FN.match(fn)
+                if m is not None:
+                    self._entries[m.group(1)] = (os.path.join(self.cache_dir, fn), int(m.group(2)), int(m.group(3)))
+        return self._entries
+
+    def _make(self, src, key):
+        ''' Make the thumbnail with pillow. Returns the entry or None. '''
+        try:
+            with Image.open(src) as im:
+                im.thumbnail((self.size_px, self.size_px))
+                if im.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                    im = im.convert('RGBA')
+                fn = os.path.join(self.cache_dir, f'{key}_{im.width}_{im.height}.png')
+                im.save(fn, 'PNG')
+            return (fn, im.width, im.height)
+        except Exception:
+            return None  # not an image we can do
+
+    def _make_png(self, src, key):
+        ''' Make the thumbnail from a png without pillow. Returns the entry or None. '''
+        try:
+            with open(src, 'rb') as fp:
+                thumb = _png_thumbnail(fp, self.size_px)
+        except (OSError, ValueError, IndexError, struct.error, zlib.error):
+            return None
+        if thumb is None:
+            return None
+        width, height, data = thumb
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fn = os.path.join(self.cache_dir, f'{key}_{width}_{height}.png')
+        with open(fn, 'wb') as fp:
+            fp.write(data)
+        return (fn, width, height)
+
+    def _trim(self, keep_fn):
+        ''' Remove least recently used until under budget. '''
+        files = []
+        total = 0
+        for key, entry in self._entries.items():
+            try:
+                st = os.stat(entry[0])
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, key, entry[0]))
+            total += st.st_size
+
+        for _, size, key, fn in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if fn != keep_fn:
+                os.remove(fn)
+                del self._entries[key]
+                total -= size
+
+
+#-----------------------------------------------------------------------------------
+def get_image_size(fn):
+    ''' Read (width, height) from the image file header. Supports png, gif, bmp, jpeg. Returns None if unknown. '''
+    with open(fn, 'rb') as fp:
+        head = fp.read(26)
+        if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', head[6:10])
+        if head.startswith(b'BM'):
+            width, height = struct.unpack('<ii', head[18:26])
+            return (width, abs(height))
+        if head.startswith(b'\xff\xd8'):
+            # Walk the markers to the frame header.
+            fp.seek(2)
+            while True:
+                marker = fp.read(4)
+                if len(marker) < 4 or marker[0] != 0xff:
+                    return None
+                if marker[1] in (0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf):
+                    height, width = struct.unpack('>xHH', fp.read(5))
+                    return (width, height)
+                fp.seek(struct.unpack('>H', marker[2:4])[0] - 2, os.SEEK_CUR)
+    return None
+
+
+#-----------------------------------------------------------------------------------
+def _png_thumbnail(fp, size_px):
+    ''' Read a png and shrink it to fit in size_px square. Nearest pixel, which is ok at popup size.
+        Returns (width, height, png file bytes) or None if it's not a png that can be done.
+    '''
+    if fp.read(8) != _PNG_SIG:
+        return None
+
+    # Header.
+    length, tag = struct.unpack('>I4s', fp.read(8))
+    if tag != b'IHDR':
+        return None
+    width, height, depth, color, _, _, interlace = struct.unpack('>IIBBBBB', fp.read(length))
+    fp.read(4)
+    if color not in _PNG_CHANNELS or depth not in (8, 16) or (color == 3 and depth != 8) or interlace != 0:
+        return None
+    bpp = _PNG_CHANNELS[color] * depth // 8
+    stride = width * bpp
+    if stride * height > _MAX_PNG_BYTES:
+        return None
+
+    # What to keep.
+    thumb_width, thumb_height = _fit((width, height), size_px)
+    want_rows = {}  # k:source row v:[thumb rows]
+    for trow in range(thumb_height):
+        want_rows.setdefault(trow * height // thumb_height, []).append(trow)
+    want_offsets = [(tcol * width // thumb_width) * bpp for tcol in range(thumb_width)]
+
+    # Go through the image data a row at a time.
+    palette = None
+    trans = None
+    thumb_rows = [None] * thumb_height
+    masks = _byte_masks(stride)
+    dec = zlib.decompressobj()
+    buf = b''
+    prev = bytes(stride)
+    irow = 0
+    while irow < height:
+        length, tag = struct.unpack('>I4s', fp.read(8))
+        data = fp.read(length)
+        fp.read(4)
+        if tag == b'PLTE':
+            palette = [data[i:i + 3] for i in range(0, len(data), 3)]
+        elif tag == b'tRNS' and color == 3:
+            trans = data
+        elif tag == b'IDAT':
+            buf += dec.decompress(data)
+            start = 0
+            while len(buf) - start > stride and irow < height:
+                row = _unfilter(buf[start], buf[start + 1:start + stride + 1], prev, bpp, masks)
+                start += stride + 1
+                if irow in want_rows:
+                    pixels = b''.join([row[offset:offset + bpp] for offset in want_offsets])
+                    for trow in want_rows[irow]:
+                        thumb_rows[trow] = pixels
+                prev = row
+                irow += 1
+            buf = buf[start:]
+        elif tag == b'IEND' or len(data) < length:
+            return None  # short
+
+    # Make it 8 bit, and no palette.
+    out_color = color
+    if depth == 16:
+        thumb_rows = [row[0::2] for row in thumb_rows]
+    if color == 3:
+        if palette is None:
+            return None
+        if trans is not None:
+            alpha = list(trans) + [255] * (len(palette) - len(trans))
+            palette = [p + bytes([a]) for p, a in zip(palette, alpha)]
+            out_color = 6
+        else:
+            out_color = 2
+        thumb_rows = [b''.join([palette[i] for i in row]) for row in thumb_rows]
+
+    raw = b''.join([b'\x00' + row for row in thumb_rows])
+    return (thumb_width, thumb_height, _PNG_SIG +
+            _png_chunk(b'IHDR', struct.pack('>IIBBBBB', thumb_width, thumb_height, 8, out_color, 0, 0, 0)) +
+            _png_chunk(b'IDAT', zlib.compress(raw)) + _png_chunk(b'IEND', b''))
+
+
+#-----------------------------------------------------------------------------------
+def _unfilter(ftype, line, prev, bpp, masks):
+    ''' Undo the png filter on one row. None, sub and up are done on the whole row as big ints. masks are from
+        _byte_masks().
+    '''
+    if ftype == 0:
+        return line
+    num = len(line)
+    if ftype == 1:
+        # Running sum in steps of bpp, doubling the step each time.
+        val = int.from_bytes(line, 'big')
+        shift = bpp
+        while shift < num:
+            val = _add_bytes(val, val >> (shift * 8), masks)
+            shift *= 2
+        return val.to_bytes(num, 'big')
+    if ftype == 2:
+        return _add_bytes(int.from_bytes(line, 'big'), int.from_bytes(prev, 'big'), masks).to_bytes(num, 'big')
+
+    # The rest depend on the byte to the left so it's one at a time.
+    out = bytearray(line)
+    if ftype == 3:
+        for i in range(num):
+            left = out[i - bpp] if i >= bpp else 0
+            out[i] = (out[i] + ((left + prev[i]) >> 1)) & 0xff
+    elif ftype == 4:
+        for i in range(num):
+            if i >= bpp:
+                a = out[i - bpp]
+                c = prev[i - bpp]
+            else:
+                a = c = 0
+            b = prev[i]
+            pa = abs(b - c)
+            pb = abs(a - c)
+            pc = abs(a + b - c - c)
+            out[i] = (out[i] + (a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 0xff
+    else:
+        raise ValueError(f'Bad png filter {ftype}')
+    return bytes(out)
+
+
+#-----------------------------------------------------------------------------------
+def _byte_masks(num):
+    ''' The low 7 bits and the top bit of each byte of a num byte int. '''
+    return (int.from_bytes(b'\x7f' * num, 'big'), int.from_bytes(b'\x80' * num, 'big'))
+
+
+#-----------------------------------------------------------------------------------
+def _add_bytes(a, b, masks):
+    ''' Add each byte of two ints, no carry between bytes. '''
+    low, high = masks
+    return ((a & low) + (b & low)) ^ ((a ^ b) & high)
+
+
+#-----------------------------------------------------------------------------------
+def _png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+
+#-----------------------------------------------------------------------------------
+def _fit(size, size_px):
+    ''' Scale (width, height) down to fit in size_px square. '''
+    width, height = size
+    scale = min(1.0, size_px / max(width, height, 1))
+    return (max(1, round(width * scale)), max(1, round(height * scale)))
@@ -89,16 +89,23 @@ def create_new_view(window, text, reuse=True):
         view.set_scratch(True)
         _temp_view_id = view.id()
 
-    # Create/populate the view.
+    # Create/populate the view. Delete rather than cut so the clipboard is left alone.
     view.run_command('select_all')
-    view.run_command('cut')
-    view.run_command('append', {'characters': text})  # insert has some odd behavior - indentation
+    view.run_command('right_delete')
+    append_text(view, text)  # insert has some odd behavior - indentation
 
     window.focus_view(view)
 
     return view
 
 
+#-----------------------------------------------------------------------------------
+def append_text(view, text, chunk_size=1000000):
+    '''Append text to the end of the view. Big text is done in chunks to keep the command args reasonable.'''
+    for i in range(0, len(text), chunk_size):
+        view.run_command('append', {'characters': text[i:i + chunk_size], 'force': True})
+
+
 #-----------------------------------------------------------------------------------
 def wait_load_file(window, fpath, line):
     '''Open file asynchronously then position at line. Returns the new View or None if failed.'''
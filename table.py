@@ -2,39 +2,89 @@
 # Source licenses are MIT so all is good. It's generic so easy stealy.
 
 # import sys
+import os
+import re
+import csv
+import html
+import collections
 import sublime
 import sublime_plugin
 
 
 DELIM = '|'
 
+# Like the syntax: a table starts with a line beginning with | and ends at a blank line.
+_RE_TABLE_START = re.compile(r'^\|', re.M)
+_RE_BLANK_LINE = re.compile(r'^[ \t]*(?:\n|\Z)', re.M)
+_RE_BLANK_LINE_NL = re.compile(r'^[ \t]*\n', re.M)  # for searching with endpos, where \Z would match
+
+# Csv values can't have the delimiter so it's replaced with this.
+_DELIM_SUB = '\u00a6'
+
+# How much of a csv file to look at to guess the format.
+_CSV_SNIFF = 16384
+
+# Footer cells are like sum=123.
+_RE_FOOTER_CELL = re.compile(r'^(sum|avg|min|max|count)=')
+AGGREGATES = ('sum', 'avg', 'min', 'max', 'count')
+
+# For sorting.
+_RE_ISO_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?$')
+_RE_DIGITS = re.compile(r'(\d+)')
+
+# How much text to read around the caret looking for the table ends. Grows if the table is bigger.
+_TABLE_CHUNK = 65536
+
+# Tables found per view. Key is view id, value is (change_count, [Region]).
+_table_regions = {}
+
+# Live fit state per view. Key is view id, value is (change_count after the fit, table start, TableMatrix, TableWidths,
+# table text after the fit).
+_auto_fit = {}
+
+# Views running a command that shouldn't be auto fitted. Undo has to be able to undo the fit. The table commands do
+# their own formatting and can change any row.
+_no_auto_fit = set()
+_NO_AUTO_FIT_COMMANDS = ('undo', 'soft_undo', 'redo', 'redo_or_repeat', 'soft_redo',
+                         'table_fit', 'table_fit_all', 'table_sort_col', 'table_sort', 'table_aggregate',
+                         'table_summary', 'table_import_csv', 'table_insert_col', 'table_move_col', 'table_delete_col')
+
+# Settings are shared with the rest of Notr.
+_SETTINGS_FN = 'Notr.sublime-settings'
+
 
 #-----------------------------------------------------------------------------------
 class TableValue:
     ''' One value in a TableMatrix row/col cell. '''
+    __slots__ = ('text', '_key')  # there can be a lot of them
 
     def __init__(self, text):
         self.text = text
+        self._key = None
 
     def __repr__(self):
         return f'{self.text}'
 
+    @property
+    def key(self):
+        ''' Sort key, parsed once. Numbers sort before text. '''
+        if self._key is None:
+            try:
+                num = float(self.text)
+                self._key = (0, num) if num == num else (1, self.text)  # nan is text
+            except ValueError:
+                self._key = (1, self.text)
+        return self._key
+
     def as_float(self):
-        try:
-            return True, float(self.text)
-        except ValueError:
-            return False, None
+        key = self.key
+        return (True, key[1]) if key[0] == 0 else (False, None)
 
     def compare(self, other):
-        self_is_float, self_float = self.as_float()
-        other_is_float, other_float = other.as_float()
-
-        if self_is_float and other_is_float:
-            return self_float - other_float
-        if self.text > other.text:
-            return 1
-        if self.text < other.text:
+        if self.key < other.key:
             return -1
+        if self.key > other.key:
+            return 1
         return 0
 
     def __lt__(self, other):
@@ -46,104 +96,466 @@ class TableValue:
 
 #-----------------------------------------------------------------------------------
 class TableMatrix:
-    ''' Container for the TableValues in the cells. '''
+    ''' Container for the TableValues in the cells. Stored by column so column operations are one list operation
+        and column widths can be kept until the column changes.
+    '''
 
-    def __init__(self, text):
-        self.rows = []  # List of lists of row columns
+    def __init__(self, text, rows=None):
+        ''' From table text, or rows which is a list of lists of cell texts e.g. from a csv file. '''
+        self.cols = []  # List of lists of column cells, all num_rows long
+        self.num_rows = 0
         self.valid = False
 
         # Split each line into table rows.
-        for line in text.splitlines():
-            cols = []
-            parts = line.split(DELIM)
-
-            # Process the cells.
-            # Rows honor empty cells except for the last one. Whitespace cells are converted to empty.
-            for i in range(1, len(parts)):
-                s = parts[i].strip()
-                if i < len(parts) - 1 or len(s) > 0:
-                    cols.append(TableValue(s))
-            self.rows.append(cols)
+        if rows is None:
+            rows = [split_row(line) for line in text.splitlines()]
+        self.num_rows = len(rows)
 
         # Make the collection square.
-        num_columns = self.count_columns()
-        for r in self.rows:
-            while len(r) < num_columns:
-                r.append(TableValue(''))
+        num_columns = max([len(row) for row in rows], default=0)
+        for row in rows:
+            row.extend([''] * (num_columns - len(row)))
 
+        self.cols = [[TableValue(s) for s in col] for col in zip(*rows)]
+        self._widths = [None] * num_columns  # cached, None until measured
         self.valid = True
 
     def __repr__(self):
         return f'rows:{self.rows}'
 
+    @property
+    def rows(self):
+        ''' Row major copy of the cells. '''
+        if len(self.cols) == 0:
+            return [[] for _ in range(self.num_rows)]
+        return [list(row) for row in zip(*self.cols)]
+
+    def row_texts(self, table_row):
+        return [col[table_row].text for col in self.cols]
+
+    def set_row(self, table_row, texts):
+        ''' Replace the cells in a row. texts must have all the columns. '''
+        for icol, (col, text) in enumerate(zip(self.cols, texts)):
+            if col[table_row].text != text:
+                col[table_row] = TableValue(text)
+                self._widths[icol] = None
+
     def validate_col_sel(self, table_col):
         num_cols = self.count_columns()
         return table_col >= 0 and table_col < num_cols
 
     def sort_column(self, table_col, asc):
-        ''' General row sorter. '''
-        class Compare:
-            def __init__(self, row):
-                self.value = row[table_col] # if len(self.rows) > 0 else TableValue('') 
+        ''' General row sorter. Numbers before text, same as TableValue.compare(). Stable. '''
+        if self.validate_col_sel(table_col):
+            end = self.body_end()
+            self._sort_rows([([value.key for value in self.cols[table_col][:end]], asc)], end)
 
-            def __lt__(self, other):
-                return self.value < other.value
+    def sort_columns(self, sort_keys):
+        ''' Sort rows on list of (table_col, asc), most significant first. Each column is sorted as its type - see
+            column_type(). Stable.
+        '''
+        end = self.body_end()
+        row_keys = []
+        for table_col, asc in sort_keys:
+            col = self.cols[table_col][:end]
+            key_func = _SORT_KEYS[column_type(col[1:])]
+            row_keys.append(([key_func(value.text) for value in col], asc))
+        self._sort_rows(row_keys, end)
+
+    def _sort_rows(self, row_keys, end):
+        ''' Reorder the rows between the header and end on list of (keys, asc), most significant first. keys is
+            indexed by row. The header and footer stay put.
+        '''
+        order = list(range(1, end))
 
-            def __eq__(self, other):
-                return self.value == other.value
+        # Least significant first, relying on stable sort.
+        for keys, asc in reversed(row_keys):
+            order.sort(key=keys.__getitem__, reverse=not asc)
 
-        if self.validate_col_sel(table_col):
-            # Assume header always.
-            self.rows[1:] = sorted(self.rows[1:], key=lambda row: Compare(row), reverse=not asc)
+        order = [0] + order + list(range(end, self.num_rows))
+        for icol, col in enumerate(self.cols):
+            self.cols[icol] = [col[irow] for irow in order]
 
     def insert_column(self, table_col):
-        if table_col >= self.count_columns():
-            for row in self.rows:
-                row.append(TableValue(''))
-        elif table_col < 0:
-            for row in self.rows:
-                row.insert(0, TableValue(''))
-        else:
-            for row in self.rows:
-                row.insert(table_col, TableValue(''))
+        table_col = min(max(table_col, 0), self.count_columns())
+        self.cols.insert(table_col, [TableValue('')] * self.num_rows)  # cells are replaced not changed so can share
+        self._widths.insert(table_col, 0)
 
     def delete_column(self, table_col):
         if self.validate_col_sel(table_col):
-            for row in self.rows:
-                row.pop(table_col)
+            self.cols.pop(table_col)
+            self._widths.pop(table_col)
+
+    def move_column(self, table_col, new_col):
+        ''' Move a column so it ends up at new_col. '''
+        if self.validate_col_sel(table_col) and self.validate_col_sel(new_col):
+            self.cols.insert(new_col, self.cols.pop(table_col))
+            self._widths.insert(new_col, self._widths.pop(table_col))
 
     def count_columns(self):
-        num_columns = 0
-        for row in self.rows:
-            num_columns = max(num_columns, len(row))
-        return num_columns
+        return len(self.cols)
+
+    def footer_row(self):
+        ''' Index of the aggregate footer row, or None. It's the last row with cells like sum=123. '''
+        if self.num_rows < 2:
+            return None
+        texts = [text for text in self.row_texts(self.num_rows - 1) if len(text) > 0]
+        if len(texts) == 0 or not all([_RE_FOOTER_CELL.match(text) is not None for text in texts]):
+            return None
+        return self.num_rows - 1
+
+    def body_end(self):
+        ''' Row after the last one that isn't the footer. '''
+        footer = self.footer_row()
+        return footer if footer is not None else self.num_rows
+
+    def aggregate(self, table_col):
+        ''' Aggregates of the numbers in a column, not counting the header or footer.
+            Returns dict of k:func v:formatted value, or None if there are no numbers.
+        '''
+        end = self.body_end()
+        nums = []
+        decimals = 0
+        for value in self.cols[table_col][1:end]:
+            key = value.key
+            if key[0] == 0:
+                nums.append(key[1])
+                decimals = max(decimals, _count_decimals(value.text))
+        if len(nums) == 0:
+            return None
+
+        total = sum(nums)
+        return {
+            'sum': _format_number(total, decimals),
+            'avg': _format_number(total / len(nums), max(decimals, 2)),
+            'min': _format_number(min(nums), decimals),
+            'max': _format_number(max(nums), decimals),
+            'count': str(len(nums)),
+        }
+
+    def set_footer(self, table_col, func):
+        ''' Put func of table_col in the footer, adding the footer if needed. '''
+        footer = self.footer_row()
+        if footer is None:
+            for col in self.cols:
+                col.append(TableValue(''))
+            self.num_rows += 1
+            footer = self.num_rows - 1
+        agg = self.aggregate(table_col)
+        self.cols[table_col][footer] = TableValue(f'{func}={agg[func] if agg is not None else ""}')
+        self._widths[table_col] = None
+
+    def update_footer(self):
+        ''' Recalculate the footer cells, if there are any. '''
+        footer = self.footer_row()
+        if footer is not None:
+            for table_col, col in enumerate(self.cols):
+                m = _RE_FOOTER_CELL.match(col[footer].text)
+                if m is not None:
+                    self.set_footer(table_col, m.group(1))
+
+    def numeric_columns(self):
+        ''' Columns that are all numbers, not counting the header or footer. '''
+        end = self.body_end()
+        return [table_col for table_col, col in enumerate(self.cols) if column_type(col[1:end]) == 'number' and
+                any([len(value.text) > 0 for value in col[1:end]])]
+
+    def column_width(self, table_col):
+        ''' Widest text in the column. '''
+        width = self._widths[table_col]
+        if width is None:
+            width = max([len(value.text) for value in self.cols[table_col]], default=0)
+            self._widths[table_col] = width
+        return width
 
     def format(self):
         ''' Format the output for display. '''
-        output = []
-
-        # Measure all columns.
-        column_widths = [0] * self.count_columns()
-        for row in self.rows:
-            for icol, value in enumerate(row):
-                text = value.text
-                # text = self.QuoteText(value.text)
-                width = len(text)
-                if width > column_widths[icol]:
-                    column_widths[icol] = width
-
-        # Generate the output text.
-        for _, row in enumerate(self.rows):
-            row_text = []
-            for icol, value in enumerate(row):
-                column_width = column_widths[icol] + 2  # add pad
-                text = (' ' + value.text).ljust(column_width)
-                row_text.append(text)
-            output.append(DELIM + DELIM.join(row_text) + DELIM)
+        if len(self.cols) == 0:
+            return (DELIM + DELIM + '\n') * self.num_rows
+
+        # Pad a column at a time then stitch the rows together.
+        padded = []
+        for icol, col in enumerate(self.cols):
+            column_width = self.column_width(icol) + 2  # add pad
+            padded.append([(' ' + value.text).ljust(column_width) for value in col])
+        output = [DELIM + DELIM.join(row_text) + DELIM for row_text in zip(*padded)]
 
         return '\n'.join(output) + '\n'
 
 
+#-----------------------------------------------------------------------------------
+class TableWidths:
+    ''' Column widths of a TableMatrix, kept up to date a row at a time. Each column has a histogram of its cell widths
+        so when the widest cell gets narrower it's a lookup to tell if it was the only one that wide. The footer isn't
+        in the histograms. It's recalculated by table_fit so it only sets a minimum width.
+    '''
+
+    def __init__(self, matrix):
+        self._footer = matrix.footer_row()
+        self._cell_widths = [[len(value.text) for value in col] for col in matrix.cols]
+        self._footer_widths = [0] * len(matrix.cols)
+        if self._footer is not None:
+            self._footer_widths = [col[self._footer] for col in self._cell_widths]
+            self._cell_widths = [col[:self._footer] for col in self._cell_widths]
+        self._hists = [collections.Counter(col) for col in self._cell_widths]
+        self.widths = [max(max(hist, default=0), footer_width)
+                       for hist, footer_width in zip(self._hists, self._footer_widths)]
+
+    def update_row(self, table_row, texts):
+        ''' Row table_row is now texts. Returns list of the columns whose width changed, or None if the row doesn't
+            have the same number of columns any more.
+        '''
+        if len(texts) != len(self._hists):
+            return None
+
+        changed = []
+        for icol, text in enumerate(texts):
+            new = len(text)
+            width = self.widths[icol]
+            hist = self._hists[icol]
+            if table_row == self._footer:
+                old = self._footer_widths[icol]
+                if old == new:
+                    continue
+                self._footer_widths[icol] = new
+            else:
+                old = self._cell_widths[icol][table_row]
+                if old == new:
+                    continue
+                self._cell_widths[icol][table_row] = new
+                hist[old] -= 1
+                if hist[old] == 0:
+                    del hist[old]
+                hist[new] += 1
+
+            if new > width:
+                self.widths[icol] = new
+            elif old == width and (table_row == self._footer or old not in hist):
+                # The widest one shrank - next widest.
+                self.widths[icol] = max(max(hist, default=0), self._footer_widths[icol])
+            if self.widths[icol] != width:
+                changed.append(icol)
+
+        return changed
+
+
+#-----------------------------------------------------------------------------------
+def column_type(values):
+    ''' How to sort the TableValues in a column. Empty cells don't count. They sort first except for numbers.
+        number: all numbers
+        date: all ISO dates like 2024-01-31 or 2024-01-31 12:30
+        natural: some have digits so item2 is before item10
+        text: case insensitive
+    '''
+    texts = [value.text for value in values if len(value.text) > 0]
+    if len(texts) == 0:
+        return 'text'
+    if all([value.key[0] == 0 for value in values if len(value.text) > 0]):
+        return 'number'
+    if all([_RE_ISO_DATE.match(text) is not None for text in texts]):
+        return 'date'
+    if any([_RE_DIGITS.search(text) is not None for text in texts]):
+        return 'natural'
+    return 'text'
+
+
+#-----------------------------------------------------------------------------------
+def parse_sort_spec(spec, header):
+    ''' Sort keys from spec like "Status, -Date". Columns are header names or 1-based numbers, - for descending.
+        header is the list of header texts. Returns list of (table_col, asc). Raises ValueError if it's bad.
+    '''
+    names = [h.lower() for h in header]
+    sort_keys = []
+    for part in spec.split(','):
+        part = part.strip()
+        asc = not part.startswith('-')
+        name = part.lstrip('+-').strip()
+        if name.lower() in names:
+            table_col = names.index(name.lower())
+        elif name.isdigit() and 1 <= int(name) <= len(header):
+            table_col = int(name) - 1
+        else:
+            raise ValueError(f'Invalid sort column [{name}]')
+        sort_keys.append((table_col, asc))
+    return sort_keys
+
+
+#-----------------------------------------------------------------------------------
+def _number_key(text):
+    try:
+        return (0, float(text))
+    except ValueError:
+        return (1, text.lower())
+
+
+def _date_key(text):
+    return text.replace('T', ' ')
+
+
+def _natural_key(text):
+    # Empty first, then cells that are numbers in float order, then the rest.
+    if len(text) == 0:
+        return (0,)
+    try:
+        num = float(text)
+        if num == num:
+            return (1, num)
+    except ValueError:
+        pass
+    parts = _RE_DIGITS.split(text.lower())
+    # Split puts the digits at the odd indexes.
+    return (2, tuple([(0, int(part)) if i % 2 == 1 else (1, part) for i, part in enumerate(parts) if len(part) > 0]))
+
+
+def _text_key(text):
+    return text.casefold()
+
+
+_SORT_KEYS = {'number': _number_key, 'date': _date_key, 'natural': _natural_key, 'text': _text_key}
+
+
+#-----------------------------------------------------------------------------------
+def read_csv(fn):
+    ''' Read a csv or tsv file into a TableMatrix. The delimiter is sniffed from the start of the file. '''
+    with open(fn, 'r', newline='', encoding='utf-8-sig') as fp:
+        try:
+            dialect = csv.Sniffer().sniff(fp.read(_CSV_SNIFF), delimiters=',\t;')
+        except csv.Error:
+            dialect = csv.excel_tab if fn.lower().endswith('.tsv') else csv.excel
+        fp.seek(0)
+        rows = [[_csv_cell(cell) for cell in row] for row in csv.reader(fp, dialect)]
+    return TableMatrix('', rows)
+
+
+#-----------------------------------------------------------------------------------
+def write_csv(fn, matrix, footer=False):
+    ''' Write a TableMatrix to a csv file, or tsv if that's the extension. The aggregate footer isn't data so it's
+        only written if footer is True. Returns the number of rows written.
+    '''
+    dialect = csv.excel_tab if fn.lower().endswith('.tsv') else csv.excel
+    end = matrix.num_rows if footer else matrix.body_end()
+    with open(fn, 'w', newline='', encoding='utf-8') as fp:
+        csv.writer(fp, dialect).writerows(matrix.row_texts(irow) for irow in range(end))
+    return end
+
+
+#-----------------------------------------------------------------------------------
+def _csv_cell(text):
+    ''' Make a csv value fit in a table cell. '''
+    return text.replace('\r', '').replace('\n', ' ').replace(DELIM, _DELIM_SUB).strip()
+
+
+#-----------------------------------------------------------------------------------
+def line_changes(old_text, new_text):
+    ''' The edits that make old_text into new_text a line at a time. A run of changed lines is one edit.
+        Returns list of (start, end, text) where start and end are offsets in old_text. Last first so they can be
+        applied in order.
+    '''
+    old_lines = _split_lines(old_text)
+    new_lines = _split_lines(new_text)
+    starts = [0]
+    for line in old_lines:
+        starts.append(starts[-1] + len(line))
+
+    changes = []
+    if len(old_lines) == len(new_lines):
+        irow = 0
+        while irow < len(old_lines):
+            if old_lines[irow] == new_lines[irow]:
+                irow += 1
+                continue
+            end_row = irow + 1
+            while end_row < len(old_lines) and old_lines[end_row] != new_lines[end_row]:
+                end_row += 1
+            changes.append((starts[irow], starts[end_row], ''.join(new_lines[irow:end_row])))
+            irow = end_row
+    else:
+        # Rows added or removed. Everything between the lines that are the same at each end.
+        first = 0
+        while first < min(len(old_lines), len(new_lines)) and old_lines[first] == new_lines[first]:
+            first += 1
+        end_old = len(old_lines)
+        end_new = len(new_lines)
+        while end_old > first and end_new > first and old_lines[end_old - 1] == new_lines[end_new - 1]:
+            end_old -= 1
+            end_new -= 1
+        changes.append((starts[first], starts[end_old], ''.join(new_lines[first:end_new])))
+
+    changes.reverse()
+    return changes
+
+
+#-----------------------------------------------------------------------------------
+def replace_lines(view, edit, region, old_text, new_text):
+    ''' Make region, which is old_text, into new_text by replacing only the lines that are different. '''
+    for start, end, text in line_changes(old_text, new_text):
+        view.replace(edit, sublime.Region(region.a + start, region.a + end), text)
+
+
+#-----------------------------------------------------------------------------------
+def _split_lines(text):
+    ''' Lines with their newlines. Split on newline only, not all the things splitlines() does. '''
+    lines = [line + '\n' for line in text.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    if len(lines[-1]) == 0:
+        lines.pop()
+    return lines
+
+
+#-----------------------------------------------------------------------------------
+def _count_decimals(text):
+    ''' Digits after the point in a number. '''
+    point = text.find('.')
+    if point < 0 or 'e' in text.lower():
+        return 0
+    return len(text) - point - 1
+
+
+def _format_number(num, decimals):
+    return f'{num:.{decimals}f}'
+
+
+#-----------------------------------------------------------------------------------
+def split_row(line):
+    ''' Cell texts in a table line. '''
+    texts = []
+    parts = line.split(DELIM)
+
+    # Rows honor empty cells except for the last one. Whitespace cells are converted to empty.
+    for i in range(1, len(parts)):
+        s = parts[i].strip()
+        if i < len(parts) - 1 or len(s) > 0:
+            texts.append(s)
+    return texts
+
+
+#-----------------------------------------------------------------------------------
+def format_row(texts, column_widths):
+    ''' One line of formatted table. '''
+    row_text = []
+    for icol, text in enumerate(texts):
+        column_width = column_widths[icol] + 2  # add pad
+        row_text.append((' ' + text).ljust(column_width))
+    return DELIM + DELIM.join(row_text) + DELIM
+
+
+#-----------------------------------------------------------------------------------
+def _cell_col(line_text, caret_col, column_widths, line_len):
+    ''' Where caret_col in unformatted line_text ends up after format_row(). Same place in the same cell. '''
+    table_col = line_text.count(DELIM, 0, caret_col) - 1
+    if table_col < 0:
+        return 0
+    if table_col >= len(column_widths):
+        return line_len
+
+    cell_start = -1
+    for _ in range(table_col + 1):
+        cell_start = line_text.find(DELIM, cell_start + 1)
+    offset = len(line_text[cell_start + 1:caret_col].lstrip())
+    new_start = 1 + sum([column_widths[icol] + 3 for icol in range(table_col)])
+    return new_start + min(1 + offset, column_widths[table_col] + 2)
+
+
 #-----------------------------------------------------------------------------------
 class TableCommand(sublime_plugin.TextCommand):
     ''' Common table command stuff. '''
@@ -163,15 +575,16 @@ class TableCommand(sublime_plugin.TextCommand):
 
     def start(self):
         ''' Collect the table the caret is in. '''
+        _auto_fit.pop(self.view.id(), None)  # any row can change
         self.region = self.get_table_region()
         text = self.view.substr(self.region) if self.region is not None else ''
         self.matrix = TableMatrix(text)  # create matrix from table text
 
     def finish(self, edit):
-        ''' Display the table. '''
+        ''' Display the table. Only the lines that changed are replaced. '''
         if self.region is not None:
             output = self.matrix.format()
-            self.view.replace(edit, self.region, output)
+            replace_lines(self.view, edit, self.region, self.view.substr(self.region), output)
 
     def is_table(self, point):
         ''' True if the point is in a table. '''
@@ -185,62 +598,101 @@ class TableCommand(sublime_plugin.TextCommand):
         ''' Get the region for the current selected table, including the header.
             Returns None if it's not a table. Also finds row/column in the table.
         '''
-        region = None
         v = self.view
 
         caret = self.get_single_caret(v)
-        if caret is None:
-            return None
-
-        caret_row = v.rowcol(caret)[0]
-        caret_col = v.rowcol(caret)[1]
-
-        # Find the first row.
-        start_row = caret_row
-        end_row = -1
-        current_row = start_row
-        done = False
-        while not done:
-            point = v.text_point(current_row, 0)
-            if self.is_table(point):
-                start_row = current_row
-                current_row -= 1
-            else:
-                done = True
-
-        # Find the last row.
-        current_row = caret_row
-        done = False
-        while not done:
-            point = v.text_point(current_row, 0)
-            if point >= len(v):
-                done = True
-            else:
-                if self.is_table(point):
-                    end_row = current_row
-                    current_row += 1
-                else:
-                    done = True
+        region = self.find_table(caret) if caret is not None else None
 
-        # Get the region and table row/col selected.
-        if start_row != -1 and end_row != -1:
-            start_point = v.text_point(start_row, 0)
-            end_point = v.full_line(v.text_point(end_row, 0)).b
-            region = sublime.Region(start_point, end_point)
-
-            # Calc the table row.
-            self.table_row_sel = caret_row - start_row
+        # Get the table row/col selected.
+        if region is not None:
+            caret_row, caret_col = v.rowcol(caret)
+            self.table_row_sel = caret_row - v.rowcol(region.a)[0]
 
             # Calc the table column by counting delimiters between start and caret.
             sel_line_text = v.substr(v.full_line(caret))
             self.table_col_sel = sel_line_text.count(DELIM, 0, caret_col) - 1 # correct count to columns
         else:
-            region = None
             self.table_row_sel = None
             self.table_col_sel = None
 
         return region
 
+    def find_table(self, point):
+        ''' Region of the table containing point, or None. Works from the text around point so it's one read for
+            most tables, and one scope check to make sure it's not in a raw block. Cached until the view changes.
+        '''
+        v = self.view
+        change_count = v.change_count()
+        cached = _table_regions.get(v.id())
+        if cached is None or cached[0] != change_count:
+            cached = (change_count, [])
+            _table_regions[v.id()] = cached
+        for region in cached[1]:
+            if region.a <= point < region.b:
+                return region
+
+        size = v.size()
+        chunk = _TABLE_CHUNK
+        while True:
+            lo = v.line(max(0, point - chunk)).a
+            hi = v.line(min(size, point + chunk)).b
+            text = v.substr(sublime.Region(lo, hi))
+            rel = point - lo
+            line_start = text.rfind('\n', 0, rel) + 1
+            line_end = text.find('\n', rel)
+            if line_end < 0:
+                line_end = len(text)
+
+            # Back to the blank line before, forward to the one after.
+            block_start = None
+            for m in _RE_BLANK_LINE_NL.finditer(text, 0, line_start):
+                block_start = m.end()
+            if block_start is None and lo == 0:
+                block_start = 0
+            m = _RE_BLANK_LINE.search(text, line_end + 1)
+            block_end = m.start() if m is not None and (m.end() < len(text) or hi == size) else None
+            if block_end is None and hi == size:
+                block_end = len(text)
+
+            if block_start is not None and block_end is not None:
+                break
+            if lo == 0 and hi == size:
+                return None  # caret line is blank
+            chunk *= 4
+
+        # The table is from the first | line in the block to the end.
+        if len(text[line_start:line_end].strip()) == 0:
+            return None
+        m = _RE_TABLE_START.search(text, block_start, block_end)
+        if m is None or m.start() > line_start:
+            return None
+        region = sublime.Region(lo + m.start(), lo + block_end)
+        if not self.is_table(region.a):
+            return None
+
+        cached[1].append(region)
+        return region
+
+    def find_tables(self, text):
+        ''' Regions of all the tables in the view, in order. text is the whole view. Also primes the find_table() cache. '''
+        v = self.view
+        regions = []
+        pos = 0
+        while True:
+            m = _RE_TABLE_START.search(text, pos)
+            if m is None:
+                break
+            e = _RE_BLANK_LINE.search(text, m.start())
+            region = sublime.Region(m.start(), e.start())
+            if self.is_table(region.a):
+                regions.append(region)
+            if e.end() >= len(text):
+                break
+            pos = e.end()
+
+        _table_regions[v.id()] = (v.change_count(), list(regions))
+        return regions
+
     def get_single_caret(self, view):
         '''Get current caret position for one only region. If multiples, return None.'''
         if len(view.sel()) == 0:
@@ -261,11 +713,133 @@ class TableFitCommand(TableCommand):
     def run(self, edit):
         super().start()
         # do work
-        # ... no work other than formatting
+        self.matrix.update_footer()
         # finish
         super().finish(edit)
 
 
+#-----------------------------------------------------------------------------------
+class TableFitAllCommand(TableCommand):
+    ''' Fit every table in the view. One edit so one undo. '''
+
+    def __init__(self, view):
+        super().__init__(view)
+
+    def is_visible(self):
+        return True
+
+    def run(self, edit):
+        v = self.view
+        _auto_fit.pop(v.id(), None)
+        text = v.substr(sublime.Region(0, v.size()))
+        # Bottom up so the regions above stay put.
+        for region in reversed(self.find_tables(text)):
+            table_text = text[region.a:region.b]
+            matrix = TableMatrix(table_text)
+            matrix.update_footer()
+            replace_lines(v, edit, region, table_text, matrix.format())
+
+
+#-----------------------------------------------------------------------------------
+class TableAutoFitCommand(TableCommand):
+    ''' Refit the table at the caret after an edit. Run by TableEvent when table_auto_fit is set. The widths are kept
+        between edits so a change to one row doesn't need the table reparsed, and if no column width changed only that
+        row is rewritten. The kept state is only used if the rest of the table is still what the last fit left.
+    '''
+
+    def __init__(self, view):
+        super().__init__(view)
+
+    def is_visible(self):
+        return False
+
+    def run(self, edit):
+        v = self.view
+        caret = self.get_single_caret(v)
+        region = self.find_table(caret) if caret is not None else None
+        if region is None:
+            _auto_fit.pop(v.id(), None)
+            return
+
+        first_row = v.rowcol(region.a)[0]
+        caret_row, caret_col = v.rowcol(caret)
+        table_row = caret_row - first_row
+        num_rows = v.rowcol(region.b - 1)[0] - first_row + 1
+        line_region = v.line(caret)
+        line_text = v.substr(line_region)
+        texts = split_row(line_text)
+        table_text = v.substr(region)
+
+        # Good for one edit to the row at the caret since the last fit.
+        changed = None
+        state = _auto_fit.get(v.id())
+        if (state is not None and state[0] == v.change_count() - 1 and state[1] == region.a and
+                state[2].num_rows == num_rows and
+                _only_row_changed(state[4], table_text, line_region.a - region.a, line_region.b - region.a)):
+            matrix, widths = state[2], state[3]
+            changed = widths.update_row(table_row, texts)
+            if changed is not None:
+                matrix.set_row(table_row, texts)
+
+        if changed is None:
+            # Start over.
+            matrix = TableMatrix(v.substr(region))
+            widths = TableWidths(matrix)
+            texts = matrix.row_texts(table_row)
+
+        output = format_row(texts, widths.widths)
+        if changed is not None and len(changed) == 0:
+            # Just this row.
+            if output != line_text:
+                v.replace(edit, line_region, output)
+            new_text = (table_text[:line_region.a - region.a] + output + table_text[line_region.b - region.a:])
+        else:
+            # Only the rows that are different.
+            new_lines = [format_row(matrix.row_texts(irow), widths.widths) for irow in range(matrix.num_rows)]
+            new_text = '\n'.join(new_lines) + ('\n' if table_text.endswith('\n') else '')
+            replace_lines(v, edit, region, table_text, new_text)
+
+        # Put the caret back in the same place in the cell.
+        point = v.text_point(caret_row, _cell_col(line_text, caret_col, widths.widths, len(output)))
+        v.sel().clear()
+        v.sel().add(sublime.Region(point, point))
+
+        _auto_fit[v.id()] = (v.change_count(), region.a, matrix, widths, new_text)
+
+
+#-----------------------------------------------------------------------------------
+def _only_row_changed(old_text, text, line_start, line_end):
+    ''' True if text is old_text with only the line at line_start:line_end in text different. '''
+    suffix_len = len(text) - line_end
+    old_line_end = len(old_text) - suffix_len
+    return (old_line_end >= line_start and
+            old_text[:line_start] == text[:line_start] and
+            old_text[old_line_end:] == text[line_end:] and
+            '\n' not in old_text[line_start:old_line_end])
+
+
+#-----------------------------------------------------------------------------------
+class TableEvent(sublime_plugin.EventListener):
+    ''' Live table fitting. '''
+
+    def on_text_command(self, view, command_name, args):
+        if command_name in _NO_AUTO_FIT_COMMANDS:
+            _no_auto_fit.add(view.id())
+
+    def on_post_text_command(self, view, command_name, args):
+        _no_auto_fit.discard(view.id())
+
+    def on_modified(self, view):
+        if view.id() in _no_auto_fit or view.syntax() is None or view.syntax().name != 'Notr':
+            return
+        state = _auto_fit.get(view.id())
+        if state is not None and state[0] == view.change_count():
+            return  # the fit itself
+        settings = sublime.load_settings(_SETTINGS_FN)
+        if settings.get('table_auto_fit', False):
+            view.run_command('table_auto_fit')
+
+
 #-----------------------------------------------------------------------------------
 class TableSortColCommand(TableCommand):
 
@@ -280,7 +854,161 @@ class TableSortColCommand(TableCommand):
         super().finish(edit)
         
 
-#-------------------------------------------------------    ----------------------------
+#-----------------------------------------------------------------------------------
+class TableSortCommand(TableCommand):
+    ''' Sort on one or more columns. spec is like "Status, -Date" - see parse_sort_spec(). '''
+
+    def __init__(self, view):
+        super().__init__(view)
+
+    def run(self, edit, spec):
+        super().start()
+        # do work
+        try:
+            header = self.matrix.row_texts(0) if self.matrix.num_rows > 0 else []
+            self.matrix.sort_columns(parse_sort_spec(spec, header))
+        except ValueError as e:
+            sublime.status_message(str(e))
+            return
+        # finish
+        super().finish(edit)
+
+    def input(self, args):
+        if 'spec' not in args:
+            return TableSortInputHandler()
+        return None
+
+
+#-----------------------------------------------------------------------------------
+class TableSortInputHandler(sublime_plugin.TextInputHandler):
+
+    def name(self):
+        return 'spec'
+
+    def placeholder(self):
+        return 'Columns by name or number, - for descending e.g. Status, -Date'
+
+
+#-----------------------------------------------------------------------------------
+class TableAggregateCommand(TableCommand):
+    ''' Add func of the caret column, or all number columns, to the footer. table_fit keeps it up to date. '''
+
+    def __init__(self, view):
+        super().__init__(view)
+
+    def run(self, edit, func='sum', all_cols=False):
+        super().start()
+        # do work
+        if func not in AGGREGATES:
+            sublime.status_message(f'Invalid aggregate [{func}]')
+            return
+        cols = self.matrix.numeric_columns() if all_cols else [self.table_col_sel]
+        for table_col in cols:
+            if self.matrix.validate_col_sel(table_col):
+                self.matrix.set_footer(table_col, func)
+        self.matrix.update_footer()
+        # finish
+        super().finish(edit)
+
+
+#-----------------------------------------------------------------------------------
+class TableSummaryCommand(TableCommand):
+    ''' Show the aggregates of the caret column, or all number columns, in a popup. '''
+
+    def __init__(self, view):
+        super().__init__(view)
+
+    def run(self, edit, all_cols=False):
+        super().start()
+        cols = self.matrix.numeric_columns() if all_cols else [self.table_col_sel]
+        header = self.matrix.row_texts(0) if self.matrix.num_rows > 0 else []
+
+        rows = []
+        for table_col in cols:
+            agg = self.matrix.aggregate(table_col) if self.matrix.validate_col_sel(table_col) else None
+            if agg is not None:
+                cells = ''.join([f'<td>{func}={agg[func]}</td>' for func in AGGREGATES])
+                rows.append(f'<tr><td><b>{html.escape(header[table_col])}</b></td>{cells}</tr>')
+
+        if len(rows) == 0:
+            sublime.status_message('No numbers')
+            return
+        content = f'<body><style>td {{ padding-right: 1em; }}</style><table>{"".join(rows)}</table></body>'
+        self.view.show_popup(content, location=self.get_single_caret(self.view), max_width=800)
+
+
+#-----------------------------------------------------------------------------------
+class TableImportCsvCommand(sublime_plugin.TextCommand):
+    ''' Insert a csv or tsv file as a table after the caret line, with blank lines around it so it stays a table. '''
+
+    def run(self, edit, fn):
+        v = self.view
+        fn = _csv_path(v, fn)
+        try:
+            matrix = read_csv(fn)
+        except (OSError, UnicodeDecodeError, csv.Error) as e:
+            sublime.status_message(f'Can\'t import {fn}: {e}')
+            return
+
+        line = v.line(v.sel()[0].b if len(v.sel()) > 0 else v.size())
+        if len(v.substr(line).strip()) > 0:
+            # End the caret line then a blank line.
+            v.insert(edit, line.b, '\n\n' + matrix.format())
+        else:
+            # In a blank line. Needs one before too unless at the top.
+            before = '\n' if line.a > 0 and len(v.substr(v.line(line.a - 1)).strip()) > 0 else ''
+            v.insert(edit, line.a, before + matrix.format())
+
+    def input(self, args):
+        if 'fn' not in args:
+            return TableCsvInputHandler()
+        return None
+
+
+#-----------------------------------------------------------------------------------
+class TableExportCsvCommand(TableCommand):
+    ''' Write the table at the caret to a csv or tsv file. '''
+
+    def __init__(self, view):
+        super().__init__(view)
+
+    def run(self, edit, fn, footer=False):
+        super().start()
+        if self.region is None:
+            return
+        fn = _csv_path(self.view, fn)
+        try:
+            num_rows = write_csv(fn, self.matrix, footer)
+            sublime.status_message(f'Exported {num_rows} rows to {fn}')
+        except OSError as e:
+            sublime.status_message(f'Can\'t export {fn}: {e}')
+
+    def input(self, args):
+        if 'fn' not in args:
+            return TableCsvInputHandler()
+        return None
+
+
+#-----------------------------------------------------------------------------------
+class TableCsvInputHandler(sublime_plugin.TextInputHandler):
+
+    def name(self):
+        return 'fn'
+
+    def placeholder(self):
+        return 'Csv or tsv file, relative to this file'
+
+
+#-----------------------------------------------------------------------------------
+def _csv_path(view, fn):
+    ''' Relative paths are from the view file. '''
+    fn = os.path.expanduser(fn.strip())
+    if not os.path.isabs(fn) and view.file_name() is not None:
+        fn = os.path.join(os.path.dirname(view.file_name()), fn)
+    return fn
+
+
+#-----------------------------------------------------------------------------------
 class TableInsertColCommand(TableCommand):
 
     def __init__(self, view):
@@ -294,6 +1022,21 @@ class TableInsertColCommand(TableCommand):
         super().finish(edit)
 
 
+#-----------------------------------------------------------------------------------
+class TableMoveColCommand(TableCommand):
+
+    def __init__(self, view):
+        super().__init__(view)
+
+    def run(self, edit, where):
+        super().start()
+        # do work
+        new_col = self.table_col_sel + (1 if where == 'right' else -1)
+        self.matrix.move_column(self.table_col_sel, new_col)
+        # finish
+        super().finish(edit)
+
+
 #-----------------------------------------------------------------------------------
 class TableDeleteColCommand(TableCommand):
 
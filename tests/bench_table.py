@@ -0,0 +1,182 @@
+'''
+Table benchmarks. Not part of the unit tests, run directly:
+
+    python tests/bench_table.py [out_fn]
+
+Times the TableMatrix operations, and finding the table through the emulated view, for tables of different shapes.
+Results are printed and written as json, by default to tests/out/bench_table.json, to compare across versions.
+'''
+
+import sys
+import os
+import json
+import time
+import random
+import platform
+
+# Set up the sublime emulation environment.
+import emu_sublime_api as emu
+
+# Import the code under test.
+cut_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if cut_path not in sys.path: sys.path.insert(0, cut_path)
+import table
+
+
+# (rows, cols, ragged)
+SHAPES = [
+    (10, 10, False),
+    (1000, 10, False),
+    (1000, 10, True),
+    (10000, 20, False),
+    (10000, 20, True),
+    (200000, 20, False),
+    (200000, 20, True),
+]
+
+# Operations in the order they're reported.
+OPS = ('construct', 'format', 'sort_num', 'sort_text', 'insert_col', 'delete_col', 'get_table_region')
+
+
+#-----------------------------------------------------------------------------------
+def make_table_text(nrows, ncols, seed=0, ragged=False):
+    ''' Header plus nrows of mixed numbers and text. Ragged rows are missing some cells at the end. '''
+    rnd = random.Random(seed)
+    lines = ['|' + '|'.join([f' Col{c} ' for c in range(ncols)]) + '|']
+    for _ in range(nrows):
+        cells = []
+        for c in range(rnd.randint(1, ncols) if ragged else ncols):
+            if c % 2 == 1:
+                cells.append(str(rnd.randint(0, 1000000)))
+            else:
+                cells.append(''.join(rnd.choice('abcdefghij') for _ in range(rnd.randint(0, 10))))
+        lines.append('| ' + ' | '.join(cells) + ' |')
+    return '\n'.join(lines) + '\n'
+
+
+#-----------------------------------------------------------------------------------
+def time_it(func, reps=3):
+    ''' Best of reps. func does its own setup and returns the time of the part of interest. '''
+    return min([func() for _ in range(reps)])
+
+
+#-----------------------------------------------------------------------------------
+def bench_construct(text):
+    def _construct():
+        start = time.perf_counter()
+        table.TableMatrix(text)
+        return time.perf_counter() - start
+    return _construct
+
+
+#-----------------------------------------------------------------------------------
+def bench_matrix_op(text, op):
+    ''' Time of op on a fresh TableMatrix. '''
+    def _op():
+        matrix = table.TableMatrix(text)
+        start = time.perf_counter()
+        op(matrix)
+        return time.perf_counter() - start
+    return _op
+
+
+#-----------------------------------------------------------------------------------
+def bench_get_table_region(text):
+    ''' Caret in the middle of the table, between some paragraphs. Not cached. '''
+    view = emu.View(10)
+    view.set_window(emu.Window(20))
+    view.insert(None, 0, 'para\n\n' + text + '\nafter\n')
+    view.scope_name = lambda point: 'text.notr meta.table'
+    point = 6 + len(text) // 2
+    sel = emu.Selection(view.id())
+    sel.add(emu.Region(point, point))
+    view.set_selection(sel)
+    cmd = table.TableFitCommand(view)
+
+    def _get():
+        table._table_regions.clear()
+        start = time.perf_counter()
+        cmd.get_table_region()
+        return time.perf_counter() - start
+    return _get
+
+
+#-----------------------------------------------------------------------------------
+def bench_shape(nrows, ncols, ragged):
+    ''' All the ops for one shape. Returns dict of k:op v:seconds. '''
+    text = make_table_text(nrows, ncols, ragged=ragged)
+    mid = ncols // 2
+    funcs = {
+        'construct': bench_construct(text),
+        'format': bench_matrix_op(text, lambda m: m.format()),
+        'sort_num': bench_matrix_op(text, lambda m: m.sort_column(1, True)),
+        'sort_text': bench_matrix_op(text, lambda m: m.sort_column(0, True)),
+        'insert_col': bench_matrix_op(text, lambda m: m.insert_column(mid)),
+        'delete_col': bench_matrix_op(text, lambda m: m.delete_column(mid)),
+        'get_table_region': bench_get_table_region(text),
+    }
+    reps = 3 if nrows * ncols < 1000000 else 1
+    return {op: time_it(funcs[op], reps) for op in OPS}
+
+
+#-----------------------------------------------------------------------------------
+def bench_fit_all(ntables, nrows):
+    ''' Fit all vs fit each one at the caret, like running table_fit on every table. '''
+    text = '\n'.join([f'## Table {i}\n\n' + make_table_text(nrows, 5, i) for i in range(ntables)])
+
+    def _make_view():
+        view = emu.View(10)
+        view.set_window(emu.Window(20))
+        view.insert(None, 0, text)
+        view.scope_name = lambda point: 'text.notr meta.table'
+        return view
+
+    def _fit_all():
+        view = _make_view()
+        start = time.perf_counter()
+        table.TableFitAllCommand(view).run(None)
+        return time.perf_counter() - start
+
+    def _fit_each():
+        view = _make_view()
+        start = time.perf_counter()
+        cmd = table.TableFitCommand(view)
+        for i in range(ntables):
+            point = view.substr(emu.Region(0, view.size())).index(f'## Table {i}\n') + len(f'## Table {i}\n\n')
+            sel = emu.Selection(view.id())
+            sel.add(emu.Region(point, point))
+            view.set_selection(sel)
+            cmd.run(None)
+        return time.perf_counter() - start
+
+    return time_it(_fit_all), time_it(_fit_each, 1)
+
+
+#-----------------------------------------------------------------------------------
+def main():
+    out_fn = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), 'out', 'bench_table.json')
+
+    results = []
+    print(f'{"shape":>20}' + ''.join([f'{op:>17}' for op in OPS]) + '   (ms)')
+    for nrows, ncols, ragged in SHAPES:
+        times = bench_shape(nrows, ncols, ragged)
+        shape = f'{nrows}x{ncols}{" ragged" if ragged else ""}'
+        print(f'{shape:>20}' + ''.join([f'{times[op] * 1000:17.2f}' for op in OPS]))
+        results.append({'rows': nrows, 'cols': ncols, 'ragged': ragged, 'times': times})
+
+    fit_all, fit_each = bench_fit_all(1000, 10)
+    print(f'1000 tables: fit all {fit_all * 1000:.1f} ms  fit each {fit_each * 1000:.1f} ms')
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_fn)), exist_ok=True)
+    with open(out_fn, 'w') as fp:
+        json.dump({
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'shapes': results,
+            'fit_all': {'tables': 1000, 'rows': 10, 'fit_all': fit_all, 'fit_each': fit_each},
+        }, fp, indent=4)
+    print(f'Results in {out_fn}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 import json
 import time
@@ -96,12 +97,12 @@ class Command():
 
 class WindowCommand(Command):
     def __init__(self, window):
-        self._window = window
+        self.window = window
 
 
 class TextCommand(Command):
     def __init__(self, view):
-        self._view = view
+        self.view = view
 
 
 class EventListener():
@@ -110,7 +111,7 @@ class EventListener():
 
 class ViewEventListener():
     def __init__(self, view):
-        self._view = view
+        self.view = view
 
 
 class ZipImporter:
@@ -125,6 +126,47 @@ TRANSIENT = 4
 IGNORECASE = 2
 LITERAL = 1
 
+HOVER_TEXT = 1
+HIDE_ON_MOUSE_MOVE_AWAY = 2
+
+KIND_NAVIGATION = (5, 'n', 'Navigation')
+INHIBIT_WORD_COMPLETIONS = 8
+INHIBIT_REORDER = 128
+
+
+class CompletionItem():
+    def __init__(self, trigger, annotation='', completion='', completion_format=0, kind=None, details=''):
+        self.trigger = trigger
+        self.annotation = annotation
+        self.completion = completion
+        self.kind = kind
+        self.details = details
+        self.command = None
+        self.args = None
+
+    @classmethod
+    def command_completion(cls, trigger, command, args=None, annotation='', kind=None, details=''):
+        item = cls(trigger, annotation, kind=kind, details=details)
+        item.command = command
+        item.args = args
+        return item
+
+
+class CompletionList():
+    def __init__(self, completions=None, flags=0):
+        self.completions = completions
+        self.flags = flags
+
+
+class RegionFlags():
+    NONE = 0
+    DRAW_EMPTY = 1
+    HIDE_ON_MINIMAP = 2
+    DRAW_NO_FILL = 32
+    DRAW_NO_OUTLINE = 256
+    DRAW_SOLID_UNDERLINE = 512
+    DRAW_STIPPLED_UNDERLINE = 1024
+
 
 #------------------------------------------------------------
 #---------------- sublime.functions() -----------------------
@@ -185,10 +227,18 @@ def set_timeout(f, timeout_ms=0):
     time.sleep(float(timeout_ms) / 1000.0)
     f()
 
+def set_timeout_async(f, timeout_ms=0):
+    # Runs on the async thread in ST. Here it's just run now.
+    set_timeout(f, timeout_ms)
+
 def active_window():
     global _active_window
     return _active_window
 
+def windows():
+    global _active_window
+    return [_active_window] if _active_window is not None else []
+
 
 #------------------------------------------------------------
 #---------------- sublime.View ------------------------------
@@ -204,8 +254,9 @@ class View():
         self._buffer = ''
         self._selection = Selection(view_id)
         self._scratch = False
-        self._regions = []
+        self._regions = {}  # k:key v:[Region]
         self._syntax = None
+        self._change_count = 0
 
     def __len__(self):
         return len(self._buffer)
@@ -231,6 +282,12 @@ class View():
     def is_loading(self):
         return False
 
+    def is_valid(self):
+        return self._view_id is not None
+
+    def change_count(self):
+        return self._change_count
+
     def close(self):
         _emu_trace('View.close()')
         return True
@@ -274,61 +331,50 @@ class View():
     def rowcol(self, point):
         # Get row and column for the point.
         point = self._validate(point).a
-        row = 0
-        col = 0
-        for index in range(point):
-            if self._buffer[index] == '\n':
-                row += 1
-                col = 0
-            else:
-                col += 1
+        row = self._buffer.count('\n', 0, point)
+        col = point - (self._buffer.rfind('\n', 0, point) + 1)
         return (row, col)
 
     def text_point(self, row, col):
-        # Calculates the character offset of the given, 0-based, row and col
-        point = 0
-        row_i = 0
-        col_i = 0
-        found = False
-
-        for index in range(len(self._buffer)):
-            if row_i == row and col_i == col:
-                found = True
-                break
-            else: # bump
-                if self._buffer[index] == '\n':
-                    point += 1
-                    row_i += 1
-                    col_i = 0
-                else:
-                    point += 1
-                    col_i += 1
+        # Calculates the character offset of the given, 0-based, row and col. Out of range is the end.
+        buff_len = len(self._buffer)
+        line_start = 0
+        for _ in range(row):
+            line_start = self._buffer.find('\n', line_start) + 1
+            if line_start == 0:
+                return buff_len
 
-        return point
+        line_end = self._buffer.find('\n', line_start)
+        if line_end < 0:
+            line_end = buff_len
+        return line_start + col if line_start + col <= line_end else buff_len
 
     #------------ Find ops ---------------------------
 
     def find(self, pattern, start_pt, flags=0):
-        start_pt = self._validate(start_pt).a
-        if flags != 0:
+        # Regex unless LITERAL, like ST.
+        start_pt = self._validate(start_pt, allow_empty=True).a
+        if flags & ~(LITERAL | IGNORECASE) != 0:
             raise NotImplementedError('args')
 
-        pos = self._buffer.find(pattern, start_pt)
-        return Region(pos, pos + len(pattern)) if pos >= 0 else None
+        if flags & LITERAL:
+            pattern = re.escape(pattern)
+        m = re.compile(pattern, re.IGNORECASE if flags & IGNORECASE else 0).search(self._buffer, start_pt)
+        return Region(m.start(), m.end()) if m is not None else None
 
     def find_all(self, pattern, flags=0, fmt=None, extractions=None):
         regions = []
         ind = 0
 
-        if flags != 0 or fmt is not None or extractions is not None:
+        if fmt is not None or extractions is not None:
             raise NotImplementedError('args')
 
         done = False
         while not done:
-            region = self.find(pattern, ind, flags)
+            region = self.find(pattern, ind, flags) if ind <= len(self._buffer) else None
             if region is not None:
                 regions.append(region)
-                ind = region.b + 1
+                ind = max(region.b, region.a + 1)
             else:
                 done = True
 
@@ -337,6 +383,8 @@ class View():
     def substr(self, x):
         # The char at the Point or within the Region provided.
         region = self._validate(x)
+        if not isinstance(x, Region):
+            return self._buffer[region.a:region.a + 1]
         return self._buffer[region.a:region.b]
 
     def word(self, x):
@@ -359,11 +407,13 @@ class View():
     def insert(self, edit, point, text):
         point = self._validate(point, allow_empty=True).a # allow insert in empty
         self._buffer = self._buffer[:point] + text + self._buffer[point:]
+        self._change_count += 1
         return len(text)
 
     def replace(self, edit, region, text):
         region = self._validate(region)
         self._buffer = self._buffer[:region.a] + text + self._buffer[region.b:]
+        self._change_count += 1
         return len(text)
 
     #------------------- Utilities -------------------
@@ -382,14 +432,17 @@ class View():
         raise NotImplementedError()
 
     def add_regions(self, key, regions, scope="", icon="", flags=0):
-        # self._regions.extend(regions) # key
-        raise NotImplementedError()
+        self._regions[key] = list(regions)
 
     def get_regions(self, key):
-        raise NotImplementedError()
+        return list(self._regions.get(key, []))
 
     def erase_regions(self, key):
-        raise NotImplementedError()
+        self._regions.pop(key, None)
+
+    def visible_region(self):
+        # Everything is visible. Tests can replace this to emulate scrolling.
+        return Region(0, len(self._buffer))
 
     #--------- Public hooks for emulation ------------
 
@@ -407,14 +460,14 @@ class View():
     def _validate(self, x, allow_empty=False):
         '''
         Checks arg for validity otherwise throws.
-        Returns a valid ordered Region within 0 to max_val inclusive.
+        Returns a valid ordered Region within 0 to max_val inclusive. Like ST, the end of the buffer is valid.
         '''
         if self._buffer is None:
             raise ValueError('_buffer is None')
         if not allow_empty and len(self._buffer) == 0:
             raise ValueError('_buffer is empty')
 
-        max_val = max(0, len(self._buffer) - 1)
+        max_val = len(self._buffer)
         if isinstance(x, Region):
             if x.a > max_val or x.b > max_val or x.a < 0 or x.b < 0:
                 raise ValueError('region out of range')
@@ -455,7 +508,7 @@ class View():
         done = False
         while not done:
             if ind >= buff_len:
-                region.b = ind - 1
+                region.b = buff_len
                 done = True
             elif self._buffer[ind] == '\n':
                 region.b = ind + 1 if mode == 'full_line' else ind
@@ -510,6 +563,10 @@ class Window():
         view.set_name(name)
         return view
 
+    def find_output_panel(self, name):
+        _emu_trace(f'Window.find_output_panel(): {name}')
+        return None
+
     def project_file_name(self):
         return 'StPluginTester.sublime-project'
 
@@ -525,7 +582,7 @@ class Window():
         if flags != 0 or syntax != '':
             raise NotImplementedError('args')
 
-        view = View(_get_next_id)
+        view = View(_get_next_id())
         view._file_name = ''
         view._window = self
         self._views.append(view)
@@ -536,7 +593,7 @@ class Window():
             raise NotImplementedError('args')
 
         with open(fname, 'r') as file:
-            view = View(_get_next_id)
+            view = View(_get_next_id())
             view._file_name = fname  # hack
             view._window = self
             view.insert(None, 0, file.read())
@@ -767,12 +824,10 @@ class Settings():
 #------------------------------------------------------------
 
 class Syntax():
+    # Attributes like ST.
 
     def __init__(self, path, name, hidden, scope):
-        self._path = path
-        self._name = name
-        self._hidden = hidden
-        self._scope = scope
-
-    def name(self):
-        return self._name
+        self.path = path
+        self.name = name
+        self.hidden = hidden
+        self.scope = scope
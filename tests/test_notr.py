@@ -1,26 +1,96 @@
 import sys
 import os
-import sublime
+import json
+import types
+import shutil
+import tempfile
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 # Set up the sublime emulation environment.
 import emu_sublime_api as emu
 
-# Import the code under test.
+# Import the code under test. It's a package in ST so use relative imports. Packages live in a temp dir here,
+# with the demo project where it expects to be.
 cut_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-if cut_path not in sys.path: sys.path.insert(0, cut_path)
-import notr
+_packages_dir = os.path.join(tempfile.mkdtemp(), 'Sublime Text', 'Packages')
+os.makedirs(_packages_dir)
+shutil.copytree(os.path.join(cut_path, 'example'), os.path.join(_packages_dir, 'Notr', 'example'))
+os.environ['APPDATA'] = os.path.dirname(os.path.dirname(_packages_dir))
+emu.packages_path = lambda: _packages_dir
+
+_package = types.ModuleType('Notr')
+_package.__path__ = [cut_path]
+sys.modules['Notr'] = _package
+from Notr import notr
+from Notr import sbot_common as sc
+
+
+#-----------------------------------------------------------------------------------
+def tearDownModule():
+    shutil.rmtree(os.path.dirname(os.path.dirname(_packages_dir)))
 
 
 #-----------------------------------------------------------------------------------
 class TestNotr(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.window = emu.Window(900)
+        self.view = emu.View(901)
+        self.view.set_window(self.window)
+        emu._active_window = self.window
+
+        # Fresh module state.
+        notr._store = {}
+        notr._current_project = None
+        notr._targets = []
+        notr._refs = []
+        notr._user_errors = []
+        notr._index_cache.clear()
+        notr._subscribers.clear()
+        notr._fixed_hl_coverage.clear()
+
+        # A little project.
+        self.tmp_dir = tempfile.mkdtemp()
+        self.write_ntr('index.ntr', ['# Index section [tag1]', 'Hello there.', '<*page#Page section>'])
+        self.write_ntr('page.ntr', ['# Page section [tag2]', 'See <*nowhere>.', '<*index#Index section>'])
+        self.project_fn = self.write_project('test.nproj', 'index.ntr')
+
+        emu.set_settings({
+            "project_files": [self.project_fn],
+            "sort_tags_alpha": True,
+            "mru_size": 5,
+            "fixed_hl_whole_word": True,
+        })
+
+        patcher = patch.object(sc, 'get_store_fn', return_value=os.path.join(self.tmp_dir, 'Notr.store'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def tearDown(self):
-        pass
+        shutil.rmtree(self.tmp_dir)
+
+    #------------------------------------------------------------
+    def write_ntr(self, fn, lines):
+        with open(os.path.join(self.tmp_dir, fn), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def write_project(self, fn, index_fn):
+        project_fn = os.path.join(self.tmp_dir, fn)
+        with open(project_fn, 'w') as f:
+            json.dump({'notr_index': os.path.join(self.tmp_dir, index_fn), 'notr_paths': [self.tmp_dir],
+                       'fixed_hl': [['Hello'], [], []]}, f)
+        return project_fn
+
+    def make_view(self, view_id, text):
+        ''' Notr view in self.window. '''
+        view = emu.View(view_id)
+        view.set_window(self.window)
+        view._file_name = os.path.join(self.tmp_dir, f'v{view_id}.ntr')
+        view.set_syntax(emu.Syntax('', 'Notr', False, 'text.notr'))
+        view.insert(None, 0, text)
+        self.window._views.append(view)
+        return view
 
     #------------------------------------------------------------
     # Mock scope interrogation by row. Corresponds to table in table1.ntr.
@@ -30,20 +100,21 @@ class TestNotr(unittest.TestCase):
 
     #------------------------------------------------------------
     def test_parsing(self):
-        ''' Tests the .ntr file parsing. Uses the demo project on Windows.'''
-        self.window = emu.Window(900)
-        self.view = emu.View(901)
-        self.view.set_window(self.window)
+        ''' Tests the .ntr file parsing. Uses the demo project.'''
 
         # Mock settings.
         mock_settings = {
-            "project_files": [os.path.join(sublime.packages_path(), "Notr", "example", "notr-demo.nproj")],
+            "project_files": [os.path.join(_packages_dir, "Notr", "example", "notr-demo.nproj")],
             "sort_tags_alpha": True,
             "mru_size": 5,
             "fixed_hl_whole_word": True,
         }
         emu.set_settings(mock_settings)
 
+        # It was the active one last time.
+        with open(sc.get_store_fn(), 'w') as f:
+            json.dump({mock_settings['project_files'][0]: {'active': True, 'frecency': []}}, f)
+
         emu.run_command = MagicMock(side_effect=self.mock_run_command)
         self.window.run_command = MagicMock(side_effect=self.mock_run_command)
         self.view.run_command = MagicMock(side_effect=self.mock_run_command)
@@ -54,8 +125,8 @@ class TestNotr(unittest.TestCase):
         evt = notr.NotrEvent()
         evt.on_init([self.view])
 
-        self.assertEqual(len(notr._get_all_tags()), 5)
-        self.assertEqual(len(notr._targets), 15)
+        self.assertEqual(len(notr._get_all_tags()), 7)
+        self.assertEqual(len(notr._targets), 21)
         self.assertEqual(len(notr._refs), 6)
 #        self.assertEqual(len(notr._parse_errors), 2)
         # self.assertEqual(len(notr._store), 13)
@@ -69,3 +140,363 @@ class TestNotr(unittest.TestCase):
     def test_GotoRef(self):
         cmd = notr.NotrGotoTargetCommand(self.view)
         cmd.run(None, False)
+
+    #------------------------------------------------------------
+    def test_fixed_hl_lazy(self):
+        ''' Lazy mode covers the visible part plus margin and grows as it scrolls. '''
+        emu.set_settings({"fixed_hl_mode": "lazy", "fixed_hl_lazy_margin": 100, "fixed_hl_whole_word": True})
+        notr._open_project(self.project_fn)
+        lines = [f'line {i} Hello' for i in range(1000)]
+        view = self.make_view(10, '\n'.join(lines) + '\n')
+        line_len = len(lines[0]) + 1  # they're all the same until 10
+        view.visible_region = lambda: emu.Region(5000, 5500)
+
+        evt = notr.NotrEvent()
+        evt.on_load(view)
+        change_count, begin, end = notr._fixed_hl_coverage[view.id()]
+        self.assertEqual(view.line(begin).begin(), begin)
+        self.assertLessEqual(begin, 4900)
+        self.assertGreaterEqual(end, 5600)
+        regions = view.get_regions('region_fixed_hl1')
+        self.assertTrue(len(regions) > 0)
+        self.assertTrue(all([begin <= r.a and r.b <= end for r in regions]))
+        self.assertEqual([view.substr(r) for r in regions], ['Hello'] * len(regions))
+
+        # Scroll down a bit. Only the new part is added.
+        view.visible_region = lambda: emu.Region(5400, 5900)
+        with patch.object(notr, '_add_fixed_hl', wraps=notr._add_fixed_hl) as add:
+            evt.on_selection_modified(view)
+            segments = add.call_args[0][1]
+            self.assertEqual([(s.a, s.b) for s in segments], [(end, view.line(5900 + 100).end())])
+            self.assertTrue(add.call_args[0][2])
+        self.assertEqual(notr._fixed_hl_coverage[view.id()][1], begin)
+        self.assertGreater(len(view.get_regions('region_fixed_hl1')), len(regions))
+
+        # Already covered so nothing to do.
+        with patch.object(notr, '_add_fixed_hl') as add:
+            evt.on_activated(view)
+            add.assert_not_called()
+
+        # Edited starts over.
+        view.insert(None, 0, 'x')
+        view.visible_region = lambda: emu.Region(0, 10 * line_len)
+        evt.on_activated(view)
+        self.assertEqual(notr._fixed_hl_coverage[view.id()][1:], (0, view.line(10 * line_len + 100).end()))
+        self.assertTrue(all([r.b <= 11 * line_len + 100 for r in view.get_regions('region_fixed_hl1')]))
+
+    #------------------------------------------------------------
+    def test_fixed_hl_auto(self):
+        ''' Auto picks by size. Full mode does the whole view. '''
+        emu.set_settings({"fixed_hl_mode": "auto", "fixed_hl_lazy_threshold": 1000, "fixed_hl_lazy_margin": 100,
+                          "fixed_hl_whole_word": True})
+        notr._open_project(self.project_fn)
+        small = self.make_view(10, 'Hello\n' * 100)
+        big = self.make_view(11, 'Hello\n' * 1000)
+        big.visible_region = lambda: emu.Region(0, 60)
+        self.assertFalse(notr._get_fixed_hl_lazy(small))
+        self.assertTrue(notr._get_fixed_hl_lazy(big))
+
+        evt = notr.NotrEvent()
+        evt.on_load(small)
+        evt.on_load(big)
+        self.assertEqual(len(small.get_regions('region_fixed_hl1')), 100)
+        self.assertNotIn(small.id(), notr._fixed_hl_coverage)
+        self.assertLess(len(big.get_regions('region_fixed_hl1')), 1000)
+        self.assertIn(big.id(), notr._fixed_hl_coverage)
+
+        # Not a notr view.
+        other = self.make_view(12, 'Hello\n')
+        other.set_syntax(emu.Syntax('', 'Plain Text', False, 'text.plain'))
+        evt.on_load(other)
+        self.assertEqual(other.get_regions('region_fixed_hl1'), [])
+
+    #------------------------------------------------------------
+    def test_user_errors(self):
+        ''' One append with a summary, capped, in the same view each time. '''
+        emu.set_settings({"max_errors_shown": 3})
+        errors = [('a.ntr', i, f'Invalid ref name: [r{i}]') for i in range(1, 6)] + [('b.ntr', 1, 'Duplicate target name: [x]')]
+        appends = []
+
+        def _run_command(view, cmd, args=None):
+            if cmd == 'append':
+                appends.append((view.id(), args['characters']))
+
+        with patch.object(emu.View, 'run_command', _run_command):
+            notr._show_user_errors(self.window, errors)
+            self.assertEqual(len(appends), 1)
+            lines = appends[0][1].splitlines()
+            self.assertEqual(lines[:4], ['Notr file errors: 6', '    Invalid ref name: 5', '    Duplicate target name: 1', ''])
+            self.assertEqual(lines[4:], ['a.ntr(1): Invalid ref name: [r1]', 'a.ntr(2): Invalid ref name: [r2]',
+                                         'a.ntr(3): Invalid ref name: [r3]', '... 3 more not shown'])
+
+            # Reindex reuses the view.
+            notr._show_user_errors(self.window, errors[:1])
+            self.assertEqual(len(appends), 2)
+            self.assertEqual(appends[1][0], appends[0][0])
+            self.assertEqual(len(self.window.views()), 1)
+
+    #------------------------------------------------------------
+    def make_projects(self, num):
+        ''' Projects with their own notes and no errors. Returns the project file names. '''
+        project_fns = []
+        for i in range(num):
+            notes_dir = os.path.join(self.tmp_dir, f'p{i}')
+            os.mkdir(notes_dir)
+            with open(os.path.join(notes_dir, f'n{i}.ntr'), 'w') as f:
+                f.write(f'# Section {i}\n')
+            project_fn = os.path.join(self.tmp_dir, f'p{i}.nproj')
+            with open(project_fn, 'w') as f:
+                json.dump({'notr_index': os.path.join(notes_dir, f'n{i}.ntr'), 'notr_paths': [notes_dir]}, f)
+            project_fns.append(project_fn)
+        return project_fns
+
+    def switch_project(self, project_fn, window=None):
+        notr._open_project(project_fn)
+        notr._process_all_files(self.window if window is None else window)
+        return notr._index_cache[project_fn]
+
+    #------------------------------------------------------------
+    def test_index_cache(self):
+        ''' Switching back is a cache hit, revalidated by mtime. Least recent go over budget. '''
+        p0, p1, p2 = self.make_projects(3)
+        index0 = self.switch_project(p0)
+        self.switch_project(p1)
+        self.switch_project(p2)
+        self.assertEqual(list(notr._index_cache.keys()), [p0, p1, p2])
+
+        # Back to the first. Same index, now most recent.
+        self.assertIs(self.switch_project(p0), index0)
+        self.assertEqual(list(notr._index_cache.keys()), [p1, p2, p0])
+        self.assertEqual([t.name for t in notr._targets], ['n0#Section 0'])
+
+        # Changed file is picked up.
+        fn = os.path.join(self.tmp_dir, 'p0', 'n0.ntr')
+        with open(fn, 'w') as f:
+            f.write('# Changed\n')
+        os.utime(fn, (0, 0))
+        self.switch_project(p1)
+        self.assertIsNot(self.switch_project(p0), index0)
+        self.assertEqual([t.name for t in notr._targets], ['n0#Changed'])
+
+        # Over budget. Everything goes but the current one.
+        settings = emu.load_settings('')
+        settings.set('index_cache_mb', 0.000001)
+        self.switch_project(p2)
+        self.assertEqual(list(notr._index_cache.keys()), [p2])
+
+        # Reload starts over.
+        index2 = notr._index_cache[p2]
+        notr.NotrReloadCommand(self.window).run()
+        self.assertIsNot(notr._index_cache[p2], index2)
+
+    #------------------------------------------------------------
+    def test_subscribers(self):
+        ''' Windows share the one project index. The last one out leaves only the current one. '''
+        p0, p1 = self.make_projects(2)
+        other = emu.Window(902)
+        self.switch_project(p0)
+        self.switch_project(p0, other)
+        self.assertEqual(notr._subscribers, {self.window.id(), other.id()})
+
+        # Switching from either window switches both.
+        index1 = self.switch_project(p1, other)
+        self.assertIs(notr._targets, index1.targets)
+        self.assertEqual(list(notr._index_cache.keys()), [p0, p1])
+
+        # Still one window.
+        evt = notr.NotrEvent()
+        evt.on_pre_close_window(self.window)
+        self.assertEqual(list(notr._index_cache.keys()), [p0, p1])
+
+        # Last one.
+        evt.on_pre_close_window(other)
+        self.assertEqual(list(notr._index_cache.keys()), [p1])
+        self.assertEqual(notr._subscribers, set())
+
+    #------------------------------------------------------------
+    def test_notify_subscribers(self):
+        ''' A new snapshot refreshes the views in the subscribed windows. '''
+        p0, = self.make_projects(1)
+        other = emu.Window(902)
+        view0 = self.make_view(10, 'Hello\n')
+        view1 = emu.View(11)
+        view1.set_window(other)
+        other._views.append(view1)
+        self.switch_project(p0)
+
+        with patch.object(emu, 'windows', return_value=[self.window, other]), \
+             patch.object(notr, '_set_status') as set_status, \
+             patch.object(notr.NotrEvent, '_init_fixed_hl') as init_fixed_hl:
+            notr._notify_subscribers()
+            self.assertEqual([c[0][0] for c in set_status.call_args_list], [view0])
+            self.assertEqual([c[0][0] for c in init_fixed_hl.call_args_list], [view0])
+
+            # New file in the project.
+            notr._subscribe(other)
+            set_status.reset_mock()
+            with open(os.path.join(self.tmp_dir, 'p0', 'new.ntr'), 'w') as f:
+                f.write('# New\n')
+            notr._process_all_files(self.window)
+            self.assertEqual([c[0][0] for c in set_status.call_args_list], [view0, view1])
+
+    #------------------------------------------------------------
+    def test_index_lock(self):
+        ''' The lock isn't held while parsing or exporting. A build for a project switched away from is cached only. '''
+        p0, p1 = self.make_projects(2)
+        build_index = notr.core.build_index
+        held = []
+
+        def _build_index(project, old_index=None):
+            held.append(notr._index_lock.locked())
+            if project['_fn'] == p0:
+                notr._open_project(p1)  # user switched meanwhile
+            return build_index(project, old_index)
+
+        notr._open_project(p0)
+        with patch.object(notr.core, 'build_index', _build_index):
+            notr._process_all_files(self.window)
+        self.assertEqual(held, [False])
+        self.assertEqual(list(notr._index_cache.keys()), [p0])
+        self.assertEqual(notr._targets, [])
+
+        held = []
+        with patch.object(notr.db, 'open_db'), \
+             patch.object(notr.db, 'update_db', side_effect=lambda conn, index: held.append(
+                 (notr._index_lock.locked(), notr._db_lock.locked()))):
+            notr._export_db(None)
+        self.assertEqual(held, [(False, True)])
+
+    #------------------------------------------------------------
+    def test_dump(self):
+        ''' Filtered dump from one snapshot, to a file or streamed to a view. '''
+        notr._open_project(self.project_fn)
+        with patch.object(notr, '_show_user_errors'):
+            notr._process_all_files(self.window)
+        targets, refs, user_errors = notr._targets, notr._refs, notr._user_errors
+        self.assertEqual(len(user_errors), 1)
+
+        # Errors only show up with their file.
+        lines = list(notr._dump_lines(targets, refs, user_errors, True, 'index', None, None))
+        self.assertNotIn('\n========== !! errors below !! ==========', lines)
+        self.assertNotIn('\n========== errors ==========', lines)
+        lines = list(notr._dump_lines(targets, refs, user_errors, False, 'page', None, None))
+        self.assertEqual(lines[0], '\n========== !! errors below !! ==========')
+        self.assertEqual(lines[-2], '\n========== errors ==========')
+        self.assertIn('nowhere', lines[-1])
+
+        # Tag filter.
+        lines = list(notr._dump_lines(targets, refs, user_errors, True, None, None, 'tag2'))
+        tags = lines[lines.index('\n========== tags ==========') + 1:lines.index('\n========== ntr_files ==========')]
+        self.assertEqual(tags, ['tag2'])
+
+        # A newer index doesn't leak into an older dump.
+        lines = notr._dump_lines(targets, refs, user_errors, True, None, None, None)
+        next(lines)
+        notr._targets = []
+        lines = list(lines)
+        files = lines[lines.index('\n========== ntr_files ==========') + 1:lines.index('\n========== errors ==========')]
+        self.assertEqual([os.path.basename(fn) for fn in files], ['index.ntr', 'page.ntr'])
+        self.assertIn('tag1', lines)
+        notr._targets = targets
+
+        # To file.
+        out_fn = os.path.join(self.tmp_dir, 'dump.txt')
+        notr.NotrDumpCommand(self.window).run(file='page', out_fn=out_fn)
+        with open(out_fn) as f:
+            self.assertEqual(f.read(), '\n'.join(notr._dump_lines(targets, refs, user_errors, False, 'page', None, None)) + '\n')
+
+        # To view. Chunks run on later timeouts. The clipboard is left alone.
+        commands = []
+        timeouts = []
+
+        def _run_command(view, cmd, args=None):
+            commands.append((cmd, args['characters'] if cmd == 'append' else None))
+
+        with patch.object(emu.View, 'run_command', _run_command), \
+             patch.object(emu, 'set_timeout', lambda f, timeout_ms=0: timeouts.append(f)):
+            view = sc.create_new_view(self.window, '')
+            commands.clear()
+            notr._stream_to_view(view, iter([str(i) for i in range(5)]), 2)
+            while len(timeouts) > 0:
+                timeouts.pop(0)()
+        self.assertEqual(commands, [('append', '0\n1\n'), ('append', '2\n3\n'), ('append', '4\n')])
+
+        commands.clear()
+        with patch.object(emu.View, 'run_command', _run_command):
+            sc.create_new_view(self.window, 'x')
+        self.assertEqual([c[0] for c in commands], ['select_all', 'right_delete', 'append'])
+
+    #------------------------------------------------------------
+    def test_expand_vars(self):
+        ''' Per file alias tables are kept until the next index. '''
+        p0, = self.make_projects(1)
+        fn = os.path.join(self.tmp_dir, 'p0', 'n0.ntr')
+        with open(fn, 'w') as f:
+            f.write(':WHERE=/here\n:MINE=$WHERE/mine\n# Section\n')
+        self.switch_project(p0)
+        self.assertEqual(notr._expand_vars('$MINE/x', fn), '/here/mine/x')
+        table = notr._file_alias_tables[1][fn]
+        self.assertEqual(notr._expand_vars('$WHERE', fn), '/here')
+        self.assertIs(notr._file_alias_tables[1][fn], table)
+        self.assertIsNone(notr._expand_vars('$NOPE', fn))
+
+        with open(fn, 'w') as f:
+            f.write(':WHERE=/there\n:MINE=$WHERE/mine\n# Section\n')
+        os.utime(fn, (0, 0))
+        self.switch_project(p0)
+        self.assertEqual(notr._expand_vars('$MINE/x', fn), '/there/mine/x')
+        self.assertIsNot(notr._file_alias_tables[1][fn], table)
+
+    #------------------------------------------------------------
+    def test_query_index(self):
+        ''' The query runs in the background and always closes the database. '''
+        p0, = self.make_projects(1)
+        self.switch_project(p0)
+        cmd = notr.NotrQueryIndexCommand(self.window)
+        queued = []
+        conn = MagicMock()
+        results = (['name', 'file', 'line'], [('n0#Section 0', 'n0.ntr', 1)])
+        with patch.object(emu, 'set_timeout_async', lambda f, timeout_ms=0: queued.append(f)), \
+             patch.object(notr.db, 'open_db', return_value=conn), \
+             patch.object(notr.db, 'update_db') as update_db, \
+             patch.object(notr.db, 'query', return_value=results), \
+             patch.object(cmd, 'show_results') as show_results:
+            cmd.on_done('section')
+            update_db.assert_not_called()
+            queued.pop(0)()
+            self.assertIs(update_db.call_args[0][1], notr._index_cache[p0])
+            show_results.assert_called_once_with(*results)
+            conn.close.assert_called_once()
+
+            conn.reset_mock()
+            with patch.object(notr.db, 'query', side_effect=notr.db.sqlite3.Error('bad')):
+                cmd.on_done('section')
+                queued.pop(0)()
+            conn.close.assert_called_once()
+
+    #------------------------------------------------------------
+    def test_complete_ref(self):
+        ''' Completion ignores case and puts in the name as it's spelled. '''
+        notr._open_project(self.project_fn)
+        with patch.object(notr, '_show_user_errors'):
+            notr._process_all_files(self.window)
+        text = 'See <*PAGE#pa'
+        view = self.make_view(10, text)
+        res = notr.NotrEvent().on_query_completions(view, 'pa', [len(text)])
+        self.assertEqual([(c.trigger, c.command, c.args) for c in res.completions],
+                         [('page#Page section', 'notr_complete_ref', {'name': 'page#Page section'})])
+
+        sel = emu.Selection(view.id())
+        sel.add(emu.Region(len(text), len(text)))
+        view.set_selection(sel)
+        notr.NotrCompleteRefCommand(view).run(None, 'page#Page section')
+        self.assertEqual(view.substr(emu.Region(0, view.size())), 'See <*page#Page section>')
+        self.assertEqual(view.sel()[0].b, view.size())
+
+        # Already closed.
+        view = self.make_view(11, 'See <* pa> and more')
+        sel = emu.Selection(view.id())
+        sel.add(emu.Region(9, 9))
+        view.set_selection(sel)
+        notr.NotrCompleteRefCommand(view).run(None, 'page#Page section')
+        self.assertEqual(view.substr(emu.Region(0, view.size())), 'See <*page#Page section> and more')
@@ -0,0 +1,84 @@
+import sys
+import os
+import time
+import unittest
+
+# Import the code under test.
+cut_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if cut_path not in sys.path: sys.path.insert(0, cut_path)
+import notr_core
+import notr_complete
+
+
+#-----------------------------------------------------------------------------------
+def make_findex(fn, names, no_index=False):
+    sections = [notr_core.Target(name, 'section', '', 1, [], '', fn, i + 1) for i, name in enumerate(names)]
+    return notr_core.FileIndex(fn, 0, no_index, sections, [], [], [])
+
+
+#-----------------------------------------------------------------------------------
+class TestNotrComplete(unittest.TestCase):
+
+    #------------------------------------------------------------
+    def test_trie(self):
+        ''' Add, find, remove. '''
+        trie = notr_complete.NameTrie()
+        for name in ['page#Intro', 'page#Index', 'Pager', 'other#Intro', 'page#Intro']:
+            trie.add(name)
+        self.assertEqual(trie.size, 5)
+        self.assertEqual(sorted(trie.find('PAGE', 10)), ['Pager', 'page#Index', 'page#Intro'])
+        self.assertEqual(trie.find('page#int', 10), ['page#Intro'])
+        self.assertEqual(len(trie.find('', 2)), 2)
+        self.assertEqual(trie.find('nope', 10), [])
+        # Depth first, not shortest first.
+        self.assertEqual(trie.find('p', 10), ['page#Intro', 'page#Index', 'Pager'])
+
+        # Added twice so still there after one remove.
+        trie.remove('page#Intro')
+        self.assertEqual(trie.find('page#int', 10), ['page#Intro'])
+        trie.remove('page#Intro')
+        self.assertEqual(trie.find('page#int', 10), [])
+        trie.remove('not there')
+        for name in ['page#Index', 'Pager', 'other#Intro']:
+            trie.remove(name)
+        self.assertEqual(trie.size, 0)
+        self.assertEqual(trie._root, {})
+
+    #------------------------------------------------------------
+    def test_update(self):
+        ''' Only changed files are redone. '''
+        trie = notr_complete.NameTrie()
+        files = {'a': make_findex('a', ['a#One', 'a#Two']), 'b': make_findex('b', ['b#One']),
+                 'c': make_findex('c', ['c#One'], no_index=True)}
+        notr_complete.update_trie(trie, files, {})
+        self.assertEqual(trie.size, 3)
+
+        files2 = dict(files)
+        files2['a'] = make_findex('a', ['a#Three'])
+        del files2['b']
+        notr_complete.update_trie(trie, files2, files)
+        self.assertEqual(sorted(trie.find('', 10)), ['a#Three'])
+
+    #------------------------------------------------------------
+    def test_rank(self):
+        ''' Mru then local then the rest. '''
+        trie = notr_complete.NameTrie()
+        for name in ['x#Sec1', 'x#Sec2', 'x#Sec3', 'y#Sec']:
+            trie.add(name)
+        res = notr_complete.complete(trie, 'x#sec', ['x#Sec3', 'y#Sec'], ['x#Sec2'], 10)
+        self.assertEqual(res, [('x#Sec3', 'mru'), ('x#Sec2', 'local'), ('x#Sec1', '')])
+        self.assertEqual(len(notr_complete.complete(trie, '', ['x#Sec3'], [], 2)), 2)
+
+    #------------------------------------------------------------
+    def test_speed(self):
+        ''' 100k targets. '''
+        trie = notr_complete.NameTrie()
+        for i in range(100000):
+            trie.add(f'file{i % 1000}#Section {i} about things')
+
+        times = []
+        for typed in ['', 'f', 'file1', 'file12#', 'file123#Section 1', 'zzz']:
+            start = time.perf_counter()
+            notr_complete.complete(trie, typed, [], [], 50)
+            times.append(time.perf_counter() - start)
+        self.assertLess(max(times), 0.01)
@@ -0,0 +1,210 @@
+import sys
+import os
+import io
+import re
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+from unittest.mock import patch
+
+# Import the code under test.
+cut_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if cut_path not in sys.path: sys.path.insert(0, cut_path)
+import notr_core
+
+
+#-----------------------------------------------------------------------------------
+class TestNotrCore(unittest.TestCase):
+
+    #------------------------------------------------------------
+    def setUp(self):
+        # Make a little project.
+        self.tmp_dir = tempfile.mkdtemp()
+        self.notes_dir = os.path.join(self.tmp_dir, 'notes')
+        os.mkdir(self.notes_dir)
+
+        self.write_ntr('index.ntr', [
+            f':NOTES_DIR={self.notes_dir}',
+            '# Index section [tag1 tag2]',
+            'See <*page#Page section> and <*nowhere>.',
+            '<notes dir>($NOTES_DIR)',
+            '## Index sub',
+            '```',
+            '# Not a section',
+            '```',
+            '# Index section',
+        ])
+        self.write_ntr('page.ntr', [
+            '# Page section [tag3]',
+            'Back to <*index##Index sub>.',
+            '<a pic>($NOTES_DIR/pic.jpg)',
+        ])
+
+        self.project_fn = os.path.join(self.tmp_dir, 'test.nproj')
+        with open(self.project_fn, 'w') as f:
+            json.dump({'notr_index': os.path.join(self.notes_dir, 'index.ntr'), 'notr_paths': [self.notes_dir]}, f)
+
+    #------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    #------------------------------------------------------------
+    def write_ntr(self, fn, lines):
+        with open(os.path.join(self.notes_dir, fn), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    #------------------------------------------------------------
+    def test_process_file(self):
+        ''' One file. '''
+        fn = os.path.join(self.notes_dir, 'index.ntr')
+        findex = notr_core.process_file(fn, 0)
+
+        self.assertFalse(findex.no_index)
+        self.assertEqual([t.name for t in findex.sections], ['index#Index section', 'index##Index sub', 'index#Index section'])
+        self.assertEqual(findex.sections[0].tags, ['tag1', 'tag2'])
+        self.assertEqual(findex.sections[1].level, 2)
+        self.assertEqual(len(findex.links), 1)
+        self.assertEqual(findex.links[0].ttype, 'dir')
+        self.assertEqual([r.name for r in findex.refs], ['page#Page section', 'nowhere'])
+        self.assertEqual(len(findex.errors), 0)
+
+    #------------------------------------------------------------
+    def test_build_index(self):
+        ''' Whole project with validation. '''
+        project = notr_core.load_project(self.project_fn)
+        index = notr_core.build_index(project)
+
+        self.assertEqual(len(index.files), 2)
+        self.assertEqual(len(index.targets), 6)
+        self.assertEqual(len(index.refs), 3)
+        msgs = [e[2] for e in index.user_errors]
+        self.assertEqual(msgs, ['Duplicate target name: [index#Index section]', 'Invalid ref name: [nowhere]'])
+
+        # Nothing changed so same one.
+        self.assertIs(notr_core.build_index(project, index), index)
+
+        # Change one file, the other is reused.
+        self.write_ntr('page.ntr', ['# New page section'])
+        fn = os.path.join(self.notes_dir, 'page.ntr')
+        os.utime(fn, (0, 0))
+        index2 = notr_core.build_index(project, index)
+        self.assertIsNot(index2, index)
+        self.assertIs(index2.files[os.path.join(self.notes_dir, 'index.ntr')], index.files[os.path.join(self.notes_dir, 'index.ntr')])
+        self.assertEqual(len(index2.targets), 5)
+
+    #------------------------------------------------------------
+    def test_target_tree(self):
+        ''' Files then sections by level, links in their section. '''
+        project = notr_core.load_project(self.project_fn)
+        index = notr_core.build_index(project)
+
+        tree = notr_core.build_target_tree(index)
+        self.assertEqual([n.name for n in tree], ['index.ntr', 'page.ntr'])
+        self.assertIsNone(tree[0].target)
+        self.assertEqual([n.name for n in tree[0].children], ['index#Index section', 'index#Index section'])
+        sect = tree[0].children[0]
+        self.assertEqual([n.name for n in sect.children], ['notes dir', 'index##Index sub'])
+        self.assertEqual(sect.children[1].target.level, 2)
+        self.assertEqual([n.name for n in tree[1].children[0].children], ['a pic'])
+
+        # Sub sections left out.
+        tree = notr_core.build_target_tree(index, 1)
+        self.assertEqual([n.name for n in tree[0].children[0].children], ['notes dir'])
+
+    #------------------------------------------------------------
+    def test_bad_project(self):
+        ''' Broken project file. '''
+        with open(self.project_fn, 'w') as f:
+            json.dump({'notr_paths': []}, f)
+        with self.assertRaises(ValueError):
+            notr_core.load_project(self.project_fn)
+
+    #------------------------------------------------------------
+    def test_cli(self):
+        ''' Command line output and exit code. '''
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            rc = notr_core.main([self.project_fn, '-j', '1'])
+        self.assertEqual(rc, 1)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].endswith('index.ntr(3): Invalid ref name: [nowhere]'))
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            rc = notr_core.main([self.project_fn, '--json'])
+        res = json.loads(out.getvalue())
+        self.assertEqual(res['targets'], 6)
+        self.assertEqual(res['errors'][1]['line'], 3)
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            rc = notr_core.main([os.path.join(self.tmp_dir, 'nope.nproj')])
+        self.assertEqual(rc, 2)
+
+    #------------------------------------------------------------
+    def test_aliases(self):
+        ''' Alias table expansion. '''
+        os.environ['NOTR_TEST_HOME'] = '/home/me'
+        self.addCleanup(os.environ.pop, 'NOTR_TEST_HOME', None)
+        table = notr_core.AliasTable({'A': '$B/a', 'B': '${NOTR_TEST_HOME}/b', 'X': '$Y', 'Y': '$X'})
+        self.assertEqual(table.expand('$A/c'), '/home/me/b/a/c')
+        self.assertEqual(table.expand('no vars'), 'no vars')
+        self.assertIsNone(table.expand('$NOPE/c'))
+        self.assertIsNone(table.expand('$X'))  # circular
+        self.assertIsNone(table.expand('cost $'))
+
+        # File overrides don't change the parent or what the parent values mean.
+        child = table.with_overrides({'B': '/other', 'C': '$A'})
+        self.assertEqual(child.expand('$B $C'), '/other /home/me/b/a')
+        self.assertEqual(table.expand('$B'), '/home/me/b')
+        self.assertIs(table.with_overrides({}), table)
+
+    #------------------------------------------------------------
+    def test_project_aliases(self):
+        ''' Aliases from one file are seen by the others, and not put in the environment. '''
+        self.write_ntr('other.ntr', ['<more notes>($NOTES_DIR)'])
+        project = notr_core.load_project(self.project_fn)
+        index = notr_core.build_index(project)
+        self.assertNotIn('NOTES_DIR', os.environ)
+        link = [t for t in index.targets if t.name == 'more notes'][0]
+        self.assertEqual((link.ttype, link.resource), ('dir', self.notes_dir))
+
+        # Changing the alias redoes the files that use it.
+        fn = os.path.join(self.notes_dir, 'index.ntr')
+        with open(fn) as f:
+            text = f.read()
+        with open(fn, 'w') as f:
+            f.write(text.replace(f':NOTES_DIR={self.notes_dir}', f':NOTES_DIR={self.tmp_dir}'))
+        os.utime(fn, (0, 0))
+        index = notr_core.build_index(project, index)
+        link = [t for t in index.targets if t.name == 'more notes'][0]
+        self.assertEqual(link.resource, self.tmp_dir)
+
+        # Windows style vars count too.
+        self.write_ntr('other.ntr', ['<more notes>(%NOTES_DIR%)'])
+        with patch.object(notr_core, '_RE_VARS', re.compile(r'\$(?:(?P<name>\w+)|\{(?P<braced>[^}]*)\})?|%(?P<win>\w+)%')):
+            findex = notr_core.process_file(os.path.join(self.notes_dir, 'other.ntr'), 0, index.aliases)
+        self.assertTrue(findex.uses_aliases)
+        self.assertEqual(findex.links[0].resource, self.tmp_dir)
+
+    #------------------------------------------------------------
+    def test_read_section(self):
+        ''' Section previews from the offsets. '''
+        self.write_ntr('big.ntr', ['intro', '# Sec ä one', 'line 1', 'line 2', 'line 3', '## Sec two', 'line 4'])
+        fn = os.path.join(self.notes_dir, 'big.ntr')
+        findex = notr_core.process_file(fn, 0)
+        self.assertEqual([t.offset for t in findex.sections], [6, 40])
+
+        self.assertEqual(notr_core.read_section(fn, findex.sections[0].offset, 2), ['# Sec ä one', 'line 1', 'line 2'])
+        self.assertEqual(notr_core.read_section(fn, findex.sections[0].offset, 10), ['# Sec ä one', 'line 1', 'line 2', 'line 3'])
+        self.assertEqual(notr_core.read_section(fn, findex.sections[1].offset, 10), ['## Sec two', 'line 4'])
+        self.assertIsNone(notr_core.read_section(fn, 2, 10))
+
+        # Edited since indexed. Found by name.
+        self.write_ntr('big.ntr', ['new intro', '```', '# Sec ä one', '```', '# Sec ä one', 'line 1', '## Sec two', 'line 4'])
+        self.assertEqual(notr_core.read_section(fn, findex.sections[0].offset, 10, findex.sections[0].name), ['# Sec ä one', 'line 1'])
+        self.assertEqual(notr_core.read_section(fn, findex.sections[1].offset, 10, findex.sections[1].name), ['## Sec two', 'line 4'])
+        self.assertEqual(notr_core.read_section(fn, 31, 10, findex.sections[1].name), ['## Sec two', 'line 4'])  # other heading
+        self.assertIsNone(notr_core.read_section(fn, findex.sections[1].offset, 10, 'big#Gone'))
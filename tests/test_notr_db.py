@@ -0,0 +1,119 @@
+import sys
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+# Import the code under test.
+cut_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if cut_path not in sys.path: sys.path.insert(0, cut_path)
+import notr_core
+import notr_db
+
+
+#-----------------------------------------------------------------------------------
+@unittest.skipUnless(notr_db.available(), 'no sqlite')
+class TestNotrDb(unittest.TestCase):
+
+    #------------------------------------------------------------
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.notes_dir = os.path.join(self.tmp_dir, 'notes')
+        os.mkdir(self.notes_dir)
+
+        self.write_ntr('index.ntr', [
+            '# Index section [tag1 tag2]',
+            'Some apples here.',
+            'See <*page#Page section>.',
+            '# Other section [tag2]',
+            'Some pears.',
+        ])
+        self.write_ntr('page.ntr', [
+            '# Page section [tag3]',
+            'Back to <*index#Index section>.',
+            'And <*nowhere>.',
+        ])
+
+        project_fn = os.path.join(self.tmp_dir, 'test.nproj')
+        with open(project_fn, 'w') as f:
+            json.dump({'notr_index': os.path.join(self.notes_dir, 'index.ntr'), 'notr_paths': [self.notes_dir]}, f)
+        self.project = notr_core.load_project(project_fn)
+        self.conn = notr_db.open_db(os.path.join(self.tmp_dir, 'test.sqlite'))
+
+    #------------------------------------------------------------
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmp_dir)
+
+    #------------------------------------------------------------
+    def write_ntr(self, fn, lines):
+        with open(os.path.join(self.notes_dir, fn), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    #------------------------------------------------------------
+    def test_export(self):
+        ''' Tables have the index contents. '''
+        index = notr_core.build_index(self.project)
+        written = notr_db.update_db(self.conn, index)
+        self.assertEqual(len(written), 2)
+
+        _, rows = notr_db.query(self.conn, "select target from tags where tag = 'tag2' order by target")
+        self.assertEqual([r[0] for r in rows], ['index#Index section', 'index#Other section'])
+
+        # Section containing a ref.
+        _, rows = notr_db.query(self.conn, "select section from refs where name = 'page#Page section'")
+        self.assertEqual(rows, [('index#Index section',)])
+
+        cols, rows = notr_db.query(self.conn, 'select file, line, msg from errors')
+        self.assertEqual(cols, ['file', 'line', 'msg'])
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0][1], 3)
+
+    #------------------------------------------------------------
+    def test_text_search(self):
+        ''' Full text on section bodies. '''
+        notr_db.update_db(self.conn, notr_core.build_index(self.project))
+        cols, rows = notr_db.query(self.conn, 'pears')
+        self.assertEqual(cols[:3], ['name', 'file', 'line'])
+        self.assertEqual([r[0] for r in rows], ['index#Other section'])
+
+    #------------------------------------------------------------
+    def test_incremental(self):
+        ''' Only changed files are rewritten. '''
+        index = notr_core.build_index(self.project)
+        notr_db.update_db(self.conn, index)
+        self.assertEqual(notr_db.update_db(self.conn, index), [])
+
+        fn = os.path.join(self.notes_dir, 'page.ntr')
+        self.write_ntr('page.ntr', ['# New page section', 'Some plums.'])
+        os.utime(fn, (0, 0))
+        index = notr_core.build_index(self.project, index)
+        self.assertEqual(notr_db.update_db(self.conn, index), [fn])
+
+        _, rows = notr_db.query(self.conn, 'select name from targets order by name')
+        self.assertEqual([r[0] for r in rows], ['index#Index section', 'index#Other section', 'page#New page section'])
+        _, rows = notr_db.query(self.conn, 'plums')
+        self.assertEqual(len(rows), 1)
+
+        # Alias in one file changes the targets in another.
+        index_fn = os.path.join(self.notes_dir, 'index.ntr')
+        self.write_ntr('index.ntr', [':PICS=/old', '# Index section'])
+        self.write_ntr('page.ntr', ['# Page section', '<a pic>($PICS/pic.jpg)'])
+        index = notr_core.build_index(self.project, index)
+        notr_db.update_db(self.conn, index)
+        mtime = os.path.getmtime(fn)
+        self.write_ntr('index.ntr', [':PICS=/new', '# Index section'])
+        os.utime(index_fn, (mtime + 10, mtime + 10))
+        index = notr_core.build_index(self.project, index)
+        self.assertEqual(os.path.getmtime(fn), mtime)
+        self.assertEqual(sorted(notr_db.update_db(self.conn, index)), sorted([fn, index_fn]))
+        _, rows = notr_db.query(self.conn, "select resource from targets where name = 'a pic'")
+        self.assertEqual(rows, [(os.path.normpath('/new/pic.jpg'),)])
+
+        # Gone file.
+        os.remove(fn)
+        index = notr_core.build_index(self.project, index)
+        notr_db.update_db(self.conn, index)
+        _, rows = notr_db.query(self.conn, 'select count(*) from files')
+        self.assertEqual(rows, [(1,)])
@@ -0,0 +1,98 @@
+import sys
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import http.server
+
+# Import the code under test.
+cut_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if cut_path not in sys.path: sys.path.insert(0, cut_path)
+import notr_core
+import notr_links
+
+
+#-----------------------------------------------------------------------------------
+class _Handler(http.server.BaseHTTPRequestHandler):
+    ''' Stand-in web server. /ok is fine, /nohead only does GET, anything else is 404. '''
+    hits = []
+
+    def do_HEAD(self):
+        self.hits.append(('HEAD', self.path))
+        self.send_response(200 if self.path == '/ok' else 405 if self.path == '/nohead' else 404)
+        self.end_headers()
+
+    def do_GET(self):
+        self.hits.append(('GET', self.path))
+        self.send_response(200 if self.path in ('/ok', '/nohead') else 404)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+#-----------------------------------------------------------------------------------
+class TestNotrLinks(unittest.TestCase):
+
+    #------------------------------------------------------------
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), _Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        _Handler.hits = []
+
+        fn = os.path.join(self.tmp_dir, 'there.txt')
+        open(fn, 'w').close()
+        self.targets = [
+            notr_core.Target('there', 'file', '', 0, [], fn, 'a.ntr', 1),
+            notr_core.Target('gone', 'file', '', 0, [], os.path.join(self.tmp_dir, 'gone.txt'), 'a.ntr', 2),
+            notr_core.Target('dir', 'dir', '', 0, [], self.tmp_dir, 'a.ntr', 3),
+            notr_core.Target('ok', 'url', '', 0, [], f'{self.url}/ok', 'b.ntr', 1),
+            notr_core.Target('nohead', 'url', '', 0, [], f'{self.url}/nohead', 'b.ntr', 2),
+            notr_core.Target('missing', 'url', '', 0, [], f'{self.url}/missing', 'b.ntr', 3),
+            notr_core.Target('section', 'section', '', 1, [], '', 'b.ntr', 4),
+        ]
+
+    #------------------------------------------------------------
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    #------------------------------------------------------------
+    def test_check(self):
+        ''' Files, dirs and urls. '''
+        cache = {}
+        errors = notr_links.check_links(self.targets, cache, workers=4)
+        self.assertEqual([(e[0], e[1]) for e in errors], [('a.ntr', 2), ('b.ntr', 3)])
+        self.assertTrue(errors[0][2].startswith('Broken link:'))
+        self.assertTrue(errors[1][2].endswith('http 404'))
+        self.assertEqual(len(cache), 6)
+        self.assertIn(('GET', '/nohead'), _Handler.hits)
+
+    #------------------------------------------------------------
+    def test_cache(self):
+        ''' Only stale entries are rechecked and gone ones are dropped. '''
+        cache = {}
+        notr_links.check_links(self.targets, cache)
+        nhits = len(_Handler.hits)
+
+        errors = notr_links.check_links(self.targets, cache)
+        self.assertEqual(len(_Handler.hits), nhits)
+        self.assertEqual(len(errors), 2)
+
+        # Make one stale.
+        cache[f'{self.url}/ok'][0] -= 1000
+        notr_links.check_links(self.targets, cache, max_age=100)
+        self.assertEqual(_Handler.hits[nhits:], [('HEAD', '/ok')])
+
+        notr_links.check_links(self.targets[:1], cache)
+        self.assertEqual(list(cache.keys()), [self.targets[0].resource])
+
+        # Round trip.
+        cache_fn = os.path.join(self.tmp_dir, 'links.json')
+        notr_links.save_cache(cache_fn, cache)
+        self.assertEqual(notr_links.load_cache(cache_fn), cache)
+        self.assertEqual(notr_links.load_cache(os.path.join(self.tmp_dir, 'nope.json')), {})
@@ -0,0 +1,77 @@
+import sys
+import os
+import time
+import unittest
+
+# Import the code under test.
+cut_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if cut_path not in sys.path: sys.path.insert(0, cut_path)
+import notr_mru
+
+
+DAY = 86400
+
+
+#-----------------------------------------------------------------------------------
+class TestNotrMru(unittest.TestCase):
+
+    #------------------------------------------------------------
+    def test_rank(self):
+        ''' Often beats once, recent beats old. '''
+        frec = notr_mru.Frecency(half_life=7 * DAY)
+        now = time.time()
+        for days_ago in (30, 29, 28, 27):
+            frec.visit('often_old', now - days_ago * DAY)
+        frec.visit('once_old', now - 20 * DAY)
+        frec.visit('often', now - 2 * DAY)
+        frec.visit('often', now - 1 * DAY)
+        frec.visit('once', now - 1 * DAY)
+        frec.visit('tie', now - 1 * DAY)
+        self.assertEqual(frec.ranked(), ['often', 'tie', 'once', 'often_old', 'once_old'])
+        self.assertEqual(frec.ranked(2), ['often', 'tie'])
+
+        # Two visits a half life apart are worth 1.5 of the latest.
+        frec.visit('a', now - 7 * DAY)
+        frec.visit('a', now)
+        self.assertAlmostEqual(frec.score('a'), frec.score('tie') + DAY + 7 * DAY * 0.5849625, delta=1)
+
+        frec.prune(set(['often', 'once']))
+        self.assertEqual(frec.ranked(), ['often', 'once'])
+        self.assertIsNone(frec.score('tie'))
+
+    #------------------------------------------------------------
+    def test_persist(self):
+        ''' dump/load and the old mru list. '''
+        frec = notr_mru.Frecency()
+        for i, name in enumerate(['a', 'b', 'c', 'b']):
+            frec.visit(name, 1000000 + i)
+        loaded = notr_mru.Frecency.load(frec.dump())
+        self.assertEqual(loaded.dump(), frec.dump())
+        self.assertEqual(loaded.ranked(), frec.ranked())
+
+        old = notr_mru.Frecency.load(['newest', 'middle', 'oldest'])
+        self.assertEqual(old.ranked(), ['newest', 'middle', 'oldest'])
+        old.visit('oldest')
+        self.assertEqual(old.ranked(1), ['oldest'])
+        self.assertEqual(len(notr_mru.Frecency.load([])), 0)
+
+        # Half life changed. Old scores still compare with new visits.
+        now = time.time()
+        frec = notr_mru.Frecency(half_life=7 * DAY)
+        frec.visit('old', now - 10 * DAY)
+        frec.visit('newer', now - 2 * DAY)
+        loaded = notr_mru.Frecency.load(frec.dump(), half_life=1 * DAY)
+        loaded.visit('new', now)
+        self.assertEqual(loaded.ranked(), ['new', 'newer', 'old'])
+        loaded.visit('old', now - 10 * DAY)
+        self.assertEqual(loaded.ranked(), ['new', 'newer', 'old'])
+
+    #------------------------------------------------------------
+    def test_size(self):
+        ''' Lowest go first. '''
+        frec = notr_mru.Frecency(max_size=100)
+        for i in range(1000):
+            frec.visit(f'n{i}', 1000000 + i)
+        self.assertLessEqual(len(frec), 100)
+        self.assertIn('n999', frec)
+        self.assertNotIn('n0', frec)
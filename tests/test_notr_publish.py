@@ -0,0 +1,141 @@
+import sys
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+# Import the code under test.
+cut_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if cut_path not in sys.path: sys.path.insert(0, cut_path)
+import notr_core
+import notr_publish
+
+
+#-----------------------------------------------------------------------------------
+class TestNotrPublish(unittest.TestCase):
+
+    #------------------------------------------------------------
+    def setUp(self):
+        # Make a little project.
+        self.tmp_dir = tempfile.mkdtemp()
+        self.notes_dir = os.path.join(self.tmp_dir, 'notes')
+        self.out_dir = os.path.join(self.tmp_dir, 'out')
+        os.mkdir(self.notes_dir)
+
+        self.write_ntr('index.ntr', [
+            '# Index section [tag1]',
+            'See <*page#Page section> & <*nowhere>.',
+            '<news>(https://example.com)',
+        ])
+        self.write_ntr('page.ntr', [
+            '# Page section',
+            'Back to <*index#Index section>.',
+        ])
+        self.write_ntr('other.ntr', [
+            '# Other section',
+            'Nothing to see.',
+        ])
+
+        project_fn = os.path.join(self.tmp_dir, 'test.nproj')
+        with open(project_fn, 'w') as f:
+            json.dump({'notr_index': os.path.join(self.notes_dir, 'index.ntr'), 'notr_paths': [self.notes_dir]}, f)
+        self.project = notr_core.load_project(project_fn)
+
+    #------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    #------------------------------------------------------------
+    def write_ntr(self, fn, lines, mtime=None):
+        path = os.path.join(self.notes_dir, fn)
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    #------------------------------------------------------------
+    def read_out(self, fn):
+        with open(os.path.join(self.out_dir, fn)) as f:
+            return f.read()
+
+    #------------------------------------------------------------
+    def test_render(self):
+        ''' Links and anchors. '''
+        res = notr_publish.publish(self.project, self.out_dir)
+        self.assertEqual(len(res['rendered']), 3)
+
+        text = self.read_out('index.html')
+        self.assertIn('<h1 id="index-section">Index section <span class="tags">[tag1]</span></h1>', text)
+        self.assertIn('See <a href="page.html#page-section">page#Page section</a> &amp; <span class="bad-ref">nowhere</span>.', text)
+        self.assertIn('<a href="https://example.com">news</a>', text)
+        self.assertIn('<a href="index.html#index-section">index#Index section</a>', self.read_out('page.html'))
+
+    #------------------------------------------------------------
+    def test_incremental(self):
+        ''' Only what changed. '''
+        notr_publish.publish(self.project, self.out_dir)
+
+        # Nothing changed.
+        res = notr_publish.publish(self.project, self.out_dir)
+        self.assertEqual(len(res['rendered']), 0)
+
+        # Touched but same content.
+        self.write_ntr('other.ntr', ['# Other section', 'Nothing to see.'], mtime=1000)
+        res = notr_publish.publish(self.project, self.out_dir)
+        self.assertEqual(len(res['rendered']), 0)
+
+        # Edit a line - just that page.
+        self.write_ntr('other.ntr', ['# Other section', 'Something to see.'], mtime=2000)
+        res = notr_publish.publish(self.project, self.out_dir)
+        self.assertEqual([os.path.basename(fn) for fn in res['rendered']], ['other.html'])
+
+        # Move a section that is referred to - that page and its backlink.
+        self.write_ntr('page.ntr', ['# Page section moved', 'Back to <*index#Index section>.'], mtime=3000)
+        res = notr_publish.publish(self.project, self.out_dir)
+        self.assertEqual(sorted([os.path.basename(fn) for fn in res['rendered']]), ['index.html', 'page.html'])
+        self.assertIn('<span class="bad-ref">page#Page section</span>', self.read_out('index.html'))
+
+        # Gone.
+        os.remove(os.path.join(self.notes_dir, 'other.ntr'))
+        res = notr_publish.publish(self.project, self.out_dir)
+        self.assertEqual(len(res['removed']), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.out_dir, 'other.html')))
+
+    #------------------------------------------------------------
+    def test_names(self):
+        ''' Anchors and pages don't collide. '''
+        self.write_ntr('page.ntr', [
+            '# Page section',
+            '## Page section',
+            '# Página dos',
+            '# ¿¡',
+            'See <*page##Page section>.',
+        ])
+        self.assertEqual(notr_publish.get_anchors(['page#Page section', 'page##Page section', 'page#Página dos', 'page#¿¡']),
+                         ['page-section', 'page-section-2', 'página-dos', notr_publish.get_anchors(['page#¿¡'])[0]])
+        self.assertRegex(notr_publish.get_anchors(['page#¿¡'])[0], r'^section-[0-9a-f]{8}$')
+
+        # Same name in another dir.
+        more_dir = os.path.join(self.tmp_dir, 'more')
+        os.mkdir(more_dir)
+        with open(os.path.join(more_dir, 'page.ntr'), 'w') as f:
+            f.write('# More section\n')
+        self.project['notr_paths'].append(more_dir)
+
+        notr_publish.publish(self.project, self.out_dir)
+        text = self.read_out('page.html')
+        self.assertIn('<h1 id="page-section">Page section</h1>', text)
+        self.assertIn('<h2 id="page-section-2">Page section</h2>', text)
+        self.assertIn('<h1 id="página-dos">Página dos</h1>', text)
+        self.assertIn('See <a href="page.html#page-section-2">page##Page section</a>.', text)
+        self.assertIn('<h1 id="more-section">More section</h1>', self.read_out('page-2.html'))
+
+        # Names stick when the first one goes.
+        os.remove(os.path.join(self.notes_dir, 'page.ntr'))
+        with open(os.path.join(more_dir, 'page.ntr'), 'w') as f:
+            f.write('# More section changed\n')
+        res = notr_publish.publish(self.project, self.out_dir)
+        self.assertEqual(sorted([os.path.basename(fn) for fn in res['rendered']]), ['index.html', 'page-2.html'])
+        self.assertFalse(os.path.exists(os.path.join(self.out_dir, 'page.html')))
+        self.assertIn('More section changed', self.read_out('page-2.html'))
@@ -0,0 +1,254 @@
+import sys
+import os
+import zlib
+import struct
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+# Import the code under test.
+cut_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if cut_path not in sys.path: sys.path.insert(0, cut_path)
+import notr_thumbs
+
+
+#-----------------------------------------------------------------------------------
+def make_png(fn, width, height):
+    ''' Minimal gray png. '''
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+    raw = b''.join([b'\x00' + b'\x80' * width for _ in range(height)])
+    with open(fn, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) +
+                chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+
+#-----------------------------------------------------------------------------------
+def png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+
+#-----------------------------------------------------------------------------------
+def filter_row(ftype, row, prev, bpp):
+    ''' Png filter one row. '''
+    out = bytearray()
+    for i, x in enumerate(row):
+        a = row[i - bpp] if i >= bpp else 0
+        b = prev[i]
+        c = prev[i - bpp] if i >= bpp else 0
+        if ftype == 0:
+            pred = 0
+        elif ftype == 1:
+            pred = a
+        elif ftype == 2:
+            pred = b
+        elif ftype == 3:
+            pred = (a + b) // 2
+        else:
+            p = a + b - c
+            pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+            pred = a if pa <= pb and pa <= pc else b if pb <= pc else c
+        out.append((x - pred) & 0xff)
+    return bytes([ftype]) + bytes(out)
+
+
+#-----------------------------------------------------------------------------------
+def make_filtered_png(fn, width, height, color, depth=8, palette=None, trans=None):
+    ''' Png with a pattern, each row a different filter. Returns the rows of pixel bytes. '''
+    bpp = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color] * depth // 8
+    rows = [bytes([(x * 7 + y * 13 + x * y) % (len(palette) if palette else 256) for x in range(width * bpp)])
+            for y in range(height)]
+    prev = bytes(width * bpp)
+    raw = b''
+    for y, row in enumerate(rows):
+        raw += filter_row(y % 5, row, prev, bpp)
+        prev = row
+    with open(fn, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, depth, color, 0, 0, 0)))
+        if palette is not None:
+            f.write(png_chunk(b'PLTE', b''.join(palette)))
+        if trans is not None:
+            f.write(png_chunk(b'tRNS', trans))
+        # Split the data over chunks.
+        data = zlib.compress(raw)
+        for i in range(0, len(data), 50):
+            f.write(png_chunk(b'IDAT', data[i:i + 50]))
+        f.write(png_chunk(b'IEND', b''))
+    return rows
+
+
+#-----------------------------------------------------------------------------------
+def read_png(data):
+    ''' (width, height, color, rows) of a png made by notr_thumbs, which is unfiltered 8 bit. '''
+    width, height, _, color = struct.unpack('>IIBB', data[16:26])
+    bpp = {0: 1, 2: 3, 4: 2, 6: 4}[color]
+    raw = zlib.decompress(data[41:data.index(b'IEND') - 4])
+    stride = width * bpp + 1
+    return (width, height, color, [raw[i + 1:i + stride] for i in range(0, len(raw), stride)])
+
+
+#-----------------------------------------------------------------------------------
+class TestNotrThumbs(unittest.TestCase):
+
+    #------------------------------------------------------------
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'thumbs')
+
+    #------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    #------------------------------------------------------------
+    def test_image_size(self):
+        ''' Header parsing. '''
+        fn = os.path.join(self.tmp_dir, 'a.png')
+        make_png(fn, 300, 100)
+        self.assertEqual(notr_thumbs.get_image_size(fn), (300, 100))
+
+        fn = os.path.join(self.tmp_dir, 'a.gif')
+        with open(fn, 'wb') as f:
+            f.write(b'GIF89a' + struct.pack('<HH', 40, 30) + bytes(20))
+        self.assertEqual(notr_thumbs.get_image_size(fn), (40, 30))
+
+        fn = os.path.join(self.tmp_dir, 'a.bmp')
+        with open(fn, 'wb') as f:
+            f.write(b'BM' + bytes(16) + struct.pack('<ii', 64, -48) + bytes(20))
+        self.assertEqual(notr_thumbs.get_image_size(fn), (64, 48))
+
+        fn = os.path.join(self.tmp_dir, 'a.jpg')
+        with open(fn, 'wb') as f:
+            f.write(b'\xff\xd8' + b'\xff\xe0' + struct.pack('>H', 6) + b'JFIF' +
+                    b'\xff\xc0' + struct.pack('>HBHH', 11, 8, 120, 160) + bytes(8))
+        self.assertEqual(notr_thumbs.get_image_size(fn), (160, 120))
+
+        fn = os.path.join(self.tmp_dir, 'a.txt')
+        with open(fn, 'w') as f:
+            f.write('not an image')
+        self.assertIsNone(notr_thumbs.get_image_size(fn))
+
+    #------------------------------------------------------------
+    @unittest.skipIf(notr_thumbs.Image is None, 'needs pillow')
+    def test_cache(self):
+        ''' Made once, then served from the cache. '''
+        src = os.path.join(self.tmp_dir, 'pic.png')
+        make_png(src, 400, 200)
+        cache = notr_thumbs.ThumbCache(self.cache_dir, 1000000, 100)
+
+        fn, width, height = cache.get(src)
+        self.assertEqual((width, height), (100, 50))
+        self.assertTrue(fn.startswith(self.cache_dir))
+
+        # Original isn't touched again, even by a new instance.
+        with patch('notr_thumbs.Image.open') as im_open:
+            self.assertEqual(cache.get(src), (fn, width, height))
+            self.assertEqual(notr_thumbs.ThumbCache(self.cache_dir, 1000000, 100).get(src), (fn, width, height))
+            im_open.assert_not_called()
+
+        # Changed source makes a new one.
+        os.utime(src, (0, 0))
+        self.assertNotEqual(cache.get(src)[0], fn)
+
+        self.assertIsNone(cache.get(os.path.join(self.tmp_dir, 'nope.png')))
+
+    #------------------------------------------------------------
+    def test_png_filters(self):
+        ''' Plain python png reading. Every filter type and color type. '''
+        fn = os.path.join(self.tmp_dir, 'pic.png')
+        for color, depth in ((0, 8), (2, 8), (4, 8), (6, 8), (2, 16)):
+            rows = make_filtered_png(fn, 23, 11, color, depth)
+            with open(fn, 'rb') as fp:
+                width, height, data = notr_thumbs._png_thumbnail(fp, 100)
+            self.assertEqual((width, height), (23, 11))
+            exp = [row[0::2] for row in rows] if depth == 16 else rows
+            self.assertEqual(read_png(data), (23, 11, color, exp), (color, depth))
+
+        # Palette, with some transparent.
+        palette = [bytes([i, 255 - i, i // 2]) for i in range(0, 250, 10)]
+        rows = make_filtered_png(fn, 9, 5, 3, palette=palette, trans=b'\x00\x80')
+        with open(fn, 'rb') as fp:
+            _, _, data = notr_thumbs._png_thumbnail(fp, 100)
+        alpha = [0, 128] + [255] * 30
+        exp = [b''.join([palette[i] + bytes([alpha[i]]) for i in row]) for row in rows]
+        self.assertEqual(read_png(data), (9, 5, 6, exp))
+
+        # Shrunk is the nearest pixels.
+        rows = make_filtered_png(fn, 40, 20, 0)
+        with open(fn, 'rb') as fp:
+            width, height, data = notr_thumbs._png_thumbnail(fp, 10)
+        self.assertEqual(read_png(data), (10, 5, 0, [bytes([rows[y * 4][x * 4] for x in range(10)]) for y in range(5)]))
+
+        # Not these.
+        with open(fn, 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', struct.pack('>IIBBBBB', 10, 10, 8, 2, 0, 0, 1)))
+        with open(fn, 'rb') as fp:
+            self.assertIsNone(notr_thumbs._png_thumbnail(fp, 10))  # interlaced
+        with open(fn, 'wb') as f:
+            f.write(b'GIF89a' + struct.pack('<HH', 40, 30) + bytes(20))
+        with open(fn, 'rb') as fp:
+            self.assertIsNone(notr_thumbs._png_thumbnail(fp, 10))
+
+    #------------------------------------------------------------
+    def test_no_pillow(self):
+        ''' Png thumbnails are cached in plain python. Others are the original scaled for display. '''
+        src = os.path.join(self.tmp_dir, 'pic.png')
+        make_filtered_png(src, 400, 200, 2)
+        with patch('notr_thumbs.Image', None):
+            cache = notr_thumbs.ThumbCache(self.cache_dir, 1000000, 100)
+            fn, width, height = cache.get(src)
+            self.assertEqual((width, height), (100, 50))
+            self.assertTrue(fn.startswith(self.cache_dir))
+            with open(fn, 'rb') as fp:
+                self.assertEqual(read_png(fp.read())[:3], (100, 50, 2))
+
+            # Original isn't read again, even by a new instance.
+            with patch('notr_thumbs._png_thumbnail') as make:
+                self.assertEqual(cache.get(src), (fn, width, height))
+                self.assertEqual(notr_thumbs.ThumbCache(self.cache_dir, 1000000, 100).get(src), (fn, width, height))
+                make.assert_not_called()
+
+            # Not a png.
+            gif = os.path.join(self.tmp_dir, 'pic.gif')
+            with open(gif, 'wb') as f:
+                f.write(b'GIF89a' + struct.pack('<HH', 400, 300) + bytes(20))
+            self.assertEqual(cache.get(gif), (gif, 100, 75))
+            with patch('notr_thumbs.get_image_size') as get_size:
+                self.assertEqual(cache.get(gif), (gif, 100, 75))
+                get_size.assert_not_called()
+
+            # Too big to show as is.
+            with patch('notr_thumbs._MAX_ORIGINAL_BYTES', 10):
+                os.utime(gif, (0, 0))
+                self.assertIsNone(cache.get(gif))
+
+            # Only so many kept.
+            with patch('notr_thumbs._MAX_ORIGINALS', 2):
+                for i in range(3):
+                    os.utime(gif, (i + 1, i + 1))
+                    cache.get(gif)
+                self.assertEqual(len(cache._originals), 2)
+
+            with open(os.path.join(self.tmp_dir, 'a.txt'), 'w') as f:
+                f.write('not an image')
+            self.assertIsNone(cache.get(os.path.join(self.tmp_dir, 'a.txt')))
+            self.assertIsNone(cache.get(os.path.join(self.tmp_dir, 'nope.png')))
+
+    #------------------------------------------------------------
+    def test_trim(self):
+        ''' Least recently used go first. '''
+        os.mkdir(self.cache_dir)
+        fns = []
+        for i in range(3):
+            fn = os.path.join(self.cache_dir, f'{i:040x}_50_50.png')
+            make_png(fn, 50, 50)
+            os.utime(fn, (i + 1, i + 1))
+            fns.append(fn)
+        cache = notr_thumbs.ThumbCache(self.cache_dir, os.path.getsize(fns[0]) * 2, 100)
+        self.assertEqual(len(cache._load()), 3)
+
+        # Oldest goes, but not the one just made.
+        os.utime(fns[0], (10, 10))
+        cache._trim(fns[0])
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), sorted([os.path.basename(fns[0]), os.path.basename(fns[2])]))
+        self.assertEqual(len(cache._entries), 2)
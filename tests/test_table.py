@@ -1,5 +1,7 @@
 # import sys
 import os
+import shutil
+import tempfile
 import unittest
 from unittest.mock import MagicMock
 
@@ -336,3 +338,375 @@ class TestTable(unittest.TestCase):
         reg = cmd.get_table_region()
         gentext = self.view.substr(reg)
         self.assertEqual(gentext, exptext)
+
+    #------------------------------------------------------------
+    def test_sort_keys(self):
+        ''' Numbers before text and equal ones stay in order. '''
+        matrix = table.TableMatrix('|h|x|\n|b|1|\n|10|2|\n|a|3|\n|9|4|\n|a|5|\n|nan|6|\n')
+        matrix.sort_column(0, True)
+        self.assertEqual([r[1].text for r in matrix.rows], ['x', '4', '2', '3', '5', '1', '6'])
+        matrix.sort_column(0, False)
+        self.assertEqual([r[1].text for r in matrix.rows], ['x', '6', '1', '3', '5', '2', '4'])
+
+    #------------------------------------------------------------
+    def test_find_table(self):
+        ''' Table extent from the text. '''
+        rows = [f'| {i} | row {i} |' for i in range(20000)]  # bigger than one chunk
+        text = '\n'.join(['para', '', 'intro', '| a | b |'] + rows + ['', 'after', '| x |', '| y |'])
+        self.view.insert(None, 0, text)
+        self.view.scope_name = MagicMock(return_value='text.notr meta.table')
+        cmd = table.TableFitCommand(self.view)
+
+        start = text.index('| a |')
+        end = text.index('\nafter')
+        reg = cmd.find_table(text.index('| 15000 |') + 3)
+        self.assertEqual((reg.a, reg.b), (start, end))
+        self.assertEqual(cmd.find_table(start), reg)
+
+        # Not in one.
+        self.assertIsNone(cmd.find_table(text.index('intro')))
+        self.assertIsNone(cmd.find_table(text.index('after')))
+        self.assertIsNone(cmd.find_table(end))
+
+        # At the end of the view with no newline.
+        reg = cmd.find_table(len(text) - 2)
+        self.assertEqual((reg.a, reg.b), (text.index('| x |'), len(text)))
+
+        # Second lookup is cached, until the view changes.
+        ncalls = self.view.scope_name.call_count
+        cmd.find_table(start + 5)
+        self.assertEqual(self.view.scope_name.call_count, ncalls)
+        self.view.insert(None, 0, '\n')
+        cmd.find_table(start + 5)
+        self.assertEqual(self.view.scope_name.call_count, ncalls + 1)
+
+        # Raw block is not a table.
+        self.view.scope_name = MagicMock(return_value='text.notr markup.raw.block.notr')
+        self.view.insert(None, 0, '\n')
+        self.assertIsNone(cmd.find_table(start + 5))
+
+    #------------------------------------------------------------
+    def test_TableFitAll(self):
+        ''' TableFitAllCommand. Every table but the one in the raw block. '''
+        raw = '```\n|not  |a table|\n```\n'
+        self.view.insert(None, 0, self.test_text_str + '\n' + raw + '\n' + self.test_text_str)
+        def _scope_name(point):
+            raw_start = self.view.substr(emu.Region(0, self.view.size())).index(raw)
+            return 'text.notr markup.raw.block.notr' if raw_start <= point < raw_start + len(raw) else 'text.notr meta.table'
+        self.view.scope_name = MagicMock(side_effect=_scope_name)
+
+        cmd = table.TableFitAllCommand(self.view)
+        cmd.run(None)
+
+        # The first table in the file is fitted like the second.
+        lines = self.test_text_str.splitlines(True)
+        fitted = ''.join(lines[:5] + lines[16:23] + lines[12:])
+        self.assertEqual(self.view.substr(emu.Region(0, self.view.size())), fitted + '\n' + raw + '\n' + fitted)
+
+        # Nothing to do the second time.
+        self.view.replace = MagicMock()
+        cmd.run(None)
+        self.view.replace.assert_not_called()
+
+    #------------------------------------------------------------
+    def test_TableWidths(self):
+        ''' Widths tracked a row at a time. '''
+        matrix = table.TableMatrix('| a | bb |\n| ccc | d |\n| ccc | |\n')
+        widths = table.TableWidths(matrix)
+        self.assertEqual(widths.widths, [3, 2])
+
+        self.assertEqual(widths.update_row(0, ['aaaa', 'bb']), [0])
+        self.assertEqual(widths.widths, [4, 2])
+        self.assertEqual(widths.update_row(0, ['a', 'bb']), [0])
+        self.assertEqual(widths.widths, [3, 2])
+        # One of two widest.
+        self.assertEqual(widths.update_row(1, ['c', 'd']), [])
+        self.assertEqual(widths.update_row(2, ['', '']), [0])
+        self.assertEqual(widths.widths, [1, 2])
+        self.assertEqual(widths.update_row(0, ['a', '']), [1])
+        self.assertEqual(widths.widths, [1, 1])
+        self.assertIsNone(widths.update_row(0, ['a', 'b', 'c']))
+
+    #------------------------------------------------------------
+    def test_TableAutoFit(self):
+        ''' TableAutoFitCommand. Typing in a cell. '''
+        text = 'para\n\n| State | Size |\n| ME    | 11   |\n| IA    | 31   |\n\nafter\n'
+        self.view.insert(None, 0, text)
+        self.view.scope_name = MagicMock(return_value='text.notr meta.table')
+        cmd = table.TableAutoFitCommand(self.view)
+
+        def _type(point, chars):
+            self.view.insert(None, point, chars)
+            sel = emu.Selection(self.view.id())
+            sel.add(emu.Region(point + len(chars), point + len(chars)))
+            self.view.set_selection(sel)
+            cmd.run(None)
+
+        def _text():
+            return self.view.substr(emu.Region(0, self.view.size()))
+
+        # First time parses it all. Nothing changed.
+        _type(text.index('11') + 2, '')
+        self.assertEqual(_text(), text)
+
+        # Fits in the column so just that row.
+        replace = self.view.replace
+        self.view.replace = MagicMock(side_effect=replace)
+        _type(text.index('IA') + 2, 'X')
+        self.assertEqual(_text(), text.replace('IA   ', 'IAX  '))
+        self.assertEqual(self.view.replace.call_count, 1)
+        line = self.view.line(text.index('IA'))
+        self.assertEqual((self.view.replace.call_args[0][1].a, self.view.replace.call_args[0][1].b), (line.a, line.b + 1))
+        self.assertEqual(self.view.sel()[0].b, text.index('IA') + 3)
+
+        # Wider column rewrites all rows.
+        _type(text.index('31') + 2, '4567')
+        exp = 'para\n\n| State | Size   |\n| ME    | 11     |\n| IAX   | 314567 |\n\nafter\n'
+        self.assertEqual(_text(), exp)
+        self.assertEqual(self.view.sel()[0].b, exp.index('314567') + 6)
+
+        # And back.
+        point = exp.index('314567') + 6
+        replace(None, emu.Region(point - 4, point), '')
+        sel = emu.Selection(self.view.id())
+        sel.add(emu.Region(point - 4, point - 4))
+        self.view.set_selection(sel)
+        cmd.run(None)
+        self.assertEqual(_text(), text.replace('IA   ', 'IAX  '))
+
+    #------------------------------------------------------------
+    def test_TableAutoFitOtherEdits(self):
+        ''' TableAutoFitCommand after edits that aren't typing in the caret row. '''
+        text = '| h    | n |\n| aaaa | 1 |\n| b    | 2 |\n'
+        self.view.insert(None, 0, text)
+        self.view.scope_name = MagicMock(return_value='text.notr meta.table')
+        sel = emu.Selection(self.view.id())
+        sel.add(emu.Region(text.index('aaaa'), text.index('aaaa')))
+        self.view.set_selection(sel)
+        fit = table.TableAutoFitCommand(self.view)
+        evt = table.TableEvent()
+
+        def _text():
+            return self.view.substr(emu.Region(0, self.view.size()))
+
+        # Table commands aren't auto fitted and start the fit over.
+        fit.run(None)
+        evt.on_text_command(self.view, 'table_sort_col', {'asc': False})
+        self.assertIn(self.view.id(), table._no_auto_fit)
+        table.TableSortColCommand(self.view).run(None, False)
+        evt.on_post_text_command(self.view, 'table_sort_col', {'asc': False})
+        exp = '| h    | n |\n| b    | 2 |\n| aaaa | 1 |\n'
+        self.assertEqual(_text(), exp)
+        fit.run(None)
+        self.assertEqual(_text(), exp)
+
+        # Any other one edit to other rows.
+        fit.run(None)
+        self.view.replace(None, emu.Region(exp.index('| b'), len(exp)), '| aaaa | 1 |\n| b    | 2 |\n')
+        fit.run(None)
+        self.assertEqual(_text(), text)
+
+        # Move a column.
+        sel = emu.Selection(self.view.id())
+        sel.add(emu.Region(text.index('1'), text.index('1')))
+        self.view.set_selection(sel)
+        fit.run(None)
+        table.TableMoveColCommand(self.view).run(None, 'left')
+        fit.run(None)
+        self.assertEqual(_text(), '| n | h    |\n| 1 | aaaa |\n| 2 | b    |\n')
+
+    #------------------------------------------------------------
+    def test_column_ops(self):
+        ''' Column major TableMatrix. '''
+        matrix = table.TableMatrix('| a | bb |\n| ccc | d\n|x|\n')
+        self.assertEqual(matrix.count_columns(), 2)
+        self.assertEqual(matrix.num_rows, 3)
+        self.assertEqual(matrix.row_texts(2), ['x', ''])
+        self.assertEqual(matrix.format(), '| a   | bb |\n| ccc | d  |\n| x   |    |\n')
+
+        matrix.move_column(0, 1)
+        self.assertEqual(matrix.format(), '| bb | a   |\n| d  | ccc |\n|    | x   |\n')
+        matrix.move_column(1, 2)  # off the end
+        self.assertEqual(matrix.row_texts(0), ['bb', 'a'])
+
+        matrix.insert_column(1)
+        matrix.set_row(1, ['dddd', 'e', 'ccc'])
+        self.assertEqual(matrix.format(), '| bb   |   | a   |\n| dddd | e | ccc |\n|      |   | x   |\n')
+        matrix.delete_column(0)
+        self.assertEqual([[v.text for v in row] for row in matrix.rows], [['', 'a'], ['e', 'ccc'], ['', 'x']])
+        matrix.insert_column(5)
+        self.assertEqual(matrix.format(), '|   | a   |  |\n| e | ccc |  |\n|   | x   |  |\n')
+
+    #------------------------------------------------------------
+    def test_sort_multi(self):
+        ''' Typed columns and more than one key. '''
+        matrix = table.TableMatrix('\n'.join([
+            '| Item   | Status | Date       | Cost |',
+            '| item10 | open   | 2024-02-01 | 10   |',
+            '| item2  | Done   | 2024-01-15 | 9.5  |',
+            '| Item1  | open   | 2023-12-31 | 100  |',
+            '| item2  | done   | 2024-03-01 |      |',
+            '']))
+        self.assertEqual([table.column_type(col[1:]) for col in matrix.cols], ['natural', 'text', 'date', 'number'])
+
+        matrix.sort_columns([(0, True)])
+        self.assertEqual([row[0] for row in [matrix.row_texts(i) for i in range(5)]], ['Item', 'Item1', 'item2', 'item2', 'item10'])
+        matrix.sort_columns([(3, True)])
+        self.assertEqual([matrix.row_texts(i)[3] for i in range(5)], ['Cost', '9.5', '10', '100', ''])
+
+        # Status then date descending.
+        matrix.sort_columns(table.parse_sort_spec('status, -3', matrix.row_texts(0)))
+        self.assertEqual([matrix.row_texts(i)[2] for i in range(1, 5)], ['2024-03-01', '2024-01-15', '2024-02-01', '2023-12-31'])
+
+        with self.assertRaises(ValueError):
+            table.parse_sort_spec('Nope', matrix.row_texts(0))
+        with self.assertRaises(ValueError):
+            table.parse_sort_spec('5', matrix.row_texts(0))
+
+    #------------------------------------------------------------
+    def test_sort_mixed(self):
+        ''' Numbers in a column with some text still sort as numbers. '''
+        text = '| N |\n| 1.5 |\n| 1.25 |\n| 10 |\n| -3 |\n| n/a |\n| B |\n| a |\n'
+        matrix = table.TableMatrix(text)
+        self.assertEqual(table.column_type(matrix.cols[0][1:]), 'natural')
+
+        # Single column is the TableValue order, case sensitive.
+        matrix.sort_column(0, True)
+        self.assertEqual([row[0].text for row in matrix.rows], ['N', '-3', '1.25', '1.5', '10', 'B', 'a', 'n/a'])
+        matrix.sort_column(0, False)
+        self.assertEqual([row[0].text for row in matrix.rows], ['N', 'n/a', 'a', 'B', '10', '1.5', '1.25', '-3'])
+
+        # Typed is case insensitive for the text.
+        matrix = table.TableMatrix(text)
+        matrix.sort_columns([(0, True)])
+        self.assertEqual([row[0].text for row in matrix.rows], ['N', '-3', '1.25', '1.5', '10', 'a', 'B', 'n/a'])
+
+    #------------------------------------------------------------
+    def test_sort_footer(self):
+        ''' The footer stays at the bottom. '''
+        matrix = table.TableMatrix('| Name | Num |\n| b | 1 |\n| c | 3 |\n| a | 2 |\n')
+        matrix.set_footer(1, 'sum')
+        self.assertEqual(matrix.numeric_columns(), [1])
+
+        matrix.sort_column(1, False)
+        self.assertEqual([row[1].text for row in matrix.rows], ['Num', '3', '2', '1', 'sum=6'])
+        self.assertEqual(matrix.footer_row(), 4)
+        matrix.sort_columns([(1, True)])
+        self.assertEqual([row[1].text for row in matrix.rows], ['Num', '1', '2', '3', 'sum=6'])
+        self.assertEqual(table.column_type(matrix.cols[1][1:matrix.body_end()]), 'number')
+
+        # Footer is only a minimum width.
+        widths = table.TableWidths(matrix)
+        self.assertEqual(widths.widths, [4, 5])
+        self.assertEqual(widths.update_row(4, ['', 'sum=600']), [1])
+        self.assertEqual(widths.update_row(4, ['', 'sum=6']), [1])
+        self.assertEqual(widths.widths, [4, 5])
+        self.assertEqual(widths.update_row(1, ['', '100000']), [1])
+        self.assertEqual(widths.widths, [4, 6])
+
+    #------------------------------------------------------------
+    def test_aggregate(self):
+        ''' Footer and summary values. '''
+        matrix = table.TableMatrix('\n'.join([
+            '| Task | Hours | Cost  | Who |',
+            '| a    | 2     | 10.50 | me  |',
+            '| b    | 3.5   | 2.25  | you |',
+            '| c    |       | 100   | me  |',
+            '']))
+        self.assertEqual(matrix.numeric_columns(), [1, 2])
+        self.assertEqual(matrix.aggregate(2), {'sum': '112.75', 'avg': '37.58', 'min': '2.25', 'max': '100.00', 'count': '3'})
+        self.assertIsNone(matrix.aggregate(3))
+        self.assertIsNone(matrix.footer_row())
+
+        matrix.set_footer(2, 'sum')
+        matrix.set_footer(1, 'count')
+        self.assertEqual(matrix.footer_row(), 4)
+        self.assertEqual(matrix.row_texts(4), ['', 'count=2', 'sum=112.75', ''])
+        self.assertEqual(matrix.numeric_columns(), [1, 2])
+
+        # Change a value and refit.
+        text = matrix.format().replace('100 ', '200 ')
+        matrix = table.TableMatrix(text)
+        matrix.update_footer()
+        self.assertEqual(matrix.row_texts(4), ['', 'count=2', 'sum=212.75', ''])
+        self.assertEqual(matrix.aggregate(2)['max'], '200.00')
+
+    #------------------------------------------------------------
+    def test_csv(self):
+        ''' Csv round trip. '''
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tmp_dir, 'in.csv')
+            with open(fn, 'w', newline='') as fp:
+                fp.write('Name,Note,Cost\r\n"Smith, J","two\nlines",1.5\r\nDoe,"a|b ""quoted""",\r\n')
+
+            matrix = table.read_csv(fn)
+            self.assertEqual(matrix.format(), '\n'.join([
+                '| Name     | Note         | Cost |',
+                '| Smith, J | two lines    | 1.5  |',
+                '| Doe      | a¦b "quoted" |      |',
+                '']))
+
+            out_fn = os.path.join(tmp_dir, 'out.tsv')
+            table.write_csv(out_fn, matrix)
+            with open(out_fn, newline='') as fp:
+                self.assertEqual(fp.read(), 'Name\tNote\tCost\r\nSmith, J\ttwo lines\t1.5\r\nDoe\t"a¦b ""quoted"""\t\r\n')
+            self.assertEqual(table.read_csv(out_fn).format(), matrix.format())
+
+            # Aggregates aren't data.
+            matrix = table.TableMatrix('| a | n |\n| x | 1 |\n| y | 2 |\n|   | sum=3 |\n')
+            out_fn = os.path.join(tmp_dir, 'agg.csv')
+            self.assertEqual(table.write_csv(out_fn, matrix), 3)
+            with open(out_fn, newline='') as fp:
+                self.assertEqual(fp.read(), 'a,n\r\nx,1\r\ny,2\r\n')
+            self.assertEqual(table.write_csv(out_fn, matrix, footer=True), 4)
+            with open(out_fn, newline='') as fp:
+                self.assertEqual(fp.read(), 'a,n\r\nx,1\r\ny,2\r\n,sum=3\r\n')
+
+            # Command with the caret mid line, then in a blank line.
+            fn = os.path.join(tmp_dir, 'small.csv')
+            with open(fn, 'w') as fp:
+                fp.write('a,b\n1,2\n')
+            self.view.insert(None, 0, 'para one\nnext\n')
+            sel = emu.Selection(self.view.id())
+            sel.add(emu.Region(4, 4))
+            self.view.set_selection(sel)
+            cmd = table.TableImportCsvCommand(self.view)
+            cmd.run(None, fn)
+            self.assertEqual(self.view.substr(emu.Region(0, self.view.size())),
+                             'para one\n\n| a | b |\n| 1 | 2 |\n\nnext\n')
+            sel = emu.Selection(self.view.id())
+            sel.add(emu.Region(self.view.size(), self.view.size()))
+            self.view.set_selection(sel)
+            cmd.run(None, fn)
+            self.assertTrue(self.view.substr(emu.Region(0, self.view.size())).endswith('\nnext\n\n| a | b |\n| 1 | 2 |\n'))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    #------------------------------------------------------------
+    def test_line_changes(self):
+        ''' Only changed lines are replaced. '''
+        old = '| a | 1 |\n| b | 2 |\n| c | 3 |\n| d | 4 |\n'
+        self.assertEqual(table.line_changes(old, old), [])
+        self.assertEqual(table.line_changes(old, old.replace('b', 'B').replace('d', 'D')),
+                         [(30, 40, '| D | 4 |\n'), (10, 20, '| B | 2 |\n')])
+        self.assertEqual(table.line_changes(old, old.replace('b', 'B').replace('c', 'C')), [(10, 30, '| B | 2 |\n| C | 3 |\n')])
+        # Rows added and removed.
+        self.assertEqual(table.line_changes(old, old + '| e | 5 |\n'), [(40, 40, '| e | 5 |\n')])
+        self.assertEqual(table.line_changes(old, old.replace('| c | 3 |\n', '')), [(20, 30, '')])
+        # No newline at the end.
+        self.assertEqual(table.line_changes(old[:-1], old), [(30, 39, '| d | 4 |\n')])
+
+        # Through the command. Sort swaps two rows.
+        self.view.insert(None, 0, 'para\n\n| h | x |\n' + old + '\nafter\n')
+        self.view.scope_name = MagicMock(return_value='text.notr meta.table')
+        self.view.replace(None, emu.Region(26, 46), '| c | 3 |\n| b | 2 |\n')
+        sel = emu.Selection(self.view.id())
+        sel.add(emu.Region(17, 17))
+        self.view.set_selection(sel)
+        replace = self.view.replace
+        self.view.replace = MagicMock(side_effect=replace)
+        table.TableSortColCommand(self.view).run(None, True)
+        self.assertEqual(self.view.substr(emu.Region(0, self.view.size())), 'para\n\n| h | x |\n' + old + '\nafter\n')
+        self.assertEqual(self.view.replace.call_count, 1)
+        self.assertEqual(self.view.replace.call_args[0][1], emu.Region(26, 46))